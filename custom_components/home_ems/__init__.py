@@ -1,12 +1,21 @@
-import asyncio
 import logging
 from homeassistant.core import HomeAssistant
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers import entity_registry as er
 from homeassistant.core import Context
 from homeassistant.components.button import ButtonEntity
 from .const import *
 from .load_balancer import *
+from .scheduler import Scheduler
+from .entity_cache import EntityIdCache
+from .command_bus import CommandBus
+from .aggregator import PowerAggregator
+from .overload import OverloadGuard
+from .websocket import async_register_websocket
+from .metrics import Metrics, MetricsView
+from .profiler import Profiler
+from .persistence import StateStore
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -14,21 +23,44 @@ _LOGGER = logging.getLogger(__name__)
 CONFIG_SCHEMA = cv.config_entry_only_config_schema(DOMAIN)
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
+    load_balancer = LoadBalancer(hass, entry)
     hass.data[DOMAIN] = {
-        "load_balancer"  : LoadBalancer(hass, entry)
+        "load_balancer"    : load_balancer,
+        "entity_cache"     : EntityIdCache(hass),
+        "command_bus"      : CommandBus(hass),
+        "metrics"          : Metrics(),
+        "profiler"         : Profiler(hass),
+        "state_store"      : StateStore(hass, load_balancer),
+        "power_aggregator" : PowerAggregator(load_balancer.enphase.power_net_id) if CONF_AGGREGATOR_ENABLED else None,
+        "overload_guard"   : OverloadGuard(hass, load_balancer) if CONF_OVERLOAD_ENABLED else None
     }
+    if CONF_AGGREGATOR_ENABLED:
+        entry.async_on_unload(hass.data[DOMAIN]["power_aggregator"].subscribe(hass))
+    if CONF_OVERLOAD_ENABLED:
+        entry.async_on_unload(hass.data[DOMAIN]["overload_guard"].start())
+    # EV connector state machine
+    entry.async_on_unload(load_balancer.subscribe())
+    # Decision trace subscription
+    async_register_websocket(hass)
+    # Views cannot be removed: registered once, they read hass.data
+    if not hass.data.get(f"{DOMAIN}_metrics_view"):
+        hass.http.register_view(MetricsView(hass))
+        hass.data[f"{DOMAIN}_metrics_view"] = True
     await hass.config_entries.async_forward_entry_setups(entry, ["sensor", "switch", "select"])
-    async def scheduler_loop():
-        hass.data[DOMAIN]["load_balancer"].late_init()
-        while True:
-            await asyncio.sleep(15 if not config_dev(hass) == True else 5)
-            await hass.data[DOMAIN]["load_balancer"].run(hass)
-    hass.loop.create_task(scheduler_loop())
+    # Resolve internal switches/select once, registry updates invalidate it
+    hass.data[DOMAIN]["entity_cache"].build(entry)
+    entry.async_on_unload(
+        hass.bus.async_listen(er.EVENT_ENTITY_REGISTRY_UPDATED, hass.data[DOMAIN]["entity_cache"].on_registry_updated)
+    )
+    # Stopped with the entry: a reload never leaves a second loop running
+    scheduler = Scheduler(hass, entry, load_balancer)
+    hass.data[DOMAIN]["scheduler"] = scheduler
+    scheduler.start()
     return True
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
-    for domain in ["sensor", "select", "switch"]:
-        await hass.config_entries.async_forward_entry_unload(entry, domain)
+    # The scheduler and the listeners are stopped by the entry callbacks
+    unloaded = await hass.config_entries.async_unload_platforms(entry, ["sensor", "select", "switch"])
     hass.data[DOMAIN]["load_balancer"] = None
-    return True
+    return unloaded
@@ -0,0 +1,222 @@
+import logging
+import math
+from array import array
+from collections import deque
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_state_change_event
+from .clock import monotonic
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+BUCKETS = 2 * CONF_AGGREGATOR_RANGE // CONF_AGGREGATOR_BUCKET + 1
+# Buckets are summed by blocks: a percentile scans the blocks, then one block
+BLOCK = 40
+
+def bucket(value):
+    if value <= -CONF_AGGREGATOR_RANGE:
+        return 0
+    if value >= CONF_AGGREGATOR_RANGE:
+        return BUCKETS - 1
+    return int((value + CONF_AGGREGATOR_RANGE) // CONF_AGGREGATOR_BUCKET)
+
+class Window:
+
+    def __init__(self, duration, capacity):
+        self.duration = duration
+        self.capacity = capacity
+        # Ring buffer: samples from start to start + count (mod capacity)
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+        # Sequence number of the next sample
+        self.seq = 0
+        self.sum = 0.0
+        # Monotonic queues of (seq, value): the front is the min/max
+        self.minimums = deque()
+        self.maximums = deque()
+        # Fixed-width histogram for the percentiles
+        self.histogram = [0] * BUCKETS
+        self.blocks = [0] * (BUCKETS // BLOCK + 1)
+
+    def add(self, t, value):
+        times = self.times
+        oldest = t - self.duration
+        while self.count > 0 and (self.count == self.capacity or times[self.start] <= oldest):
+            self.evict()
+        index = self.start + self.count
+        if index >= self.capacity:
+            index -= self.capacity
+        times[index] = t
+        self.values[index] = value
+        self.count += 1
+        self.sum += value
+        index = bucket(value)
+        self.histogram[index] += 1
+        self.blocks[index // BLOCK] += 1
+        minimums = self.minimums
+        while minimums and minimums[-1][1] >= value:
+            minimums.pop()
+        maximums = self.maximums
+        while maximums and maximums[-1][1] <= value:
+            maximums.pop()
+        sample = (self.seq, value)
+        minimums.append(sample)
+        maximums.append(sample)
+        self.seq += 1
+
+    def evict(self):
+        oldest = self.seq - self.count
+        value = self.values[self.start]
+        self.sum -= value
+        index = bucket(value)
+        self.histogram[index] -= 1
+        self.blocks[index // BLOCK] -= 1
+        if self.minimums[0][0] == oldest:
+            self.minimums.popleft()
+        if self.maximums[0][0] == oldest:
+            self.maximums.popleft()
+        self.start += 1
+        if self.start == self.capacity:
+            self.start = 0
+        self.count -= 1
+        if self.count == 0:
+            # Do not carry the rounding errors of the running sum
+            self.sum = 0.0
+
+    def expire(self, t):
+        while self.count > 0 and self.times[self.start] <= t - self.duration:
+            self.evict()
+
+    def span(self, t):
+        return t - self.times[self.start] if self.count > 0 else 0.0
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else None
+
+    def minimum(self):
+        return self.minimums[0][1] if self.count > 0 else None
+
+    def maximum(self):
+        return self.maximums[0][1] if self.count > 0 else None
+
+    def percentile(self, q):
+        # Center of the bucket holding the q-th percentile
+        if self.count == 0:
+            return None
+        rank = q / 100 * (self.count - 1)
+        seen = 0
+        for block, total in enumerate(self.blocks):
+            if seen + total <= rank:
+                seen += total
+                continue
+            for index in range(block * BLOCK, min((block + 1) * BLOCK, BUCKETS)):
+                seen += self.histogram[index]
+                if seen > rank:
+                    return index * CONF_AGGREGATOR_BUCKET - CONF_AGGREGATOR_RANGE + CONF_AGGREGATOR_BUCKET / 2
+        return CONF_AGGREGATOR_RANGE
+
+class PowerAggregator:
+
+    def __init__(self, entity_id):
+        self.entity_id = entity_id
+        self.windows = {
+            duration: Window(duration, CONF_AGGREGATOR_CAPACITY)
+            for duration in (CONF_AGGREGATOR_FAST_WINDOW, CONF_AGGREGATOR_SLOW_WINDOW)
+        }
+        self.ewma = None
+        # Last sample pushed in the windows (received or held)
+        self.last_time = None
+        self.last_value = None
+        # Last sample received from the sensor
+        self.last_update = None
+        self.samples = 0
+        self.invalid = 0
+
+    def subscribe(self, hass):
+        _LOGGER.info(f"[aggregator] sampling {self.entity_id}")
+        return async_track_state_change_event(hass, [ self.entity_id ], self.on_state_change)
+
+    @callback
+    def on_state_change(self, event):
+        state = event.data.get("new_state")
+        try:
+            value = float(state.state)
+        except (AttributeError, TypeError, ValueError):
+            self.invalid += 1
+            return
+        if state.attributes.get("unit_of_measurement") == "kW":
+            value *= 1000
+        self.add(value)
+
+    def add(self, value):
+        now = monotonic()
+        self.last_update = now
+        self.samples += 1
+        self.push(now, value)
+
+    def push(self, now, value):
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            alpha = 1 - math.exp(-(now - self.last_time) / CONF_AGGREGATOR_EWMA_TAU)
+            self.ewma += alpha * (value - self.ewma)
+        self.last_time = now
+        self.last_value = value
+        for window in self.windows.values():
+            window.add(now, value)
+
+    def refresh(self):
+        # Sensors only report changes: hold the last value so that a stable
+        # power weighs as much as a changing one
+        now = monotonic()
+        if not self.is_fresh():
+            return
+        while now - self.last_time >= CONF_AGGREGATOR_HOLD:
+            self.push(self.last_time + CONF_AGGREGATOR_HOLD, self.last_value)
+        for window in self.windows.values():
+            window.expire(now)
+
+    def is_fresh(self):
+        return self.last_update is not None and monotonic() - self.last_update <= CONF_AGGREGATOR_MAX_AGE
+
+    def is_ready(self, duration):
+        # Fresh and covering at least half of the window
+        return self.is_fresh() and self.windows[duration].span(monotonic()) >= duration / 2
+
+    def get_ewma(self):
+        return self.ewma
+
+    def mean(self, duration):
+        return self.windows[duration].mean()
+
+    def minimum(self, duration):
+        return self.windows[duration].minimum()
+
+    def maximum(self, duration):
+        return self.windows[duration].maximum()
+
+    def percentile(self, duration, q):
+        return self.windows[duration].percentile(q)
+
+    def stats(self):
+        stats = {
+            "samples": self.samples,
+            "invalid": self.invalid,
+            "age": round(monotonic() - self.last_update, 1) if self.last_update is not None else None,
+            "ewma": round(self.ewma) if self.ewma is not None else None,
+        }
+        for duration, window in self.windows.items():
+            if window.count == 0:
+                continue
+            stats[f"{duration}s"] = {
+                "count": window.count,
+                "mean": round(window.mean()),
+                "min": round(window.minimum()),
+                "max": round(window.maximum()),
+                "p10": window.percentile(10),
+                "p50": window.percentile(50),
+                "p90": window.percentile(90),
+            }
+        return stats
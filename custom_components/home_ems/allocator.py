@@ -0,0 +1,130 @@
+import itertools
+import logging
+from .utils import get_phase_list
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class Demand:
+
+    def __init__(self, device, priority, min_power, max_power, current=0, can_start=True, can_stop=True, keep_power=None, continuous=False):
+        self.device = device
+        self.priority = priority
+        self.min_power = min_power
+        self.max_power = max_power
+        # Power currently given to the device (0 = off or suspended)
+        self.current = current
+        self.can_start = can_start
+        self.can_stop = can_stop
+        # Budget needed to keep running (below min_power to avoid bouncing)
+        self.keep_power = keep_power if keep_power is not None else min_power
+        self.continuous = continuous
+        self.phases = device.get_phases()
+        self.consumed = device.get_consumed_power()
+
+    def is_running(self):
+        return self.current > 0
+
+class Allocator:
+
+    def __init__(self):
+        self.runs = 0
+        self.candidates = 0
+        self.preemptions = 0
+
+    def allocate(self, demands, budget, expected, headroom):
+        # Every on/off combination is scored (few devices), continuous loads
+        # share what is left by priority
+        demands = sorted(demands, key=lambda demand: -demand.priority)
+        self.runs += 1
+        best = None
+        best_score = None
+        for states in itertools.product((False, True), repeat=len(demands)):
+            allocation = self.fill(demands, states, budget, expected, headroom)
+            if allocation is None:
+                continue
+            self.candidates += 1
+            switches = sum(1 for demand, on in zip(demands, states) if on != demand.is_running())
+            value = sum(demand.priority * allocation[demand.device] for demand in demands)
+            score = (value - CONF_ALLOCATOR_SWITCH_COST * switches, -switches)
+            if best_score is None or score > best_score:
+                best = allocation
+                best_score = score
+        if best is None:
+            # Devices that can neither start nor stop do not fit: keep them
+            return { demand.device: demand.current for demand in demands }
+        stopped = any(demand.is_running() and best[demand.device] == 0 for demand in demands)
+        started = any(not demand.is_running() and best[demand.device] > 0 for demand in demands)
+        if stopped and started:
+            self.preemptions += 1
+        return best
+
+    def minimum(self, demands):
+        # Safe mode: no start, running loads at their min power or stopped
+        allocation = {}
+        for demand in demands:
+            if not demand.is_running():
+                allocation[demand.device] = 0
+            elif demand.continuous:
+                allocation[demand.device] = min(demand.current, demand.min_power)
+            else:
+                allocation[demand.device] = 0 if demand.can_stop else demand.current
+        return allocation
+
+    def fill(self, demands, states, budget, expected, headroom):
+        tolerance = 0
+        minimums = 0
+        starts = False
+        for demand, on in zip(demands, states):
+            if on != demand.is_running() and not (demand.can_start if on else demand.can_stop):
+                return None
+            if not on:
+                continue
+            minimums += demand.min_power
+            if demand.is_running():
+                tolerance += demand.min_power - demand.keep_power
+            else:
+                starts = True
+        free = budget - minimums
+        free_expected = expected - minimums
+        if starts:
+            # A start needs the min power of every load, now and in the forecast
+            if free < 0 or free_expected < 0:
+                return None
+        elif free + tolerance < 0:
+            # Running loads may keep going on less than their min power
+            return None
+
+        allocation = {}
+        # Per phase power left by the other loads (phase ledger)
+        left = list(headroom)
+        for demand, on in zip(demands, states):
+            if not on:
+                allocation[demand.device] = 0
+                continue
+            power = demand.min_power
+            if demand.continuous:
+                power += min(max(free, 0), demand.max_power - demand.min_power)
+                if power > demand.current:
+                    # Only raise on a surplus that is expected to last
+                    power = max(min(power, demand.min_power + max(free_expected, 0)), demand.current, demand.min_power)
+            # Per phase current limit
+            phases = get_phase_list(demand.phases)
+            limit = min(left[phase] for phase in phases) * len(phases)
+            if power > limit:
+                if not demand.continuous or limit < demand.min_power:
+                    return None
+                power = limit
+            for phase in phases:
+                left[phase] -= power / len(phases)
+            free -= power - demand.min_power
+            free_expected -= power - demand.min_power
+            allocation[demand.device] = power
+        return allocation
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "candidates": self.candidates,
+            "preemptions": self.preemptions,
+        }
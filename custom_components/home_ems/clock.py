@@ -0,0 +1,25 @@
+import time
+from datetime import datetime
+
+class SystemClock:
+
+    def now(self):
+        return datetime.now()
+
+    def monotonic(self):
+        return time.monotonic()
+
+_clock = SystemClock()
+
+def set_clock(clock):
+    # The simulator replaces the system clock by a virtual one
+    global _clock
+    _clock = clock
+
+def now():
+    # Wall clock: only for time of day rules (HC, 6pm...)
+    return _clock.now()
+
+def monotonic():
+    # Delays and deadlines do not depend on wall clock changes (DST, NTP)
+    return _clock.monotonic()
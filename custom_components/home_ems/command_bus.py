@@ -0,0 +1,126 @@
+import logging
+from .executor import ServiceExecutor
+from .utils import create_task, get_state, metrics
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class Command:
+
+    def __init__(self, kind, method, data, on_done=None):
+        self.kind = kind
+        self.method = method
+        self.data = data
+        self.entity_id = data.get("entity_id")
+        self.callbacks = [ on_done ] if on_done is not None else []
+
+    def done(self, success):
+        for on_done in self.callbacks:
+            on_done(success)
+
+    def key(self):
+        # turn_on/turn_off on the same entity target the same state
+        method = "turn" if self.method in ("turn_on", "turn_off") else self.method
+        return (self.kind, self.entity_id, method)
+
+    def value(self):
+        if self.method in ("turn_on", "turn_off"):
+            return self.method
+        if self.method == "set_value":
+            return self.data.get("value")
+        if self.method == "set_temperature":
+            return self.data.get("temperature")
+        return None
+
+    def is_noop(self, hass):
+        # True when the target is already in the requested state
+        if self.entity_id is None:
+            return False
+        state = get_state(hass, self.entity_id)
+        if state is None:
+            return False
+        if self.method in ("turn_on", "turn_off"):
+            return state.state == self.method[5:]
+        try:
+            if self.method == "set_value":
+                return float(state.state) == float(self.data["value"])
+            if self.method == "set_temperature":
+                return float(state.attributes.get("temperature")) == float(self.data["temperature"])
+        except (TypeError, ValueError):
+            pass
+        return False
+
+    def __repr__(self):
+        return f"{self.kind}.{self.method}({self.data})"
+
+class CommandBus:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.executor = ServiceExecutor(hass)
+        self.pending = {}
+        # key -> command sent and not completed yet: the state machine does
+        # not reflect it until the call returns
+        self.inflight = {}
+        self.flush_handle = None
+        self.issued = 0
+        self.suppressed = 0
+        self.coalesced = 0
+
+    def send(self, kind, method, data, on_done=None):
+        command = Command(kind, method, data, on_done)
+        key = command.key()
+        if key in self.pending:
+            # Only the last write to a target is sent, it reports for all
+            self.coalesced += 1
+            command.callbacks = self.pending.pop(key).callbacks + command.callbacks
+        self.pending[key] = command
+        # Commands issued outside a tick are flushed at the next loop iteration
+        if self.flush_handle is None:
+            self.flush_handle = self.hass.loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending = self.pending, {}
+        commands = []
+        for command in pending.values():
+            inflight = self.inflight.get(command.key())
+            if inflight is not None and command.value() is not None and command.value() == inflight.value():
+                # Same write still in flight: it reports for this one too
+                _LOGGER.debug(f"[command bus] suppress {command} (in flight)")
+                self.suppressed += 1
+                inflight.callbacks += command.callbacks
+            elif inflight is None and command.is_noop(self.hass):
+                _LOGGER.debug(f"[command bus] suppress {command}")
+                self.suppressed += 1
+                command.done(True)
+            else:
+                commands.append(command)
+        self.issued += len(commands)
+        counters = metrics(self.hass)
+        if counters is not None:
+            counters.service_calls += len(commands)
+        for command in commands:
+            self.inflight[command.key()] = command
+            create_task(self.hass, self.async_send(command))
+        return commands
+
+    async def async_send(self, command):
+        try:
+            success = await self.executor.async_call(command.kind, command.method, command.data)
+        finally:
+            # A later write to the same target owns the record
+            if self.inflight.get(command.key()) is command:
+                del self.inflight[command.key()]
+        if not success:
+            _LOGGER.error(f"[command bus] {command} failed")
+        command.done(success)
+
+    def stats(self):
+        return {
+            "issued": self.issued,
+            "suppressed": self.suppressed,
+            "coalesced": self.coalesced,
+        }
@@ -5,6 +5,7 @@ CONF_ENTITY_ID = "home_ems"
 
 CONF_MAX_POWER_PER_PHASE = 6000
 CONF_MAX_CURRENT_PER_PHASE = 25
+CONF_PHASE_VOLTAGE = 230
 
 CONF_WATER_HEATER_MIN_TEMP = 50
 CONF_WATER_HEATER_MAX_TEMP = 62
@@ -19,6 +20,7 @@ CONF_POOL_ID = "pipool"
 
 # Electrical config
 CONF_POOL_HEATER_PHASE = 1 << 1
+CONF_POOL_HEATER_ABOVE_TIME = 15
 
 CONF_WATER_HEATER_PHASE = 1 << 2
 CONF_WATER_HEATER_MIN_POWER = 500
@@ -28,14 +30,116 @@ CONF_EV_CHARGER_PHASE_MONO = 1 << 0
 CONF_EV_CHARGER_MIN_POWER_TRI = 4000
 CONF_EV_CHARGER_MIN_POWER_MONO = 1500
 CONF_EV_CHARGER_MIN_DELTA = 200
+CONF_EV_CHARGER_POWER_OFFERED_SCALE = 1000 # power_offered sensor is in kW
+CONF_EV_CHARGER_FULL_DELAY = 30 # minutes in SuspendedEV before the charge is stopped
+CONF_EV_CHARGER_FAULT_RESET_DELAY = 10 # minutes between two resets of a faulted charger
+# OCPP charge profiles: a push takes seconds, the charger applies whole amps.
+# Raises are sent at most every interval (seconds), drops right away. In
+# "schedule" mode the profile follows the expected surplus over the horizon
+# (minutes), one period per step, so that the charger follows it locally
+CONF_EV_CHARGER_PROFILE_INTERVAL = 60
+CONF_EV_CHARGER_PROFILE_MODE = "single"
+CONF_EV_CHARGER_SCHEDULE_STEP = 5
+CONF_EV_CHARGER_SCHEDULE_HORIZON = 60
 
 CONF_CRO_POWER = 2200
 CONF_CRO_PHASE = 1 << 2
 CONF_CRO_MIN_DELTA = 400
 
+# Surplus allocator: value of 1W of self-consumption per device, cost (W) of
+# starting or stopping a load so that it does not switch for a marginal gain
+CONF_WATER_HEATER_PRIORITY = 1.5
+CONF_EV_CHARGER_PRIORITY = 1.3
+CONF_CRO_PRIORITY = 1.0
+CONF_ALLOCATOR_SWITCH_COST = 300
+
 # Load balancer timings
 CONF_CRO_WAITING_TIME = 1
 CONF_EV_CHARGER_PRE_TIME = 1
 CONF_EV_CHARGER_WAITING_TIME = 3
 CONF_WATER_HEATER_WAITING_TIME = 1
-CONF_POOL_HEATER_WAITING_TIME = 2
\ No newline at end of file
+CONF_POOL_HEATER_WAITING_TIME = 2
+# Once the effect of a command is observed, let 1min averages settle (seconds)
+CONF_EFFECT_SETTLE_TIME = 30
+
+# Scheduler (seconds)
+CONF_SCHEDULER_EVENT_DRIVEN = True
+CONF_SCHEDULER_PERIOD = 15
+CONF_SCHEDULER_PERIOD_DEV = 5
+CONF_SCHEDULER_DEBOUNCE = 2
+CONF_SCHEDULER_HEARTBEAT = 60
+CONF_SCHEDULER_OVERRUN = 1 # seconds, runs taking longer are reported
+
+# Service calls executor
+CONF_EXECUTOR_CONCURRENCY = 2
+CONF_EXECUTOR_MAX_PENDING = 8
+CONF_EXECUTOR_TIMEOUT = 10
+CONF_EXECUTOR_RETRIES = 2
+CONF_EXECUTOR_BACKOFF = 1
+CONF_EXECUTOR_LATENCY_BUCKETS = [ 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+# High-rate power aggregator: raw net power samples (windows in seconds)
+CONF_AGGREGATOR_ENABLED = True
+CONF_AGGREGATOR_CAPACITY = 512 # samples kept per window, the oldest are dropped first
+CONF_AGGREGATOR_FAST_WINDOW = 60
+CONF_AGGREGATOR_SLOW_WINDOW = 300
+CONF_AGGREGATOR_EWMA_TAU = 20
+CONF_AGGREGATOR_HOLD = 5 # last sample is repeated when the sensor does not change
+CONF_AGGREGATOR_MAX_AGE = 30 # no new sample for longer => back to Enphase averages
+CONF_AGGREGATOR_BUCKET = 25 # W, resolution of the percentiles
+CONF_AGGREGATOR_RANGE = 20000 # W, percentiles are clamped to +-range
+
+# PV surplus forecast (minutes unless stated)
+CONF_FORECAST_ENABLED = True
+CONF_FORECAST_STEP = 60 # seconds between two history samples
+CONF_FORECAST_HISTORY = 90
+CONF_FORECAST_MIN_SAMPLES = 15
+CONF_FORECAST_FIT_TAU = 30 # weight of the older samples in the fit
+CONF_FORECAST_RESIDUAL_TAU = 10 # current deviation from the clear sky fit fades away
+CONF_FORECAST_HORIZON = 60
+CONF_FORECAST_START_HORIZON = 30 # loads are started or raised on a lasting surplus
+CONF_FORECAST_EV_HORIZON = 15
+
+# Overload shedding, on the raw net power and the Linky per phase currents
+CONF_OVERLOAD_ENABLED = True
+CONF_OVERLOAD_IMPORT = 8500 # W, below the subscribed power
+CONF_OVERLOAD_MARGIN = 500 # W, loads are shed down to threshold - margin
+CONF_OVERLOAD_HOLDOFF = 5 # seconds before shedding again on the same input
+CONF_OVERLOAD_HOLD = 5 # minutes before shed devices are decided again
+CONF_OVERLOAD_EVENTS = 20
+
+# Decision trace: last ticks kept in memory
+CONF_TRACE_SIZE = 200
+
+# Hot path metrics
+CONF_METRICS_WINDOW = 100 # ticks averaged by the diagnostic sensors
+CONF_METRICS_TICK_BUCKETS = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1 ]
+CONF_METRICS_DRIFT_BUCKETS = [ 0.01, 0.05, 0.1, 0.5, 1, 5 ]
+
+# Profiling switch: cProfile + tracemalloc over the next ticks
+CONF_PROFILING_TICKS = 20
+CONF_PROFILING_TOP = 40
+CONF_PROFILING_FRAMES = 10
+
+# Warm restart: controller state saved to the HA storage
+CONF_STATE_VERSION = 1
+CONF_STATE_SAVE_DELAY = 30 # seconds, changes are written at most once per delay
+CONF_STATE_MAX_AGE = 3600 # seconds, older states are ignored (cold start)
+CONF_STATE_SWITCHES = [
+    "ev_force", "ev_request", "ev_hc", "ev_tri",
+    "cro_force", "cro_request", "cro_hc",
+    "pool_force", "water_heater_force", "water_heater_boost",
+]
+
+# Startup: wait for the internal and required external entities
+CONF_READINESS_TIMEOUT = 120 # seconds, then start with what is there
+
+# Data freshness: max age (s) of the last update of an input. Inputs not
+# listed are only checked for availability (sensors reporting on change)
+CONF_STALENESS_BUDGETS = {
+    f"sensor.{CONF_ENHPASE_ID}_power_net_1min": 180,
+    f"sensor.{CONF_ENHPASE_ID}_power_net_5min": 600,
+}
+# Net power stale: "hold" keeps the solar loads as they are, "minimum" drops
+# them to their minimum (EV at min power, others stopped when allowed)
+CONF_STALE_MODE = "hold"
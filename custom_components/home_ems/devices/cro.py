@@ -1,6 +1,7 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from .device import Device
 from ..utils import *
+from ..allocator import Demand
 
 class CRO(Device):
 
@@ -15,50 +16,86 @@ class CRO(Device):
         self.delay_min_after_activation = 10
         # Wait at least 10min after deactivation before activating it
         self.delay_min_after_deactivation = 10
-        self.last_cro_power = 0.0
-        self.next_auto_activation = datetime.now()
+        self.tpl_power_id = f"sensor.{entity}_tpl_power"
+        self.tpl_power_dev_id = f"input_number.{entity}_tpl_power"
+        self.resend_status = None
 
     def logger_name(self):
         return "[cro]"
 
-    def late_init(self):
-        super().late_init()
-        if config_dev(self.hass):
+    def get_watched_entities(self):
+        return [ self.tpl_power_id, self.tpl_power_dev_id ]
+
+    def get_required_entities(self, config):
+        if config.dev:
+            return [ self.tpl_power_dev_id, f"input_boolean.{self.entity}" ]
+        return [ self.tpl_power_id, f"switch.{self.entity}" ]
+
+    def late_init(self, restored=None):
+        super().late_init(restored)
+        if self.config.dev:
             self.auto_activation_delta = timedelta(seconds=30)
         else:
             self.auto_activation_delta = timedelta(minutes=30)
 
+    def save_state(self):
+        return {
+            **super().save_state(),
+            "can_auto_request": self.can_auto_request,
+        }
+
+    def reconcile(self, saved):
+        domain = "switch" if not self.config.dev == True else "input_boolean"
+        state = self.read_state(f"{domain}.{self.entity}")
+        if state is None:
+            return False
+        # Active only if it is still switched on
+        return not saved["active"] or state.state == "on"
+
+    def restore_state(self, saved):
+        super().restore_state(saved)
+        self.can_auto_request = saved["can_auto_request"]
+
     #
     # CRO management
     #
 
     def cro_get_power(self):
-        ret = 0.0
-        try:
-            ret = float(self.get_state("sensor" if not config_dev(self.hass) else "input_number", "tpl_power"))
-        except ValueError:
-            ret = self.last_cro_power
-        self.last_cro_power = ret
-        return ret
+        return self.read_float(self.tpl_power_id if not self.config.dev else self.tpl_power_dev_id)
+
+    def get_consumed_power(self):
+        return self.cro_get_power()
 
     def cro_set_status(self, status):
-        domain = "switch" if not config_dev(self.hass) == True else "input_boolean"
+        self.resend_status = None
+        self.expect(
+            self.tpl_power_id if not self.config.dev else self.tpl_power_dev_id,
+            lambda state: (float(state.state) >= 10) == status
+        )
+        domain = "switch" if not self.config.dev == True else "input_boolean"
         call_async(
             self.hass,
             domain,
             f"turn_{'on' if status else 'off'}",
-            { "entity_id": f"{domain}.{self.entity}" }
+            { "entity_id": f"{domain}.{self.entity}" },
+            lambda success: self.on_status_result(status, success)
         )
 
-    def compute_max_available_power(self, power):
-        # Allow if HC is set in solar mode and hc in progress
-        if config_cro_hc(self.hass) and loadbalancer_instance(self.hass).linky.is_hc():
-            return CONF_CRO_POWER
-        # Allow if we are below the min delta
-        if power > CONF_CRO_MIN_DELTA:
-            return 0
-        # Disable
-        return CONF_CRO_POWER
+    def on_status_result(self, status, success):
+        if not success and status == self.active:
+            self.info(f"failed to turn {'on' if status else 'off'} => retry")
+            self.resend_status = status
+
+    def has_due_work(self):
+        return super().has_due_work() or self.resend_status is not None
+
+    def is_solar_managed(self):
+        # Started and stopped by the surplus allocator, otherwise by rules
+        if self.is_hc_hp or self.is_forced():
+            return False
+        if self.config.cro_hc and loadbalancer_instance(self.hass).linky.is_hc():
+            return False
+        return True
 
     #
     # Logic
@@ -72,7 +109,7 @@ class CRO(Device):
         super().deactivate()
         self.cro_set_status(False)
 #        if not self.is_hc_hp:
-#            self.next_auto_activation = datetime.now() + self.auto_activation_delta
+#            self.timers.start("auto_activation", self.auto_activation_delta.total_seconds())
         self.max_power = 0
 
     def still_needed(self, power):
@@ -87,65 +124,92 @@ class CRO(Device):
             if not loadbalancer_instance(self.hass).linky.is_hc():
                 self.info(f"HP => deactivate")
                 return False
-        elif config_cro_hc(self.hass):
+        elif self.config.cro_hc:
             if not loadbalancer_instance(self.hass).linky.is_hc() and power > 0:
                 self.info(f"HP => deactivate")
                 return False
-        return config_cro_requested(self.hass)
+        return self.config.cro_request
 
     def should_activate(self):
-#        if not self.is_hc_hp and datetime.now() > self.next_auto_activation:
+#        if not self.is_hc_hp and not self.timers.is_running("auto_activation"):
 #            config_cro_set_requested(self.hass, True)
-        return self.can_activate() and config_cro_requested(self.hass)
+        return self.can_activate() and self.config.cro_request
 
     def is_forced(self):
-        return config_cro_forced(self.hass)
+        return self.config.cro_force
 
     #
     # Interface with LoadBalancer
     #
 
-    def activate_if(self, power):
+    def activate_if(self, power, config):
+        # Last status command was not applied
+        if self.resend_status is not None:
+            self.cro_set_status(self.resend_status)
+            return CONF_CRO_WAITING_TIME
         if not self.should_activate():
             return 0
+        if self.phase_limit() < CONF_CRO_POWER:
+            self.debug(f"not enough current left on its phase ({self.phase_limit():.0f}W)")
+            return 0
         if self.is_forced():
             self.max_power = CONF_CRO_POWER
             self.activate()
             self.info(f"start charging (forced) @ {CONF_CRO_POWER}W")
             return CONF_CRO_WAITING_TIME
-        elif self.is_hc_hp or config_cro_hc(self.hass):
+        elif self.is_hc_hp or config.cro_hc:
             # If mode is HP/HC or requested to do HC, force it if HC
             if loadbalancer_instance(self.hass).linky.is_hc():
                 self.info("activate due to HC")
                 self.max_power = CONF_CRO_POWER
                 self.activate()
                 return CONF_CRO_WAITING_TIME
-        
-        # Solar management
-        if not self.is_hc_hp:
-            if power < 0 and abs(power) >= self.get_min_power():
-                self.max_power = CONF_CRO_POWER
-                self.activate()
-                self.info(f"start charging @ {self.max_power}W")
-                return CONF_CRO_WAITING_TIME
 
+        # Solar: see get_demand
         return 0
 
-    def update(self, power):
+    def update(self, power, config):
         if not self.still_needed(power) and self.can_deactivate():
             self.info(f"no longer needed, deactivate")
             self.deactivate()
             return CONF_CRO_WAITING_TIME
 
-        # Nothing to be done if HC/HP or is_forced        
-        if self.is_hc_hp or self.is_forced():
+        # Solar: see get_demand
+        return 0
+
+    def shed(self, excess):
+        if not self.active:
             return 0
+        power = max(self.cro_get_power(), CONF_CRO_POWER)
+        self.info("overload => stop")
+        self.deactivate()
+        return power
+
+    def get_demand(self, power):
+        if self.resend_status is not None or not self.is_solar_managed():
+            return None
+        if not self.active and not self.config.cro_request:
+            return None
+        # Kept running while importing less than CONF_CRO_MIN_DELTA
+        return Demand(
+            self,
+            CONF_CRO_PRIORITY,
+            CONF_CRO_POWER,
+            CONF_CRO_POWER,
+            current=CONF_CRO_POWER if self.active else 0,
+            can_start=self.can_activate(),
+            can_stop=self.can_deactivate(),
+            keep_power=CONF_CRO_POWER - CONF_CRO_MIN_DELTA
+        )
 
-        # Need to check if we have enough
-        new_power = self.compute_max_available_power(power)        
-        if new_power != CONF_CRO_POWER and self.can_deactivate():
+    def apply_allocation(self, power):
+        if power > 0 and not self.active:
+            self.max_power = CONF_CRO_POWER
+            self.activate()
+            self.info(f"start charging @ {self.max_power}W")
+            return CONF_CRO_WAITING_TIME
+        if power == 0 and self.active:
             self.info(f"disable due to missing solar power")
             self.deactivate()
             return CONF_CRO_WAITING_TIME
-
         return 0
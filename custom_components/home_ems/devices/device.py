@@ -1,5 +1,6 @@
 import logging
-from datetime import datetime, timedelta
+from .. import clock
+from ..timers import Timers
 from ..utils import *
 
 class Device:
@@ -11,30 +12,190 @@ class Device:
         self.min_power = 0
         self.phases = phases
         self.logger = logging.getLogger(__name__)
-        self.next_possible_activation = datetime.now()
-        self.next_possible_deactivation = datetime.now()
+        # Monotonic timers: "activation" and "deactivation" delays, plus
+        # device specific ones
+        self.timers = Timers()
         self.delay_min_after_activation = 0
         self.delay_min_after_deactivation = 0
         self.no_delay = False
-
-    def late_init(self):
-        self.is_hc_hp = config_loadbalancer_mode_is_hc_hp(self.hass)
+        self.config = None
+        # Per tick read-through cache of the state machine
+        self.states = {}
+        self.values = {}
+        self.last_values = {}
+        # Observable effects of the last command (entity_id -> check(state))
+        self.effects = {}
+        # What the device logged during the current tick (decision trace)
+        self.notes = []
+        self.warm = False
+
+    def late_init(self, restored=None):
+        self.is_hc_hp = self.config.is_hc_hp()
+        # Warm restart: saved state still consistent with the live entities
+        self.warm = restored is not None and self.reconcile(restored)
+        if self.warm:
+            self.restore_state(restored)
+            self.info(f"state restored (active={self.active})")
+        elif restored is not None:
+            self.info("saved state does not match the live states => cold start")
+
+    def start_tick(self, config):
+        # Configuration snapshot of the current tick, sensors are read again
+        self.config = config
+        self.states = {}
+        self.values = {}
+        self.notes = []
 
     def logger_name(self):
         return "[device]"
 
+    def short_name(self):
+        return self.logger_name().strip("[]")
+
     def debug(self, info):
         self.logger.debug(self.logger_name() + " " + info)
 
     def info(self, info):
         self.logger.info(self.logger_name() + " " + info)
+        self.notes.append(info)
+
+    def read_state(self, entity_id):
+        if entity_id not in self.states:
+            self.states[entity_id] = get_state(self.hass, entity_id)
+        return self.states[entity_id]
+
+    def read_float(self, entity_id, default=0.0):
+        # Parsed once per tick, falls back to the last valid value
+        if entity_id in self.values:
+            return self.values[entity_id]
+        try:
+            value = float(self.read_state(entity_id).state)
+        except (AttributeError, ValueError):
+            # Missing or unavailable: see get_stale_inputs
+            value = self.last_values.get(entity_id, default)
+        self.last_values[entity_id] = value
+        self.values[entity_id] = value
+        return value
+
+    def input_age(self, entity_id):
+        # Seconds since the sensor last reported, None if missing or if Home
+        # Assistant does not tell (no last_reported before 2024.4:
+        # last_updated does not move while the value stays the same)
+        state = self.read_state(entity_id)
+        reported = getattr(state, "last_reported", None)
+        if reported is None:
+            return None
+        return clock.now().timestamp() - reported.timestamp()
+
+    def is_stale(self, entity_id):
+        state = self.read_state(entity_id)
+        if state is None or state.state in ("unavailable", "unknown"):
+            return True
+        budget = CONF_STALENESS_BUDGETS.get(entity_id)
+        if budget is None:
+            return False
+        age = self.input_age(entity_id)
+        return age is not None and age > budget
+
+    def get_stale_inputs(self):
+        # Required inputs that are missing, unavailable or too old
+        return [ entity_id for entity_id in self.get_required_entities(self.config) if self.is_stale(entity_id) ]
 
     def get_state(self, domain, field):
-        return self.hass.states.get(f"{domain}.{self.entity}_{field}").state
+        return self.read_state(f"{domain}.{self.entity}_{field}").state
+
+    def expect(self, entity_id, check):
+        # The load balancer waits for the effect instead of the full waiting time
+        self.effects[entity_id] = check
+
+    def clear_effects(self):
+        self.effects = {}
+
+    def effects_observed(self):
+        if len(self.effects) == 0:
+            # Nothing observable: full waiting time
+            return False
+        for entity_id, check in self.effects.items():
+            state = self.read_state(entity_id)
+            if state is None:
+                return False
+            try:
+                if not check(state):
+                    return False
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    def get_watched_entities(self):
+        # Entities whose changes should trigger a new load balancer run
+        return []
+
+    def get_required_entities(self, config):
+        # Entities that must exist before the first decision
+        return []
+
+    def next_deadline(self):
+        # Next time a device timer expires (None if nothing pending)
+        return self.timers.next_deadline()
+
+    def has_due_work(self):
+        # Inactive devices waiting for their activation delay have nothing
+        # to decide, except in dev mode where can_activate skips the delay
+        if self.active or self.is_forced() or self.config.dev:
+            return True
+        return not self.timers.is_running("activation")
 
     def get_phases(self):
         return self.phases
 
+    def get_consumed_power(self):
+        # Measured by devices that can
+        return self.max_power if self.active else 0
+
+    def phase_limit(self):
+        # Max power the device can take within the per phase current limit
+        return loadbalancer_instance(self.hass).ledger.limit(self)
+
+    def shed(self, excess):
+        # Overload: returns the power shed (W)
+        return 0
+
+    def get_demand(self, power):
+        # Surplus the device can take from the allocator (None: not surplus driven)
+        return None
+
+    def apply_allocation(self, power):
+        # Returns the minutes to wait for the effect (0: nothing done)
+        return 0
+
+    def expected_power(self, power, horizon):
+        # Net power expected over the next horizon minutes
+        forecaster = loadbalancer_instance(self.hass).forecaster
+        if forecaster is None:
+            return power
+        return forecaster.expected_power(power, horizon)
+
+    #
+    # Warm restart
+    #
+
+    def save_state(self):
+        # Compact controller state, saved when it changes
+        return {
+            "active": self.active,
+            "max_power": self.max_power,
+            "timers": self.timers.save(),
+        }
+
+    def reconcile(self, saved):
+        # False when the saved state contradicts the live entities
+        return True
+
+    def restore_state(self, saved):
+        self.active = saved["active"]
+        self.max_power = saved["max_power"]
+        self.timers.restore(saved["timers"])
+
     def get_max_power(self):
         return self.max_power
             
@@ -44,17 +205,17 @@ class Device:
     def activate(self):
         self.active = True
         self.info("activate")
-        self.next_possible_deactivation = datetime.now() + timedelta(minutes=self.delay_min_after_activation)
+        self.timers.start("deactivation", self.delay_min_after_activation * 60)
 
     def deactivate(self):
         self.active = False
         self.info("deactivate")
         if self.no_delay:
-            self.next_possible_activation = datetime.now()
-            self.next_possible_deactivation = datetime.now()
+            self.timers.cancel("activation")
+            self.timers.cancel("deactivation")
             self.no_delay = False
         else:
-            self.next_possible_activation = datetime.now() + timedelta(minutes=self.delay_min_after_deactivation)
+            self.timers.start("activation", self.delay_min_after_deactivation * 60)
 
     def should_activate(self):
         pass
@@ -63,11 +224,11 @@ class Device:
         if self.active:
             # Already active
             return False
-        if not self.is_forced() and datetime.now() < self.next_possible_activation:
+        if not self.is_forced() and self.timers.is_running("activation"):
             # Not allowed - need to wait a minimum amount of time before reactivation
-            if config_dev(self.hass):
+            if self.config.dev:
                 self.debug("to early to activate")
-                self.next_possible_activation = datetime.now()
+                self.timers.cancel("activation")
             return False
         return True
 
@@ -75,11 +236,11 @@ class Device:
         if not self.active:
             # Already inactive
             return False
-        if datetime.now() < self.next_possible_deactivation:
+        if self.timers.is_running("deactivation"):
             # Not allowed - need to wait a minimum amount of time before deactivation
-            if config_dev(self.hass):
+            if self.config.dev:
                 self.debug("to early to deactivate")
-                self.next_possible_deactivation = datetime.now()
+                self.timers.cancel("deactivation")
             return False
         return True
 
@@ -5,26 +5,45 @@ class Enphase(PowerInfo):
 
     def __init__(self, hass, entity):
         super().__init__(hass, entity)
-        self.last_power = 0.0
-        self.last_power_5min = 0.0
+        self.power_net_id = f"sensor.{entity}_power_net"
+        self.power_net_1min_id = f"sensor.{entity}_power_net_1min"
+        self.power_net_5min_id = f"sensor.{entity}_power_net_5min"
 
     def logger_name(self):
         return "[enphase]"
 
+    def get_watched_entities(self):
+        return [ self.power_net_1min_id, self.power_net_5min_id ]
+
+    def get_required_entities(self, config):
+        return [ self.power_net_1min_id, self.power_net_5min_id ]
+
+    def get_stale_inputs(self):
+        # Averages are not used (nor read) while the raw samples cover their window
+        aggregator = power_aggregator(self.hass)
+        covered = set()
+        if aggregator is not None and aggregator.is_ready(CONF_AGGREGATOR_FAST_WINDOW):
+            covered.add(self.power_net_1min_id)
+        if aggregator is not None and aggregator.is_ready(CONF_AGGREGATOR_SLOW_WINDOW):
+            covered.add(self.power_net_5min_id)
+        return [ entity_id for entity_id in self.get_required_entities(self.config) if entity_id not in covered and self.is_stale(entity_id) ]
+
+    def start_tick(self, config):
+        super().start_tick(config)
+        aggregator = power_aggregator(self.hass)
+        if aggregator is not None:
+            aggregator.refresh()
+
     def get_power(self):
-        ret = 0.0
-        try:
-            ret = float(self.get_state('sensor', 'power_net_1min'))
-        except ValueError:
-            ret = self.last_power
-        self.last_power = ret
-        return ret
+        # Raw samples when available: fresher than the 1min average
+        aggregator = power_aggregator(self.hass)
+        if aggregator is not None and aggregator.is_ready(CONF_AGGREGATOR_FAST_WINDOW):
+            return round(aggregator.get_ewma())
+        return self.read_float(self.power_net_1min_id)
 
     def get_power_5min(self):
-        ret = 0.0
-        try:
-            ret = float(self.get_state('sensor', 'power_net_5min'))
-        except ValueError:
-            ret = self.last_power_5min
-        self.last_power_5min = ret
-        return ret
+        # Median over 5min: short import spikes are ignored
+        aggregator = power_aggregator(self.hass)
+        if aggregator is not None and aggregator.is_ready(CONF_AGGREGATOR_SLOW_WINDOW):
+            return aggregator.percentile(CONF_AGGREGATOR_SLOW_WINDOW, 50)
+        return self.read_float(self.power_net_5min_id)
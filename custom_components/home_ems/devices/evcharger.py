@@ -1,6 +1,25 @@
-from datetime import datetime, timedelta
+from dataclasses import replace
+from datetime import timezone
+from .. import clock
+from ..clock import monotonic
 from .device import Device
 from ..utils import *
+from ..allocator import Demand
+
+# Connector state machine, driven by the OCPP status: (from, to) -> entry
+# actions, None matches any state. Starting the charge is left to the load
+# balancer, right after the actions
+CONNECTOR_TRANSITIONS = {
+    (None, "Available"): ("unplugged", "cancel_full_timer"),
+    ("Available", "Preparing"): ("plugged", "auto_request"),
+    ("Available", "SuspendedEVSE"): ("plugged", "auto_request"),
+    (None, "Preparing"): ("auto_request", "start_transaction", "cancel_full_timer"),
+    (None, "SuspendedEVSE"): ("auto_request", "cancel_full_timer"),
+    (None, "Charging"): ("cancel_full_timer",),
+    (None, "Finishing"): ("cancel_full_timer",),
+    (None, "SuspendedEV"): ("full_timer",),
+    (None, "Faulted"): ("fault_reset", "cancel_full_timer"),
+}
 
 class EVCharger(Device):
 
@@ -15,21 +34,78 @@ class EVCharger(Device):
         self.delay_min_after_activation = 10
         # Wait at least 10min after deactivation before activating it
         self.delay_min_after_deactivation = 10
-        self.last_connector_status = ""
+        # Connector state machine state (last OCPP status)
+        self.connector = None
         self.activate_first = False
-        self.suspend_ev_stop_timer = None
         self.tri_detected = None
-        self.last_power_active_import = 0.0
-        self.last_power_active_offered = 0.0
+        self.status_connector_id = f"sensor.{entity}_status_connector"
+        self.power_imported_id = f"sensor.{entity}_power_active_import"
+        self.power_offered_id = f"sensor.{entity}_power_offered"
+        self.requested = False
+        self.resend_max_power = False
+        # Raise held back by the profile rate limit (W)
+        self.deferred = None
+        self.sent_limit = None
+        # Profile in force on the charger: monotonic start, [(seconds, limit)]
+        self.profile = None
+        self.profile_mode = CONF_EV_CHARGER_PROFILE_MODE
+        self.profiles = { "sent": 0, "suppressed": 0, "deferred": 0 }
 
     def logger_name(self):
         return "[evcharger]"
 
-    def late_init(self):
-        super().late_init()
+    def late_init(self, restored=None):
+        super().late_init(restored)
+        if self.warm:
+            # Resume the session: only resend the power if the charger lost it
+            if self.active and not self.activate_first and abs(self.power_offered() * CONF_EV_CHARGER_POWER_OFFERED_SCALE - self.max_power) > CONF_EV_CHARGER_MIN_DELTA:
+                self.resend_max_power = True
+            return
         self.stop_transaction()
         self.update_max_power()
-        config_evcharger_set_tri(self.hass, False)
+        self.set_tri(False)
+
+    def save_state(self):
+        return {
+            **super().save_state(),
+            "activate_first": self.activate_first,
+            "tri_detected": self.tri_detected,
+            "can_auto_request": self.can_auto_request,
+        }
+
+    def reconcile(self, saved):
+        state = self.read_state(self.status_connector_id)
+        if state is None or state.state in ("unknown", "unavailable"):
+            return False
+        if saved["active"]:
+            # The car was unplugged meanwhile
+            return state.state != "Available"
+        # A charge this controller did not start is stopped (cold start)
+        return state.state != "Charging"
+
+    def restore_state(self, saved):
+        super().restore_state(saved)
+        self.activate_first = saved["activate_first"]
+        self.tri_detected = saved["tri_detected"]
+        self.can_auto_request = saved["can_auto_request"]
+
+    def start_tick(self, config):
+        super().start_tick(config)
+        # Local view of the request switch, updated when we change it
+        self.requested = config.ev_request
+        if self.active and self.profile is not None and len(self.profile[1]) > 1:
+            # The charger follows the schedule on its own
+            self.max_power = round(self.profile_limit() / self.limit_scale())
+
+    def set_requested(self, value):
+        config_evcharger_set_requested(self.hass, value)
+        self.requested = value
+
+    def set_tri(self, value):
+        config_evcharger_set_tri(self.hass, value)
+        # Keep the snapshot of the current tick in line with the switch
+        if self.config is not None and self.config.ev_tri != value:
+            self.config = replace(self.config, ev_tri=value)
 
     def get_min_power(self):
         if self.is_tri():
@@ -37,6 +113,12 @@ class EVCharger(Device):
         else:
             return CONF_EV_CHARGER_MIN_POWER_MONO
 
+    def get_watched_entities(self):
+        return [ self.status_connector_id, self.power_offered_id ]
+
+    def get_required_entities(self, config):
+        return [ self.status_connector_id, self.power_offered_id, self.power_imported_id ]
+
     def is_tri(self):
         return self.tri_detected != None and self.tri_detected
 
@@ -45,34 +127,83 @@ class EVCharger(Device):
     #
 
     def connector_status(self):
-        return self.hass.states.get(f"sensor.{self.entity}_status_connector").state
+        return self.connector
 
     def cable_plugged(self):
-        return self.connector_status() != "Available"
+        return self.connector != "Available"
+
+    #
+    # Connector state machine
+    #
+
+    def sync_connector(self):
+        # Catch up on a missed event (startup, restart)
+        state = self.read_state(self.status_connector_id)
+        if state is not None and state.state not in ("unknown", "unavailable"):
+            self.set_connector(state.state)
+
+    def set_connector(self, status):
+        if status == self.connector:
+            return False
+        actions = CONNECTOR_TRANSITIONS.get((self.connector, status), CONNECTOR_TRANSITIONS.get((None, status), ()))
+        self.debug(f"connector {self.connector} => {status} {list(actions)}")
+        self.connector = status
+        for action in actions:
+            getattr(self, f"enter_{action}")()
+        return True
+
+    def enter_plugged(self):
+        self.info("cable connected")
+
+    def enter_unplugged(self):
+        self.info("cable disconnected")
+        self.can_auto_request = True
+        if self.requested:
+            self.set_requested(False)
+
+    def enter_auto_request(self):
+        # This is needed to avoid the need of clicking the button
+        if not self.requested and self.can_auto_request:
+            self.info("cable connected, automatically request charge")
+            self.set_requested(True)
+
+    def enter_start_transaction(self):
+        # Back to Preparing during a charge: the transaction was closed
+        if self.active:
+            self.start_transaction()
+
+    def enter_full_timer(self):
+        # Only a charge of ours can be full
+        if self.active and not self.timers.is_started("suspend_ev_stop"):
+            self.info("car stopped the charge, most likely full")
+            self.timers.start("suspend_ev_stop", CONF_EV_CHARGER_FULL_DELAY * 60)
+
+    def enter_cancel_full_timer(self):
+        self.timers.cancel("suspend_ev_stop")
+
+    def enter_fault_reset(self):
+        if self.timers.is_running("fault_reset"):
+            self.info(f"fault, charger reset less than {CONF_EV_CHARGER_FAULT_RESET_DELAY}min ago")
+            return
+        self.info("fault => reset the charger")
+        self.timers.start("fault_reset", CONF_EV_CHARGER_FAULT_RESET_DELAY * 60)
+        if not self.config.dev:
+            call_async(self.hass, "button", "press", { "entity_id": f"button.{self.entity}_reset" })
 
     def power_imported(self):
-        ret = 0.0
-        try:
-            ret = float(self.get_state("sensor", "power_active_import"))
-        except ValueError:
-            ret = self.last_power_active_import
-        self.last_power_active_import = ret
-        return ret
+        return self.read_float(self.power_imported_id)
 
     def power_offered(self):
-        ret = 0.0
-        try:
-            ret = float(self.get_state("sensor", "power_offered"))
-        except ValueError:
-            ret = self.last_power_active_offered
-        self.last_power_active_offered = ret
-        return ret        
+        return self.read_float(self.power_offered_id)
+
+    def get_consumed_power(self):
+        return self.power_imported() * CONF_EV_CHARGER_POWER_OFFERED_SCALE
 
     def start_transaction(self):
         if self.connector_status() != "Preparing" and self.connector_status() != "Finishing":
             self.info(f"no need to start transation in state {self.connector_status()}")
             return
-        domain = "switch" if not config_dev(self.hass) == True else "input_boolean"
+        domain = "switch" if not self.config.dev == True else "input_boolean"
         call_async(
             self.hass,
             domain,
@@ -81,7 +212,7 @@ class EVCharger(Device):
         )
 
     def stop_transaction(self):
-        domain = "switch" if not config_dev(self.hass) == True else "input_boolean"
+        domain = "switch" if not self.config.dev == True else "input_boolean"
         call_async(
             self.hass,
             domain,
@@ -89,12 +220,74 @@ class EVCharger(Device):
             { "entity_id": f"{domain}.{self.entity}_charge_control" }
         )
 
-    def update_max_power(self):
-        limit = self.max_power
-        if not self.is_tri():
-            limit *= 3
-        self.info(f"update_max_power {limit}W")
-        if not config_dev(self.hass):
+    def limit_scale(self):
+        # Mono limit is sent x3, in both cases the charger offers max_power
+        return 1 if self.is_tri() else 3
+
+    def limit_amps(self, limit):
+        # Current per phase the charger applies for a profile limit
+        return int(limit / (CONF_PHASE_VOLTAGE * 3))
+
+    def profile_limit(self):
+        start, periods = self.profile
+        elapsed = monotonic() - start
+        return [ limit for seconds, limit in periods if seconds <= elapsed ][-1]
+
+    def build_schedule(self, limit):
+        # Allocated power now, then the expected surplus change: never above
+        # the per phase limit, never below min power (the allocator suspends)
+        forecaster = loadbalancer_instance(self.hass).forecaster
+        if self.profile_mode != "schedule" or self.config.dev or limit == 0 or forecaster is None or not forecaster.is_ready() or not self.is_solar_managed():
+            return [ (0, limit) ]
+        step = CONF_EV_CHARGER_SCHEDULE_STEP
+        per_amp = CONF_PHASE_VOLTAGE * 3
+        top = min(CONF_MAX_POWER_PER_PHASE, self.phase_limit())
+        periods = [ (0, limit) ]
+        for minute in range(step, CONF_EV_CHARGER_SCHEDULE_HORIZON, step):
+            power = limit / self.limit_scale() + forecaster.surplus_change(minute, minute + step)
+            power = max(min(power, top), self.get_min_power())
+            scheduled = int(power * self.limit_scale() // per_amp) * per_amp
+            if self.limit_amps(scheduled) != self.limit_amps(periods[-1][1]):
+                periods.append((minute * 60, scheduled))
+        return periods
+
+    def update_max_power(self, power=None, force=False):
+        # Returns True if a profile was sent. max_power is the power of the
+        # profile in force, a deferred raise does not change it
+        if power is None:
+            power = self.max_power
+        limit = power * self.limit_scale()
+        if self.profile is not None and not force:
+            in_force = self.limit_amps(self.profile_limit())
+            amps = self.limit_amps(limit)
+            if amps == in_force:
+                # Same current on the charger side
+                self.max_power = power
+                self.resend_max_power = False
+                self.deferred = None
+                self.profiles["suppressed"] += 1
+                return False
+            if amps > in_force and self.timers.is_running("profile"):
+                # Raises wait for the end of the interval (a timer deadline,
+                # the scheduler runs again then), drops do not
+                if self.deferred is None:
+                    self.debug(f"raise to {power}W deferred")
+                    self.profiles["deferred"] += 1
+                self.deferred = power
+                return False
+        self.max_power = power
+        self.resend_max_power = False
+        self.deferred = None
+        periods = self.build_schedule(limit)
+        self.profile = (monotonic(), periods)
+        # A schedule is left to run for at least one period
+        self.timers.start("profile", CONF_EV_CHARGER_PROFILE_INTERVAL if len(periods) == 1 else CONF_EV_CHARGER_SCHEDULE_STEP * 60)
+        self.profiles["sent"] += 1
+        self.sent_limit = limit
+        offered = self.max_power
+        self.expect(self.power_offered_id, lambda state: abs(float(state.state) * CONF_EV_CHARGER_POWER_OFFERED_SCALE - offered) <= CONF_EV_CHARGER_MIN_DELTA)
+        self.info(f"update_max_power {limit}W" + (f" ({len(periods)} periods)" if len(periods) > 1 else ""))
+        if not self.config.dev:
             # Prepare the data for the OCPP set_charge_rate service
             charging_profile = {
                 "chargingProfileId": 8,
@@ -105,19 +298,25 @@ class EVCharger(Device):
                     "chargingRateUnit": "W",
                     "chargingSchedulePeriod": [
                         {
-                            "startPeriod": 0,
-                            "limit": limit
+                            "startPeriod": seconds,
+                            "limit": period_limit
                         }
+                        for seconds, period_limit in periods
                     ]
                 }
             }
+            if len(periods) > 1:
+                # Periods start from now, not from the start of the session
+                charging_profile["chargingProfileKind"] = "Absolute"
+                charging_profile["chargingSchedule"]["startSchedule"] = clock.now().astimezone(timezone.utc).isoformat()
             # Log the data being sent
             self.debug(f"sending set_charge_rate with data: {charging_profile}")
             # Call the OCPP set_charge_rate service
             call_async(self.hass, "ocpp", "set_charge_rate",
                 {
                     "custom_profile": charging_profile
-                }
+                },
+                lambda success: self.on_max_power_result(limit, success)
             )
         else:
             call_async(
@@ -127,81 +326,60 @@ class EVCharger(Device):
                 {
                     "entity_id": f"input_number.{self.entity}_maximum_power",
                     "value": limit,
-                }
+                },
+                lambda success: self.on_max_power_result(limit, success)
             )
-
-    def set_max_power(self, max_power):
+        return True
+
+    def profile_stats(self):
+        return {
+            **self.profiles,
+            "periods": len(self.profile[1]) if self.profile is not None else 0,
+        }
+
+    def on_max_power_result(self, limit, success):
+        if not success and limit == self.sent_limit:
+            self.info(f"update_max_power {limit}W failed => resend")
+            self.profile = None
+            self.timers.cancel("profile")
+            self.resend_max_power = True
+
+    def set_max_power(self, max_power, force=False):
+        # Returns True if a profile was sent
         if max_power == 0:
             self.info(f"max below min power => suspend")
-        if self.max_power != max_power:
-            self.max_power = max_power
-            self.update_max_power()
-        else:
-            self.max_power = max_power
-
-    def compute_max_available_power(self, power_max, power):
-
-        # if is_forced
-        if self.is_forced():
-            return CONF_MAX_POWER_PER_PHASE
-
-        # HP/HC: disable if HP
-        if self.is_hc_hp:
-            if loadbalancer_instance(self.hass).linky.is_hc():
-                return CONF_MAX_POWER_PER_PHASE
-            else:
-                return 0
-
-        # Force HC in solar mode
-        if config_evcharger_hc(self.hass) and loadbalancer_instance(self.hass).linky.is_hc():
-            return CONF_MAX_POWER_PER_PHASE
+        if self.max_power != max_power or self.deferred is not None:
+            return self.update_max_power(max_power, force)
+        return False
 
-        #
-        # Check power import / export and max
-        #
-
-        new_power = power_max - power
-
-        #
-        # Here we check for update which means we need to include current power
-        # and check if we import energy from grids
-        #
-        if power > 0:
-            # So we import from grid, let's reduce current offered power
-            if self.get_max_power() != 0:
-                self.debug(f"importing {power}W -> may need to reduce offered power")
-
-        if new_power < self.get_min_power():
-            if self.get_max_power() != 0:
-                # Need to check the 5min power to not stop the charge due to a short
-                # import. If this is the case let's reduce to min power
-                power_5min = loadbalancer_instance(self.hass).enphase.get_power_5min()
-                if power_max - power_5min < (self.get_min_power() / 2):
-                    self.info(f"new power based on 5min stat is too low (avail:{power_max - power_5min} min/2:{self.get_min_power() / 2}) => suspend charge")
-                    new_power = 0
-                else:
-                    new_power = self.get_min_power()
-            else:
-                new_power = 0
-            return min(new_power, CONF_MAX_POWER_PER_PHASE)
-
-        # We do not want to update if delta is too small to avoid
-        # bouncing
-        delta = abs(power_max - new_power)
-        if delta <= CONF_EV_CHARGER_MIN_DELTA:
-            if power_max > 0:
-                self.debug(f"delta({delta}W) current({power_max}W) avail({power}W) is too small => do not react")
-            return power_max
+    def is_solar_managed(self):
+        # Modulated by the surplus allocator, otherwise by rules
+        if self.is_forced() or self.is_hc_hp:
+            return False
+        if self.config.ev_hc and loadbalancer_instance(self.hass).linky.is_hc():
+            return False
+        return True
 
+    def compute_max_available_power(self):
+        # Forced, HP/HC mode or HC requested in solar mode
+        if self.is_hc_hp and not self.is_forced() and not loadbalancer_instance(self.hass).linky.is_hc():
+            return 0
+        return self.limit_power(CONF_MAX_POWER_PER_PHASE)
 
-        return min(new_power, CONF_MAX_POWER_PER_PHASE)
+    def limit_power(self, power):
+        # Per phase current limit, the charge is suspended below min power
+        limit = self.phase_limit()
+        if power > limit:
+            self.debug(f"{power}W limited to {limit:.0f}W by the per phase current")
+            power = round(limit) if limit >= self.get_min_power() else 0
+        return power
 
     #
     # Logic
     #
 
     def get_phases(self):
-        if config_evcharger_is_tri(self.hass):
+        if self.config.ev_tri:
             self.phases = 7
         else:
             self.phases = CONF_EV_CHARGER_PHASE_MONO
@@ -213,84 +391,78 @@ class EVCharger(Device):
         self.activate_first = True
         self.tri_detected = None
         self.start_transaction()
+        if self.connector == "SuspendedEV":
+            self.enter_full_timer()
 
     def deactivate(self):
         super().deactivate()
         config_evcharger_set_forced(self.hass, False)
-        config_evcharger_set_tri(self.hass, False)
+        self.set_tri(False)
         config_evcharger_set_hc(self.hass, False)
-        config_evcharger_set_requested(self.hass, False)
+        self.set_requested(False)
         self.stop_transaction()
-        self.max_power = 0
-        self.update_max_power()
+        self.update_max_power(0)
         self.activate_first = False
-        self.suspend_ev_stop_timer = None
+        self.timers.cancel("suspend_ev_stop")
         self.tri_detected = None
 
     def still_needed(self):
-        status = self.connector_status()
-        if status != self.last_connector_status:
-            self.last_connector_status = status
-        if status == "SuspendedEV":
-            if self.suspend_ev_stop_timer == None:
-                self.info("car stopped the charge, most likely full")
-                self.suspend_ev_stop_timer = datetime.now() + timedelta(minutes=30)
-            elif datetime.now() >= self.suspend_ev_stop_timer:
-                self.info("car stopped the charge 30min ago, most likely full (deactivate)")
-                self.no_delay = True
-                return False
-        else:
-            self.suspend_ev_stop_timer = None
-        if status == "Faulted":
-            self.info("fault, need to reset")
+        if self.timers.expired("suspend_ev_stop"):
+            self.info(f"car stopped the charge {CONF_EV_CHARGER_FULL_DELAY}min ago, most likely full (deactivate)")
+            self.no_delay = True
+            return False
+        if self.connector == "Faulted":
+            # Reset on entering the state
             return True
         if not self.cable_plugged():
-            self.info("cable disconnected")
-            self.can_auto_request = True
             self.no_delay = True
             return False
         if self.is_forced():
             return True
-        return config_evcharger_requested(self.hass)
+        return self.requested
 
     def should_activate(self):
-        return self.can_activate() and config_evcharger_requested(self.hass) and self.cable_plugged()
+        return self.can_activate() and self.requested and self.cable_plugged()
 
     def is_forced(self):
-        return config_evcharger_forced(self.hass) and self.cable_plugged()
+        return self.config.ev_force and self.cable_plugged()
 
     #
     # Interface with LoadBalancer
     #
 
-    def activate_if(self, power):
-        # First, check if cable is unplugged, means we can auto request next one
-        if not self.cable_plugged() and not self.can_auto_request:
-            self.can_auto_request = True
-        if not self.cable_plugged() and config_evcharger_requested(self.hass):
-            config_evcharger_set_requested(self.hass, False)
-        # First, check if we need to force the request
-        # This is needed to avoid the need of clicking the button
-        if self.cable_plugged() and not config_evcharger_requested(self.hass) and (self.connector_status() == "Preparing" or self.connector_status() == "SuspendedEVSE") and self.can_auto_request:
-            self.info("cable connected, automatically request charge")
-            config_evcharger_set_requested(self.hass, True)
+    def activate_if(self, power, config):
+        # Requests follow the connector state machine
         if not self.should_activate():
             return 0
-        self.set_max_power(CONF_MAX_POWER_PER_PHASE)
+        # A new session is not rate limited
+        self.set_max_power(self.limit_power(CONF_MAX_POWER_PER_PHASE), force=True)
         self.activate()
         self.info(f"start charging")
         return CONF_EV_CHARGER_PRE_TIME
 
-    def update(self, power):
+    def update(self, power, config):
         if not self.still_needed() and self.can_deactivate():
             self.info(f"no longer needed, deactivate")
             self.deactivate()
             return CONF_EV_CHARGER_WAITING_TIME
 
+        # Last charge profile was not applied
+        if self.resend_max_power:
+            self.update_max_power()
+            return CONF_EV_CHARGER_WAITING_TIME
+
+        # Raise held back by the profile rate limit
+        if self.deferred is not None and not self.timers.is_running("profile"):
+            if self.update_max_power(self.deferred):
+                return CONF_EV_CHARGER_WAITING_TIME
+
         # Ensure power was sent
         if self.activate_first and self.get_max_power() != 0:
             self.info(f"charger is in {self.connector_status()} state after activation => set power")
-            self.update_max_power()
+            # Not suppressed: the charger may have dropped the profile
+            # sent before the transaction started
+            self.update_max_power(force=abs(self.power_offered() * CONF_EV_CHARGER_POWER_OFFERED_SCALE - self.max_power) > CONF_EV_CHARGER_MIN_DELTA)
             self.activate_first = False
             return CONF_EV_CHARGER_WAITING_TIME
 
@@ -301,16 +473,71 @@ class EVCharger(Device):
                 self.info("car is detected to use MONO")
             else:
                 self.tri_detected = True
-                config_evcharger_set_tri(self.hass, True)
+                self.set_tri(True)
                 self.info("car is detected to use TRI")
-                new_power = self.compute_max_available_power(self.get_max_power(), power)
-                self.set_max_power(new_power)
-                self.update_max_power()
+                power = self.compute_max_available_power() if not self.is_solar_managed() else self.max_power
+                # The limit is no longer sent x3
+                self.update_max_power(power, force=True)
                 return CONF_EV_CHARGER_WAITING_TIME
 
-        # Need to check if we have enough
-        new_power = self.compute_max_available_power(self.get_max_power(), power)
-        if new_power != self.get_max_power():
-            self.set_max_power(new_power)
+        # Solar: see get_demand
+        if self.is_solar_managed():
+            return 0
+        new_power = self.compute_max_available_power()
+        if new_power != self.get_max_power() and self.set_max_power(new_power):
             return CONF_EV_CHARGER_WAITING_TIME
         return 0
+
+    def shed(self, excess):
+        # Reduce the charge, suspend it below min power
+        power_max = self.get_max_power()
+        if not self.active or power_max == 0:
+            return 0
+        new_power = power_max - excess
+        if new_power < self.get_min_power():
+            new_power = 0
+        self.info(f"overload => {new_power:.0f}W")
+        in_force = self.limit_amps(self.profile_limit()) if self.profile is not None else None
+        if not self.set_max_power(round(new_power)):
+            # Same current per phase as the profile in force: nothing shed
+            return 0
+        # The power to apply after activation is the one just sent
+        self.activate_first = False
+        if in_force is None:
+            return power_max - new_power
+        # The charger applies whole amps
+        return max(in_force - self.limit_amps(self.profile_limit()), 0) * CONF_PHASE_VOLTAGE * 3 / self.limit_scale()
+
+    def get_demand(self, power):
+        if not self.active or self.activate_first or self.resend_max_power or not self.is_solar_managed():
+            return None
+        keep_power = self.get_min_power()
+        if self.get_max_power() != 0:
+            # A short import (5min stat) or a dip the forecast expects to
+            # recover from does not suspend the charge: stay at min power
+            power_max = self.get_max_power()
+            power_5min = loadbalancer_instance(self.hass).enphase.get_power_5min()
+            power_expected = self.expected_power(power_5min, CONF_FORECAST_EV_HORIZON)
+            if power_max - power_5min >= (self.get_min_power() / 2) or power_max - power_expected >= (self.get_min_power() / 2):
+                keep_power = 0
+        return Demand(
+            self,
+            CONF_EV_CHARGER_PRIORITY,
+            self.get_min_power(),
+            CONF_MAX_POWER_PER_PHASE,
+            current=self.get_max_power(),
+            keep_power=keep_power,
+            continuous=True
+        )
+
+    def apply_allocation(self, power):
+        power_max = self.get_max_power()
+        # We do not want to update if delta is too small to avoid bouncing
+        if power == power_max or (power != 0 and power_max != 0 and abs(power - power_max) <= CONF_EV_CHARGER_MIN_DELTA):
+            # A raise held back is no longer wanted
+            self.deferred = None
+            return 0
+        # Nothing to wait for if no profile was sent
+        if not self.set_max_power(round(power)):
+            return 0
+        return CONF_EV_CHARGER_WAITING_TIME
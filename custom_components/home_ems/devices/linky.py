@@ -4,16 +4,29 @@ class Linky(PowerInfo):
 
     def __init__(self, hass, entity):
         super().__init__(hass, entity)
-        self.last_ntarf = 2
+        self.ntarf_id = f"sensor.{entity}_ntarf"
+        # Three phase meters only (TIC IRMS1-3)
+        self.irms_ids = [ f"sensor.{entity}_irms{phase}" for phase in range(1, 4) ]
 
     def logger_name(self):
         return "[linky]"
 
+    def get_watched_entities(self):
+        return [ self.ntarf_id ]
+
+    def get_required_entities(self, config):
+        return [ self.ntarf_id ]
+
     def is_hc(self):
-        ntarf = 2
-        try:
-            ntarf = int(self.get_state('sensor', 'ntarf'))
-            self.last_ntarf = ntarf
-        except ValueError:
-            ntarf = self.last_ntarf
-        return ntarf == 1
+        return self.read_float(self.ntarf_id, 2) == 1
+
+    def get_phase_currents(self):
+        # None when not available
+        currents = []
+        for entity_id in self.irms_ids:
+            state = self.read_state(entity_id)
+            try:
+                currents.append(float(state.state))
+            except (AttributeError, ValueError):
+                return None
+        return currents
@@ -1,4 +1,4 @@
-from datetime import datetime
+from .. import clock
 from .device import Device
 from ..utils import *
 
@@ -11,7 +11,7 @@ class PoolHeater(Device):
         self.delay_min_after_activation = 30
         # Wait at least 30min after deactivation before activating it
         self.delay_min_after_deactivation = 30
-        self.last_pool_water_temp = 0
+        self.water_temperature_id = f"sensor.{CONF_POOL_ID}_temp_water"
 
     def logger_name(self):
         return "[pool heater]"
@@ -21,16 +21,10 @@ class PoolHeater(Device):
     #
 
     def pool_water_temperature(self):
-        ret = 0.0
-        try:
-            ret = float(self.hass.states.get(f"sensor.{CONF_POOL_ID}_temp_water").state)
-        except ValueError:
-            ret = self.last_pool_water_temp
-        self.last_pool_water_temp = ret
-        return ret
+        return self.read_float(self.water_temperature_id)
 
     def min_temperature(self):
-        now = datetime.now()
+        now = clock.now()
         if now.hour > 20 and now.hour < 9:
             return 27
         return 29
@@ -41,7 +35,7 @@ class PoolHeater(Device):
 
     def activate(self):
         super().activate()
-        self.count_above = 0
+        self.timers.cancel("above")
 
     def deactivate(self):
         return super().deactivate()
@@ -50,7 +44,7 @@ class PoolHeater(Device):
         temp = self.pool_water_temperature()
         return False and self.can_activate() and temp < self.min_temperature()
 
-    def activate_if(self, power):
+    def activate_if(self, power, config):
         if self.should_activate():
             # Need to check if we have enough
             phases = self.get_phases()
@@ -59,20 +53,22 @@ class PoolHeater(Device):
                 self.activate()
                 self.info(f"start (available: {abs(power)}W)")
                 return CONF_POOL_HEATER_WAITING_TIME
-            now = datetime.now()
+            now = clock.now()
             if now.hour >= 12 and now.hour <= 15:
                 self.activate()
                 self.info(f"force start")
                 return CONF_POOL_HEATER_WAITING_TIME
         return 0
 
-    def update(self, power):
+    def update(self, power, config):
+        # Need to stay above the min temperature for a while
         if self.pool_water_temperature() >= self.min_temperature():
-            self.count_above += 1
+            if not self.timers.is_started("above"):
+                self.timers.start("above", CONF_POOL_HEATER_ABOVE_TIME * 60)
         else:
-            self.count_above = 0
+            self.timers.cancel("above")
         
-        if self.count_above > 60 and self.can_deactivate():
+        if self.timers.expired("above") and self.can_deactivate():
             self.info(f"no longer needed")
             self.deactivate()
             return CONF_POOL_HEATER_WAITING_TIME
@@ -1,6 +1,8 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
+from .. import clock
 from .device import Device
 from ..utils import *
+from ..allocator import Demand
 
 class WaterHeater(Device):
 
@@ -18,32 +20,75 @@ class WaterHeater(Device):
         self.delay_min_after_activation = 10
         # Wait at least 10min after deactivation before activating it
         self.delay_min_after_deactivation = 10
-        self.next_force_pv_hc = datetime.now()
-        self.last_water_temperature = 30.0
+        self.water_temperature_id = f"sensor.{entity}_middle_water_temperature"
         self.rule_6pm_active = False
+        self.resend_temperature = False
 
     def logger_name(self):
         return "[water heater]"
 
-    def late_init(self):
-        super().late_init()
+    def get_watched_entities(self):
+        return [ f"water_heater.{self.entity}", f"input_number.{self.entity}" ]
+
+    def get_required_entities(self, config):
+        if config.dev:
+            return [ self.water_temperature_id, f"input_number.{self.entity}" ]
+        return [ self.water_temperature_id, f"water_heater.{self.entity}" ]
+
+    def late_init(self, restored=None):
+        super().late_init(restored)
+        if self.warm:
+            # The entities hold what was last applied
+            domain = "switch" if not self.config.dev == True else "input_boolean"
+            pv = self.read_state(f"{domain}.{self.entity}_pv")
+            if pv is not None:
+                self.force_pv_hc = pv.state == "on"
+            if self.active and self.get_wanted_temperature() != self.needed_temperature:
+                self.resend_temperature = True
+            return
         self.set_force_pv_hc(False)
 
+    def save_state(self):
+        return {
+            **super().save_state(),
+            "force_pv_hc": self.force_pv_hc,
+            "needed_temperature": self.needed_temperature,
+            "boost": self.boost,
+            "suspended": self.suspended,
+            "rule_6pm_active": self.rule_6pm_active,
+        }
+
+    def reconcile(self, saved):
+        return self.read_state(f"water_heater.{self.entity}" if not self.config.dev else f"input_number.{self.entity}") is not None
+
+    def restore_state(self, saved):
+        super().restore_state(saved)
+        self.force_pv_hc = saved["force_pv_hc"]
+        self.needed_temperature = saved["needed_temperature"]
+        self.boost = saved["boost"]
+        self.suspended = saved["suspended"]
+        self.rule_6pm_active = saved["rule_6pm_active"]
+
     #
     # WaterHeater info
     #
 
     def get_water_temperature(self):
-        ret = 0.0
+        return self.read_float(self.water_temperature_id, 30.0)
+
+    def get_wanted_temperature(self):
+        # Target temperature currently set on the water heater
         try:
-            ret = float(self.get_state("sensor", "middle_water_temperature"))
-        except ValueError:
-            ret = self.last_water_temperature
-        self.last_water_temperature = ret
-        return ret
+            if not self.config.dev:
+                return float(self.read_state(f"water_heater.{self.entity}").attributes.get("temperature"))
+            return float(self.read_state(f"input_number.{self.entity}").state)
+        except (AttributeError, TypeError, ValueError):
+            return None
 
     def set_wanted_temperature(self, value):
-        if not config_dev(self.hass):
+        self.resend_temperature = False
+        if not self.config.dev:
+            self.expect(f"water_heater.{self.entity}", lambda state: float(state.attributes.get("temperature")) == value)
             call_async(
                 self.hass,
                 "water_heater",
@@ -51,8 +96,10 @@ class WaterHeater(Device):
                 {
                     "entity_id": f"water_heater.{self.entity}",
                     "temperature": value
-                })
+                },
+                lambda success: self.on_wanted_temperature_result(value, success))
         else:
+            self.expect(f"input_number.{self.entity}", lambda state: float(state.state) == value)
             call_async(
                 self.hass,
                 "input_number",
@@ -60,13 +107,19 @@ class WaterHeater(Device):
                 {
                     "entity_id": f"input_number.{self.entity}",
                     "value": value
-                })
+                },
+                lambda success: self.on_wanted_temperature_result(value, success))
+
+    def on_wanted_temperature_result(self, value, success):
+        if not success and value == self.needed_temperature:
+            self.info(f"failed to set temperature {value} => retry")
+            self.resend_temperature = True
 
     def set_boost(self, value):
         if self.boost != value:
             self.info(f"set boost {value}")
             self.boost = value
-            domain = "number" if not config_dev(self.hass) == True else "input_number"
+            domain = "number" if not self.config.dev == True else "input_number"
             action = "set_value"
             key = "value"
             call_async(
@@ -95,7 +148,7 @@ class WaterHeater(Device):
     #
 
     def compute_needed_temp(self):
-        now = datetime.now()
+        now = clock.now()
         #
         # Compute at what time water should be OK if we start now
         #
@@ -162,8 +215,8 @@ class WaterHeater(Device):
         if force != self.force_pv_hc:
             self.force_pv_hc = force
             if force:
-                self.next_force_pv_hc = datetime.now() + timedelta(hours=14)
-            domain = "switch" if not config_dev(self.hass) == True else "input_boolean"
+                self.timers.start("force_pv_hc", 14 * 3600)
+            domain = "switch" if not self.config.dev == True else "input_boolean"
             call_async(
                 self.hass,
                 domain,
@@ -171,7 +224,7 @@ class WaterHeater(Device):
                 { "entity_id": f"{domain}.{self.entity}_pv" })
 
     def can_force_pv_hc(self):
-        return datetime.now() > self.next_force_pv_hc
+        return not self.timers.is_running("force_pv_hc")
 
     #
     # Logic
@@ -202,20 +255,20 @@ class WaterHeater(Device):
         return True
 
     def is_forced(self):
-        return config_water_heater_forced(self.hass)
+        return self.config.water_heater_force
 
     #
     # Interface with LoadBalancer
     #
 
-    def activate_if(self, power):
+    def activate_if(self, power, config):
         # Always ON
         if not self.is_active():
             self.activate()
             return CONF_WATER_HEATER_WAITING_TIME
         return 0
 
-    def update(self, power):
+    def update(self, power, config):
         if not self.suspended and self.close_to_max():
             self.set_force_pv_hc(False)
             self.set_needed_temperature(CONF_WATER_HEATER_MIN_TEMP)
@@ -229,28 +282,17 @@ class WaterHeater(Device):
             #
             # HC/HP mode: need to set HC signal every 24h so ensure we set it once
             #
-            now = datetime.now()
-            if self.next_force_pv_hc > now and now.hour > 4 and loadbalancer_instance(self.hass).linky.is_hc() and not self.get_force_pv_hc():
+            now = clock.now()
+            if self.timers.is_running("force_pv_hc") and now.hour > 4 and loadbalancer_instance(self.hass).linky.is_hc() and not self.get_force_pv_hc():
                 self.info("forcing HC signal to avoid alarms")
                 self.set_force_pv_hc(True)
-        else:
-            #
-            # Solar mode: manage pv signal
-            #
 
-            #
-            # Check import/export status
-            #
-            if not self.get_force_pv_hc() and self.can_force_pv_hc() and power < 0 and abs(power) >= self.get_max_power():
-                # We have now enough solar production, let's raise PV/HC signal. (once per day)
-                self.set_force_pv_hc(True)
-                self.info(f"force pv")
-                return CONF_WATER_HEATER_WAITING_TIME
+        # Solar mode: PV signal, see get_demand
 
         #
         # Is boost needed?
         #
-        if config_water_heater_boost(self.hass) and not self.boost > 0:
+        if config.water_heater_boost and not self.boost > 0:
             self.set_boost(1)
         elif self.boost > 0:
             self.set_boost(0)
@@ -258,9 +300,35 @@ class WaterHeater(Device):
         #
         # Now we can update needed temperature
         #
+        if self.resend_temperature:
+            self.set_wanted_temperature(self.needed_temperature)
         self.set_needed_temperature(self.compute_needed_temp())
 
         if self.get_water_temperature() < self.needed_temperature:
             self.suspended = False
 
+        return 0
+
+    def get_consumed_power(self):
+        return self.max_power if self.active and self.get_force_pv_hc() else 0
+
+    def shed(self, excess):
+        # Only the PV signal is ours to drop
+        if not self.get_force_pv_hc():
+            return 0
+        self.info("overload => drop pv signal")
+        self.set_force_pv_hc(False)
+        return self.get_max_power()
+
+    def get_demand(self, power):
+        # PV signal is raised once per day when there is enough solar production
+        if self.is_hc_hp or not self.active or self.get_force_pv_hc() or not self.can_force_pv_hc():
+            return None
+        return Demand(self, CONF_WATER_HEATER_PRIORITY, self.get_max_power(), self.get_max_power())
+
+    def apply_allocation(self, power):
+        if power > 0:
+            self.set_force_pv_hc(True)
+            self.info(f"force pv")
+            return CONF_WATER_HEATER_WAITING_TIME
         return 0
\ No newline at end of file
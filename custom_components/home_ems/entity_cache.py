@@ -0,0 +1,59 @@
+import logging
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
+from .utils import metrics
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class EntityIdCache:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.entity_ids = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def build(self, config_entry):
+        ent_reg = er.async_get(self.hass)
+        for entry in er.async_entries_for_config_entry(ent_reg, config_entry.entry_id):
+            self.entity_ids[(entry.domain, entry.unique_id)] = entry.entity_id
+        _LOGGER.debug(f"[entity cache] built with {len(self.entity_ids)} entities")
+
+    def get(self, domain, unique_id):
+        key = (domain, unique_id)
+        entity_id = self.entity_ids.get(key)
+        if entity_id is not None:
+            self.hits += 1
+            return entity_id
+        self.misses += 1
+        counters = metrics(self.hass)
+        if counters is not None:
+            counters.registry_lookups += 1
+        entity_id = er.async_get(self.hass).async_get_entity_id(domain, DOMAIN, unique_id)
+        # Unknown entities are not cached: they will be resolved once created
+        if entity_id is not None:
+            self.entity_ids[key] = entity_id
+        return entity_id
+
+    @callback
+    def on_registry_updated(self, event):
+        if event.data.get("action") == "create":
+            return
+        changed = { event.data.get("entity_id"), event.data.get("old_entity_id") }
+        if changed.isdisjoint(self.entity_ids.values()):
+            return
+        _LOGGER.debug(f"[entity cache] invalidated by {event.data}")
+        self.entity_ids.clear()
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entity_ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else None,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import bisect
+import logging
+import time
+import voluptuous as vol
+from homeassistant.exceptions import ServiceNotFound
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class LatencyHistogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self):
+        buckets = { f"le_{bucket}": count for bucket, count in zip(self.buckets, self.counts) }
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 3) if self.count > 0 else None,
+            "buckets": buckets,
+        }
+
+class ServiceExecutor:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.semaphores = {}
+        self.pending = {}
+        self.latencies = {}
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def target(self, domain, data):
+        # Slots per target entity: a hung integration does not hold the
+        # writes to the others (Home-EMS own switches included)
+        entity_id = data.get("entity_id")
+        if isinstance(entity_id, list):
+            entity_id = ",".join(entity_id)
+        return entity_id if entity_id else domain
+
+    def semaphore(self, target):
+        if target not in self.semaphores:
+            self.semaphores[target] = asyncio.Semaphore(CONF_EXECUTOR_CONCURRENCY)
+        return self.semaphores[target]
+
+    def record(self, domain, service, latency):
+        key = f"{domain}.{service}"
+        if key not in self.latencies:
+            self.latencies[key] = LatencyHistogram(CONF_EXECUTOR_LATENCY_BUCKETS)
+        self.latencies[key].record(latency)
+
+    async def async_call(self, domain, service, data):
+        # Bounded: do not pile up calls on a target that hangs
+        target = self.target(domain, data)
+        if self.pending.get(target, 0) >= CONF_EXECUTOR_MAX_PENDING:
+            self.rejected += 1
+            _LOGGER.error(f"[executor] {CONF_EXECUTOR_MAX_PENDING} calls pending on {target}, drop {domain}.{service}({data}) ({self.rejected} dropped so far)")
+            return False
+        self.pending[target] = self.pending.get(target, 0) + 1
+        try:
+            for attempt in range(CONF_EXECUTOR_RETRIES + 1):
+                if attempt > 0:
+                    self.retries += 1
+                    await asyncio.sleep(CONF_EXECUTOR_BACKOFF * (2 ** (attempt - 1)))
+                async with self.semaphore(target):
+                    start = time.monotonic()
+                    try:
+                        await asyncio.wait_for(
+                            self.hass.services.async_call(domain, service, data, blocking=True),
+                            CONF_EXECUTOR_TIMEOUT
+                        )
+                        self.record(domain, service, time.monotonic() - start)
+                        self.successes += 1
+                        return True
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        _LOGGER.warning(f"[executor] {domain}.{service} timed out after {CONF_EXECUTOR_TIMEOUT}s (attempt {attempt + 1})")
+                    except (ServiceNotFound, vol.Invalid) as err:
+                        # Retrying will not help
+                        _LOGGER.error(f"[executor] {domain}.{service} failed: {err}")
+                        break
+                    except Exception as err:
+                        _LOGGER.warning(f"[executor] {domain}.{service} failed: {err} (attempt {attempt + 1})")
+            self.failures += 1
+            return False
+        finally:
+            self.pending[target] -= 1
+
+    def stats(self):
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "pending": sum(self.pending.values()),
+            "latency": { key: histogram.stats() for key, histogram in self.latencies.items() },
+        }
@@ -0,0 +1,170 @@
+import logging
+import math
+import numpy as np
+from . import clock
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+def solar_elevation(timestamps, latitude, longitude):
+    # Low precision solar position (< 1deg), timestamps in seconds since epoch
+    d = timestamps / 86400.0 - 10957.5
+    g = np.radians(357.528 + 0.9856003 * d)
+    ecliptic = np.radians(280.460 + 0.9856474 * d + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.0000004 * d)
+    declination = np.arcsin(np.sin(obliquity) * np.sin(ecliptic))
+    right_ascension = np.arctan2(np.cos(obliquity) * np.sin(ecliptic), np.cos(ecliptic))
+    sidereal = np.radians((280.46061837 + 360.98564736629 * d) % 360)
+    hour_angle = sidereal + np.radians(longitude) - right_ascension
+    latitude = np.radians(latitude)
+    return np.arcsin(np.sin(latitude) * np.sin(declination) + np.cos(latitude) * np.cos(declination) * np.cos(hour_angle))
+
+class SurplusForecaster:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.size = CONF_FORECAST_HISTORY * 60 // CONF_FORECAST_STEP
+        # Surplus of the house without the controlled loads (W, >0 = export)
+        self.times = np.zeros(self.size)
+        self.surpluses = np.zeros(self.size)
+        # Clear sky shape of each sample, computed when it is recorded
+        self.shapes = np.zeros(self.size)
+        self.count = 0
+        self.index = 0
+        # Weighted sums of the fit at the last sample: w, wx, wy, wxx, wxy
+        self.sums = [ 0.0 ] * 5
+        # Clear sky shape on the minute grid, from minute shape_start
+        self.shape_start = None
+        self.shape_block = None
+        # Fitted model (pv, offset, residual, time), the curve is only
+        # computed when a forecast is read
+        self.model = None
+        # Forecast curve, one point per minute from the last sample
+        self.curve = None
+        # Mean surplus per horizon, for the current curve
+        self.means = {}
+        self.decay = np.exp(-np.arange(CONF_FORECAST_HORIZON + 1) / CONF_FORECAST_RESIDUAL_TAU)
+        self.fits = 0
+
+    def clear_sky(self, timestamps):
+        return np.maximum(np.sin(solar_elevation(timestamps, self.hass.config.latitude, self.hass.config.longitude)), 0.0)
+
+    def record(self, surplus):
+        now = clock.now().timestamp()
+        if self.count > 0 and now - self.times[(self.index - 1) % self.size] < CONF_FORECAST_STEP:
+            return
+        shape = self.shape_at(now)
+        self.update_sums(now, shape, surplus)
+        self.times[self.index] = now
+        self.surpluses[self.index] = surplus
+        self.shapes[self.index] = shape
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        if self.index == 0:
+            # Once per history: rounding errors of the running sums dropped
+            self.sums = self.weighted_sums(now)
+        self.model = self.fit(now) if self.count >= CONF_FORECAST_MIN_SAMPLES else None
+        self.curve = None
+        self.means = {}
+
+    def weighted_sums(self, now):
+        weights = np.exp(-(now - self.times[:self.count]) / (CONF_FORECAST_FIT_TAU * 60))
+        shape = self.shapes[:self.count]
+        surpluses = self.surpluses[:self.count]
+        return [ float(weights.sum()), float(weights @ shape), float(weights @ surpluses), float(weights @ (shape * shape)), float(weights @ (shape * surpluses)) ]
+
+    def update_sums(self, now, shape, surplus):
+        # The weights decay with the age of the samples: the sums of the
+        # previous sample are scaled, the sample overwritten is removed
+        sums = self.sums
+        if self.count > 0:
+            k = math.exp(-(now - self.times[(self.index - 1) % self.size]) / (CONF_FORECAST_FIT_TAU * 60))
+            sums = [ value * k for value in sums ]
+        if self.count == self.size:
+            w = math.exp(-(now - self.times[self.index]) / (CONF_FORECAST_FIT_TAU * 60))
+            x = self.shapes[self.index]
+            y = self.surpluses[self.index]
+            sums = [ sums[0] - w, sums[1] - w * x, sums[2] - w * y, sums[3] - w * x * x, sums[4] - w * x * y ]
+        self.sums = [ sums[0] + 1.0, sums[1] + shape, sums[2] + surplus, sums[3] + shape * shape, sums[4] + shape * surplus ]
+
+    def fit(self, now):
+        # surplus(t) = pv * clear_sky(t) - load + residual decaying to 0,
+        # weighted least squares on 2 parameters, closed form
+        w, wx, wy, wxx, wxy = self.sums
+        shapes = self.shapes[:self.count]
+        det = w * wxx - wx * wx
+        pv = 0.0
+        if shapes.max() - shapes.min() > 0.01 and det > 0:
+            pv = (w * wxy - wx * wy) / det
+            offset = (wy - pv * wx) / w
+        if pv <= 0:
+            # Night or no correlation with the sun: persistence of the weighted mean
+            pv = 0.0
+            offset = wy / w
+        # Deviation of the last samples (clouds) fades away
+        last = [ (self.index - i) % self.size for i in range(1, min(self.count, 3) + 1) ]
+        residual = sum(float(self.surpluses[i]) - (pv * float(self.shapes[i]) + offset) for i in last) / len(last)
+        self.fits += 1
+        return (pv, offset, residual, now)
+
+    def forecast(self):
+        if self.curve is None and self.model is not None:
+            pv, offset, residual, now = self.model
+            self.curve = pv * self.horizon_shape(now) + offset + residual * self.decay
+        return self.curve
+
+    def minute_shapes_from(self, start):
+        # Computed in blocks of two horizons, older minutes are dropped
+        if self.shape_start is None or start < self.shape_start or start + CONF_FORECAST_HORIZON + 1 >= self.shape_start + len(self.shape_block):
+            self.shape_start = start
+            self.shape_block = self.clear_sky(np.arange(start, start + 2 * (CONF_FORECAST_HORIZON + 1)) * 60.0)
+        return start - self.shape_start
+
+    def shape_at(self, now):
+        start = int(now // 60)
+        offset = self.minute_shapes_from(start)
+        fraction = now / 60 - start
+        return float(self.shape_block[offset] * (1 - fraction) + self.shape_block[offset + 1] * fraction)
+
+    def horizon_shape(self, now):
+        # One point per minute from now
+        start = int(now // 60)
+        offset = self.minute_shapes_from(start)
+        fraction = now / 60 - start
+        points = self.shape_block[offset:offset + CONF_FORECAST_HORIZON + 2]
+        return points[:-1] * (1 - fraction) + points[1:] * fraction
+
+    def is_ready(self):
+        return self.model is not None
+
+    def expected_surplus(self, horizon):
+        # Mean surplus over the next horizon minutes
+        curve = self.forecast()
+        if curve is None:
+            return None
+        if horizon not in self.means:
+            self.means[horizon] = float(curve[:horizon + 1].mean())
+        return self.means[horizon]
+
+    def surplus_change(self, start, end):
+        # Lowest surplus between start and end minutes, relative to now
+        curve = self.forecast()
+        if curve is None:
+            return 0.0
+        return float(curve[start:end + 1].min() - curve[0])
+
+    def expected_power(self, power, horizon):
+        # Net power expected over the horizon with the loads as they are now:
+        # current power shifted by the forecast surplus change
+        curve = self.forecast()
+        if curve is None:
+            return power
+        return power - (self.expected_surplus(horizon) - float(curve[0]))
+
+    def stats(self):
+        return {
+            "samples": self.count,
+            "fits": self.fits,
+            "surplus_15min": round(self.expected_surplus(15)) if self.is_ready() else None,
+            "surplus_60min": round(self.expected_surplus(60)) if self.is_ready() else None,
+        }
@@ -0,0 +1,87 @@
+import logging
+from .utils import get_phase_list
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+PHASE_LIMIT = CONF_MAX_CURRENT_PER_PHASE * CONF_PHASE_VOLTAGE
+# Phase bitmask -> phases
+PHASE_LISTS = [ get_phase_list(phases) for phases in range(8) ]
+
+class PhaseLedger:
+
+    def __init__(self):
+        # Power given to each device, per phase (W)
+        self.contributions = {}
+        # (phases, power) each contribution was split from
+        self.powers = {}
+        # Loads not managed by Home-EMS, per phase (W), from Linky currents
+        self.others = [ 0.0, 0.0, 0.0 ]
+        self.measured = False
+        self.overloads = 0
+        # Phases above the current limit, logged when they go over or back
+        self.over = set()
+
+    def split(self, phases, power):
+        phases = PHASE_LISTS[phases & 0x7]
+        contribution = [ 0.0, 0.0, 0.0 ]
+        for phase in phases:
+            contribution[phase] = power / len(phases)
+        return contribution
+
+    def set(self, device, power):
+        key = (device.get_phases(), power)
+        if self.powers.get(device) != key:
+            self.powers[device] = key
+            self.contributions[device] = self.split(key[0], power)
+
+    def measure(self, currents):
+        # Linky currents include the managed devices: the rest is the house.
+        # Without them, only the managed devices are accounted
+        self.measured = currents is not None
+        for phase in range(3):
+            if currents is None:
+                self.others[phase] = 0.0
+                continue
+            managed = sum(contribution[phase] for contribution in self.contributions.values())
+            self.others[phase] = max(currents[phase] * CONF_PHASE_VOLTAGE - managed, 0.0)
+            if currents[phase] > CONF_MAX_CURRENT_PER_PHASE and phase not in self.over:
+                self.over.add(phase)
+                self.overloads += 1
+                _LOGGER.warning(f"[ledger] phase {phase + 1} at {currents[phase]}A above {CONF_MAX_CURRENT_PER_PHASE}A")
+            elif currents[phase] <= CONF_MAX_CURRENT_PER_PHASE and phase in self.over:
+                self.over.discard(phase)
+                _LOGGER.info(f"[ledger] phase {phase + 1} back to {currents[phase]}A")
+
+    def load(self, phase, excluded=()):
+        return self.others[phase] + sum(
+            contribution[phase]
+            for device, contribution in self.contributions.items()
+            if device not in excluded
+        )
+
+    def headroom(self, excluded=()):
+        # Power per phase left for the excluded devices (W), in one pass
+        left = [ PHASE_LIMIT - other for other in self.others ]
+        for device, contribution in self.contributions.items():
+            if device not in excluded:
+                left[0] -= contribution[0]
+                left[1] -= contribution[1]
+                left[2] -= contribution[2]
+        return left
+
+    def limit(self, device):
+        # Max power the device can take on its phases
+        phases = PHASE_LISTS[device.get_phases() & 0x7]
+        headroom = self.headroom((device,))
+        return max(min(headroom[phase] for phase in phases) * len(phases), 0.0)
+
+    def allows(self, device, power):
+        return power <= self.limit(device)
+
+    def stats(self):
+        return {
+            "measured": self.measured,
+            "overloads": self.overloads,
+            "currents": [ round(self.load(phase) / CONF_PHASE_VOLTAGE, 1) for phase in range(3) ],
+        }
@@ -1,17 +1,36 @@
 import logging
 import copy
-from datetime import datetime, timedelta
+import time
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_state_change_event
+from . import clock
+from .clock import monotonic
 from .devices.water_heater import WaterHeater
 from .devices.linky import Linky
 from .devices.enphase import Enphase
 from .devices.evcharger import EVCharger
 from .devices.pool_heater import PoolHeater
 from .devices.cro import CRO
+from .forecaster import SurplusForecaster
+from .allocator import Allocator
+from .ledger import PhaseLedger
+from .trace import DecisionTrace
 from .utils import *
 from .const import *
 
 _LOGGER = logging.getLogger(__name__)
 
+class Cooldown:
+
+    def __init__(self, device, start, until, delta=0):
+        self.start = start
+        self.until = until
+        # Phases used when the decision was taken
+        self.phases = device.get_phases()
+        # Power the decision added, not visible on the net power yet
+        self.delta = delta
+        self.waiting_effect = True
+
 class LoadBalancer:
 
     def __init__(self, hass, config_entry):
@@ -24,80 +43,356 @@ class LoadBalancer:
         self.cro = CRO(hass, CONF_CRO_ID, CONF_CRO_PHASE)
         self.pool_heater = PoolHeater(hass, CONF_POOL_HEATER_PHASE)        
         self.devices = [ self.water_heater, self.evcharger, self.cro, self.pool_heater ]
-        self.devices_for_update = self.devices.copy()
+        self.forecaster = SurplusForecaster(hass) if CONF_FORECAST_ENABLED else None
+        self.allocator = Allocator()
+        self.ledger = PhaseLedger()
+        self.trace = DecisionTrace()
         self.loop_count = 0
-        self.next_run = datetime.now()
+        # Devices waiting for the effect of their last decision
+        self.cooldowns = {}
+        self.started = False
+        # Data freshness: stale inputs per device, devices held, safe mode
+        self.stale = {}
+        self.held = set()
+        self.degraded = None
+
+    def start_tick(self, config):
+        for device in [ self.enphase, self.linky ] + self.devices:
+            device.start_tick(config)
+        for device in self.devices:
+            self.ledger.set(device, self.consumed_power(device))
+        self.ledger.measure(self.linky.get_phase_currents())
+
+    def late_init(self, restored=None):
+        config = config_snapshot(self.hass)
+        self.start_tick(config)
+        saved = restored["devices"] if restored is not None else {}
+        for device in self.devices:
+            device.late_init(saved.get(device.short_name()))
+        if restored is not None:
+            self.restore_cooldowns(restored["cooldowns"])
+        self.is_hc_hp = config.is_hc_hp()
+        self.started = True
+
+    #
+    # Warm restart
+    #
+
+    def save_state(self):
+        config = self.devices[0].config
+        now = monotonic()
+        wall = clock.now().timestamp()
+        return {
+            "switches": { name: getattr(config, name) for name in CONF_STATE_SWITCHES },
+            "cooldowns": {
+                device.short_name(): {
+                    "until": round(wall + cooldown.until - now),
+                    "phases": cooldown.phases,
+                    "waiting_effect": cooldown.waiting_effect,
+                    "delta": cooldown.delta,
+                }
+                for device, cooldown in self.cooldowns.items()
+            },
+            "devices": { device.short_name(): device.save_state() for device in self.devices },
+        }
 
-    def late_init(self):
+    def restore_cooldowns(self, saved):
+        now = monotonic()
+        wall = clock.now().timestamp()
         for device in self.devices:
-            device.late_init()
-        self.is_hc_hp = config_loadbalancer_mode_is_hc_hp(self.hass)
+            cooldown = saved.get(device.short_name())
+            if cooldown is None or not device.warm or cooldown["until"] <= wall:
+                continue
+            self.cooldowns[device] = Cooldown(device, now, now + cooldown["until"] - wall, cooldown.get("delta", 0))
+            self.cooldowns[device].phases = cooldown["phases"]
+            self.cooldowns[device].waiting_effect = cooldown["waiting_effect"]
+
+    def get_watched_entities(self):
+        entities = []
+        for device in [ self.enphase, self.linky ] + self.devices:
+            entities.extend(device.get_watched_entities())
+        return entities
+
+    def get_required_entities(self, config):
+        entities = []
+        for device in [ self.enphase, self.linky ] + self.devices:
+            entities.extend(device.get_required_entities(config))
+        return entities
 
-    def activate_if(self, power):
+    def next_deadline(self):
+        # Earliest time something may change without any input change:
+        # end of a cooldown or any device timer
+        deadlines = [ cooldown.until for cooldown in self.cooldowns.values() ]
         for device in self.devices:
-            next_run = device.activate_if(power)
+            deadline = device.next_deadline()
+            if deadline is not None:
+                deadlines.append(deadline)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    #
+    # Cooldowns: a device that acted waits for its effect, devices sharing
+    # one of its phases wait too, others can be decided in the same tick
+    #
+
+    def update_cooldowns(self, now, config):
+        for device, cooldown in list(self.cooldowns.items()):
+            if config.dev or cooldown.until <= now:
+                del self.cooldowns[device]
+            elif cooldown.waiting_effect and device.effects_observed():
+                # Closed loop: only leave time for the 1min averages to settle
+                _LOGGER.info(f"[loadbalancer]{device.logger_name()} effect observed => resume decisions")
+                cooldown.waiting_effect = False
+                cooldown.until = min(cooldown.until, now + CONF_EFFECT_SETTLE_TIME)
+
+    def start_cooldown(self, device, now, delta_min, delta=0):
+        self.cooldowns[device] = Cooldown(device, now, now + delta_min * 60, delta)
+
+    def is_cooling_down(self, device):
+        phases = device.get_phases()
+        for other, cooldown in self.cooldowns.items():
+            if other is device or (cooldown.phases & phases) != 0:
+                return True
+        return False
+
+    def record_device(self, device, stage, start):
+        counters = metrics(self.hass)
+        if counters is not None:
+            counters.record_device(device, stage, time.perf_counter() - start)
+
+    def check_freshness(self):
+        # A device with a stale input is not decided, a stale net power puts
+        # the surplus allocation in safe mode
+        stale = {}
+        held = set()
+        for device in [ self.enphase, self.linky ] + self.devices:
+            inputs = device.get_stale_inputs()
+            if len(inputs) == 0:
+                continue
+            ages = {}
+            for entity_id in inputs:
+                age = device.input_age(entity_id)
+                ages[entity_id] = round(age) if age is not None else None
+            stale[device.short_name()] = ages
+            held.add(device)
+        degraded = CONF_STALE_MODE if self.enphase in held else None
+        # Ages change every tick: only log when the set of stale inputs does
+        entity_ids = { entity_id for ages in stale.values() for entity_id in ages }
+        previous = { entity_id for ages in self.stale.values() for entity_id in ages }
+        if entity_ids != previous and len(stale) > 0:
+            _LOGGER.warning(f"[loadbalancer] stale inputs {stale}" + (f" => {degraded} mode" if degraded is not None else ""))
+        elif len(stale) == 0 and len(self.stale) > 0:
+            _LOGGER.warning("[loadbalancer] inputs fresh again")
+        self.stale = stale
+        self.held = held
+        self.degraded = degraded
+
+    def consumed_power(self, device):
+        return device.get_max_power() if device.is_active() else 0
+
+    def controlled_power(self):
+        return sum(device.get_consumed_power() for device in self.devices)
+
+    def activate_if(self, power, config, now):
+        for device in self.devices:
+            power = self.activate_device(device, power, config, now)
+        return power
+
+    def activate_device(self, device, power, config, now):
+        if device in self.held or not device.has_due_work() or self.is_cooling_down(device):
+            return power
+        device.clear_effects()
+        before = self.consumed_power(device)
+        start = time.perf_counter()
+        next_run = device.activate_if(power, config)
+        self.record_device(device, "activate_if", start)
+        self.ledger.set(device, self.consumed_power(device))
+        if next_run > 0:
+            _LOGGER.info(f"[loadbalancer]{device.logger_name()} activated => wait for effect or {next_run}min before taking any new decision on its phases")
+            self.trace.action(device, "activate_if", wait_min=next_run)
+            self.start_cooldown(device, now, next_run, self.consumed_power(device) - before)
+            # Next devices only get what is left
+            power += self.consumed_power(device) - before
+        return power
+
+    def update(self, power, config, now):
+        for device in reversed(self.devices):
+            if device in self.held or not device.is_active() or self.is_cooling_down(device):
+                continue
+            device.clear_effects()
+            before = self.consumed_power(device)
+            start = time.perf_counter()
+            next_run = device.update(power, config)
+            self.record_device(device, "update", start)
+            self.ledger.set(device, self.consumed_power(device))
             if next_run > 0:
-                _LOGGER.info(f"[loadbalancer]{device.logger_name()} activated => wait for {next_run}min before taking any new decision")
-                return next_run
-        return 0
-
-    def update(self, power):
-        if len(self.devices_for_update) == 0:            
-            self.devices_for_update = self.devices.copy()
-        while len(self.devices_for_update) > 0:
-            device = self.devices_for_update.pop()
-            if device.is_active():
-                next_run = device.update(power)
-                if next_run > 0:
-                    _LOGGER.info(f"[loadbalancer]{device.logger_name()} updated => wait for {next_run}min before taking any new decision")
-                    return next_run        
-        return 0
-
-    def apply_rules(self, power):
-        if self.is_hc_hp:
-            # Only needed in Solar mode
+                _LOGGER.info(f"[loadbalancer]{device.logger_name()} updated => wait for effect or {next_run}min before taking any new decision on its phases")
+                self.trace.action(device, "update", wait_min=next_run)
+                self.start_cooldown(device, now, next_run, self.consumed_power(device) - before)
+                power += self.consumed_power(device) - before
+        return power
+
+    def allocate(self, power, config, now):
+        # Share the surplus between the devices driven by it, in one pass.
+        # The budget adds up their consumption and the net power: it is only
+        # consistent once the last decision is visible on the net power: the
+        # devices cooling down (or sharing their phases) keep their power, and
+        # what earlier ticks gave them is taken out of the budget until then
+        if self.degraded == "hold":
             return
+        pending = sum(max(cooldown.delta, 0) for cooldown in self.cooldowns.values() if cooldown.start < now)
+        demands = []
+        for device in self.devices:
+            if device in self.held or self.is_cooling_down(device):
+                continue
+            demand = device.get_demand(power)
+            if demand is not None:
+                demands.append(demand)
+        if len(demands) == 0:
+            return
+        budget = 0
+        if self.degraded == "minimum":
+            # The net power is not known
+            allocation = self.allocator.minimum(demands)
+        else:
+            budget = sum(demand.consumed for demand in demands) - power - pending
+            expected = budget
+            if self.forecaster is not None:
+                expected -= self.forecaster.expected_power(power, CONF_FORECAST_START_HORIZON) - power
+            headroom = self.ledger.headroom([ demand.device for demand in demands ])
+            allocation = self.allocator.allocate(demands, budget, expected, headroom)
+            self.trace.inputs(budget=round(budget), expected_budget=round(expected))
+        for demand in demands:
+            device = demand.device
+            device.clear_effects()
+            before = self.consumed_power(device)
+            next_run = device.apply_allocation(allocation[device])
+            self.ledger.set(device, self.consumed_power(device))
+            if next_run > 0:
+                _LOGGER.info(f"[loadbalancer]{device.logger_name()} allocated {allocation[device]:.0f}W (budget {budget:.0f}W) => wait for effect or {next_run}min before taking any new decision on its phases")
+                self.trace.action(device, "allocate", power=round(allocation[device]), wait_min=next_run)
+                self.start_cooldown(device, now, next_run, self.consumed_power(device) - before)
 
-        #
-        # Special case: if EV charger is requested then we need to give him
-        # the priority
-        #
-        if self.cro.is_active() and self.evcharger.is_active() and self.evcharger.get_max_power() == 0:
-            if power < 0 and (abs(power) + self.cro.cro_get_power()) > self.evcharger.get_min_power():
-                _LOGGER.info("EV Charger is waiting for activation and there are enough power if we deactivate")
-                self.cro.deactivate()
+    def shed(self, excess, phases):
+        # Emergency path, outside of the ticks: reduce loads on the given
+        # phases until the excess is covered, whatever their cooldowns
+        config = config_snapshot(self.hass)
+        if not self.started or config.loadbalancer != True:
+            return []
+        now = monotonic()
+        self.trace.begin("overload")
+        self.trace.inputs(excess=round(excess), phases=phases)
+        self.start_tick(config)
+        actions = []
+        for device in [ self.evcharger, self.cro, self.water_heater ]:
+            if excess <= 0:
+                break
+            if (device.get_phases() & phases) == 0:
+                continue
+            device.clear_effects()
+            shed = device.shed(excess)
+            if shed > 0:
+                actions.append(f"{device.logger_name()} -{shed:.0f}W")
+                self.trace.action(device, "shed", power=-round(shed), wait_min=CONF_OVERLOAD_HOLD)
+                excess -= shed
+                self.start_cooldown(device, now, CONF_OVERLOAD_HOLD)
+                self.ledger.set(device, self.consumed_power(device))
+        self.trace.end(command_bus(self.hass).flush())
+        store = state_store(self.hass)
+        if store is not None:
+            store.on_change()
+        return actions
 
-    async def run(self, hass):
+    def subscribe(self):
+        # Connector events are handled right away, not on the next tick
+        return async_track_state_change_event(self.hass, [ self.evcharger.status_connector_id ], self.on_connector_change)
 
-        if config_loadbalancer_enabled(hass) != True:
-            # Disabled
+    @callback
+    def on_connector_change(self, event):
+        state = event.data.get("new_state")
+        if state is None or state.state in ("unknown", "unavailable") or state.state == self.evcharger.connector:
+            return
+        self.on_connector(state.state)
+
+    def on_connector(self, status):
+        # Entry actions of the connector state machine, then the charge
+        # starts if it is requested
+        config = config_snapshot(self.hass)
+        if not self.started or config.loadbalancer != True:
             return
+        now = monotonic()
+        self.trace.begin("connector")
+        self.trace.inputs(connector=status)
+        self.start_tick(config)
+        self.update_cooldowns(now, config)
+        if self.evcharger.set_connector(status):
+            self.activate_device(self.evcharger, self.enphase.get_power(), config, now)
+        self.trace.notes([ self.evcharger ])
+        self.trace.end(command_bus(self.hass).flush())
+        store = state_store(self.hass)
+        if store is not None:
+            store.on_change()
+
+    async def run(self, hass, target=None):
+        # target: monotonic time the run was scheduled for (drift)
+        counters = metrics(hass)
+        if counters is not None:
+            if target is not None:
+                counters.record_drift(monotonic() - target)
+            counters.begin()
+        active = profiler(hass)
+        profiling = active is not None and active.enable()
+        self.trace.begin("tick")
+        try:
+            self.decide(hass)
+        finally:
+            self.trace.notes(self.devices)
+            # Send the commands of this tick, merged and deduplicated
+            self.trace.end(command_bus(hass).flush())
+            if profiling:
+                active.disable()
+            store = state_store(hass)
+            if store is not None and self.started:
+                store.on_change()
+            if counters is not None:
+                counters.end()
+
+    def decide(self, hass):
 
-        now = datetime.now()
+        # Read all switches and select once: every decision of this tick
+        # sees the same configuration
+        config = config_snapshot(hass)
 
-        # All logic need device and linky to update. Depending on the action
-        # a longer wait might be required
-        if now < self.next_run:
-            _LOGGER.debug(f"[loadbalancer] too early next_run={self.next_run})")
-            if config_dev(hass):
-                self.next_run = now
+        if config.loadbalancer != True:
+            # Disabled
+            self.trace.inputs(enabled=False)
             return
 
+        now = monotonic()
+        self.start_tick(config)
+        self.update_cooldowns(now, config)
+        self.check_freshness()
+        self.evcharger.sync_connector()
+
         # Extract current import/export from Enphase
         power = self.enphase.get_power()
 
+        self.trace.inputs(
+            power=round(power),
+            mode=config.mode,
+            cooldowns=[ device.short_name() for device in self.cooldowns ],
+        )
+        if len(self.stale) > 0:
+            self.trace.inputs(stale=self.stale, degraded=self.degraded)
+
         if self.loop_count % 10 == 0:
-            _LOGGER.info(f"[loadbalancer] eletrical state: power={power}W")
+            _LOGGER.info(f"[loadbalancer] eletrical state: power={power}W cooldowns={len(self.cooldowns)}")
         self.loop_count += 1
 
-        self.apply_rules(power)
-
-        next_delta_min = self.activate_if(power)
-        if next_delta_min > 0:
-            self.next_run = now + timedelta(minutes=next_delta_min)
-            return
+        if self.forecaster is not None and self.degraded is None:
+            # History of the surplus without the controlled loads
+            self.forecaster.record(self.controlled_power() - power)
 
-        next_delta_min = self.update(power)
-        if next_delta_min > 0:
-            self.next_run = now + timedelta(minutes=next_delta_min)
-            return
+        # Rules (requests, forced, HC...) first, then the surplus allocation
+        power = self.activate_if(power, config, now)
+        power = self.update(power, config, now)
+        self.allocate(power, config, now)
@@ -0,0 +1,149 @@
+import logging
+import time
+from collections import deque
+from aiohttp import web
+from homeassistant.components.http import HomeAssistantView
+from .executor import LatencyHistogram
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+PREFIX = CONF_ENTITY_ID
+
+def histogram_lines(name, histogram, labels=""):
+    # Prometheus histogram: cumulative buckets in seconds
+    lines = []
+    cumulative = 0
+    for bucket, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}le="{bucket}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+    labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+    lines.append(f"{name}_sum{labels} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{labels} {histogram.count}")
+    return lines
+
+class Metrics:
+
+    def __init__(self):
+        # Counters incremented where the integration reads or acts
+        self.states_get = 0
+        self.registry_lookups = 0
+        self.service_calls = 0
+        self.ticks = 0
+        self.tick_duration = LatencyHistogram(CONF_METRICS_TICK_BUCKETS)
+        self.drift = LatencyHistogram(CONF_METRICS_DRIFT_BUCKETS)
+        # (device, stage) -> time spent in activate_if/update
+        self.devices = {}
+        # Last ticks: (duration, states.get, registry lookups, service calls)
+        self.recent = deque(maxlen=CONF_METRICS_WINDOW)
+        self.recent_drifts = deque(maxlen=CONF_METRICS_WINDOW)
+        self.start = None
+        self.counters = None
+
+    def begin(self):
+        self.start = time.perf_counter()
+        self.counters = (self.states_get, self.registry_lookups, self.service_calls)
+
+    def end(self):
+        if self.start is None:
+            return
+        duration = time.perf_counter() - self.start
+        self.start = None
+        self.ticks += 1
+        self.tick_duration.record(duration)
+        self.recent.append((
+            duration,
+            self.states_get - self.counters[0],
+            self.registry_lookups - self.counters[1],
+            self.service_calls - self.counters[2],
+        ))
+
+    def record_drift(self, drift):
+        # Delay of a run after the time it was scheduled for
+        self.drift.record(max(drift, 0))
+        self.recent_drifts.append(drift)
+
+    def record_device(self, device, stage, duration):
+        # Keyed by the device itself, named on output only
+        histogram = self.devices.get((device, stage))
+        if histogram is None:
+            histogram = self.devices[(device, stage)] = LatencyHistogram(CONF_METRICS_TICK_BUCKETS)
+        histogram.record(duration)
+
+    def mean(self, index):
+        if len(self.recent) == 0:
+            return None
+        return sum(tick[index] for tick in self.recent) / len(self.recent)
+
+    def tick_duration_ms(self):
+        mean = self.mean(0)
+        return round(mean * 1000, 3) if mean is not None else None
+
+    def tick_drift_ms(self):
+        if len(self.recent_drifts) == 0:
+            return None
+        return round(sum(self.recent_drifts) / len(self.recent_drifts) * 1000, 1)
+
+    def per_tick(self, index):
+        mean = self.mean(index)
+        return round(mean, 2) if mean is not None else None
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "tick_max_ms": round(max(tick[0] for tick in self.recent) * 1000, 3) if len(self.recent) > 0 else None,
+            "drift_max_ms": round(max(self.recent_drifts) * 1000, 1) if len(self.recent_drifts) > 0 else None,
+            "devices_ms": {
+                f"{device.short_name()}.{stage}": round(histogram.sum / histogram.count * 1000, 3)
+                for (device, stage), histogram in self.devices.items()
+            },
+        }
+
+    def exposition(self, executor=None):
+        # Text format of Prometheus, for a local scraper
+        lines = [
+            f"# TYPE {PREFIX}_ticks_total counter",
+            f"{PREFIX}_ticks_total {self.ticks}",
+            f"# TYPE {PREFIX}_states_get_total counter",
+            f"{PREFIX}_states_get_total {self.states_get}",
+            f"# TYPE {PREFIX}_registry_lookups_total counter",
+            f"{PREFIX}_registry_lookups_total {self.registry_lookups}",
+            f"# TYPE {PREFIX}_service_calls_total counter",
+            f"{PREFIX}_service_calls_total {self.service_calls}",
+            f"# TYPE {PREFIX}_tick_duration_seconds histogram",
+        ]
+        lines += histogram_lines(f"{PREFIX}_tick_duration_seconds", self.tick_duration)
+        lines.append(f"# TYPE {PREFIX}_tick_drift_seconds histogram")
+        lines += histogram_lines(f"{PREFIX}_tick_drift_seconds", self.drift)
+        lines.append(f"# TYPE {PREFIX}_device_duration_seconds histogram")
+        for (device, stage), histogram in self.devices.items():
+            lines += histogram_lines(f"{PREFIX}_device_duration_seconds", histogram, f'device="{device.short_name()}",stage="{stage}",')
+        if executor is not None:
+            lines.append(f"# TYPE {PREFIX}_service_calls_rejected_total counter")
+            lines.append(f"{PREFIX}_service_calls_rejected_total {executor.rejected}")
+            lines.append(f"# TYPE {PREFIX}_service_latency_seconds histogram")
+            for service, histogram in executor.latencies.items():
+                lines += histogram_lines(f"{PREFIX}_service_latency_seconds", histogram, f'service="{service}",')
+        return "\n".join(lines) + "\n"
+
+class MetricsView(HomeAssistantView):
+    """Metrics in the Prometheus text format."""
+
+    url = f"/api/{CONF_ENTITY_ID}/metrics"
+    name = f"api:{CONF_ENTITY_ID}:metrics"
+    requires_auth = True
+
+    def __init__(self, hass):
+        self.hass = hass
+
+    async def get(self, request):
+        data = self.hass.data.get(DOMAIN, {})
+        metrics = data.get("metrics")
+        if metrics is None:
+            return web.Response(status=404)
+        bus = data.get("command_bus")
+        return web.Response(
+            text=metrics.exposition(bus.executor if bus is not None else None),
+            content_type="text/plain",
+        )
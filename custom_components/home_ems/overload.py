@@ -0,0 +1,86 @@
+import logging
+import time
+from collections import deque
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_state_change_event
+from . import clock
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class OverloadGuard:
+
+    def __init__(self, hass, load_balancer):
+        self.hass = hass
+        self.load_balancer = load_balancer
+        self.power_net_id = load_balancer.enphase.power_net_id
+        self.irms_ids = load_balancer.linky.irms_ids
+        # entity_id -> monotonic time of the last shedding it triggered
+        self.last_shed = {}
+        # Inputs over their threshold with nothing left to shed (reported once)
+        self.unresolved = set()
+        self.events = deque(maxlen=CONF_OVERLOAD_EVENTS)
+        self.count = 0
+
+    def start(self):
+        # Not debounced and not waiting for the next tick
+        return async_track_state_change_event(self.hass, [ self.power_net_id ] + self.irms_ids, self.on_state_change)
+
+    @callback
+    def on_state_change(self, event):
+        entity_id = event.data.get("entity_id")
+        state = event.data.get("new_state")
+        try:
+            value = float(state.state)
+        except (AttributeError, TypeError, ValueError):
+            return
+        if entity_id == self.power_net_id:
+            if state.attributes.get("unit_of_measurement") == "kW":
+                value *= 1000
+            if value <= CONF_OVERLOAD_IMPORT:
+                self.unresolved.discard(entity_id)
+                return
+            excess = value - CONF_OVERLOAD_IMPORT + CONF_OVERLOAD_MARGIN
+            phases = 0x7
+        else:
+            if value <= CONF_MAX_CURRENT_PER_PHASE:
+                self.unresolved.discard(entity_id)
+                return
+            excess = (value - CONF_MAX_CURRENT_PER_PHASE) * CONF_PHASE_VOLTAGE + CONF_OVERLOAD_MARGIN
+            phases = 1 << self.irms_ids.index(entity_id)
+        # Leave time for the previous shedding to show on the same input
+        last = self.last_shed.get(entity_id)
+        if last is not None and clock.monotonic() - last < CONF_OVERLOAD_HOLDOFF:
+            return
+        self.shed(entity_id, value, excess, phases)
+
+    def shed(self, entity_id, value, excess, phases):
+        start = time.perf_counter()
+        actions = self.load_balancer.shed(excess, phases)
+        duration = time.perf_counter() - start
+        # Holdoff and report once per input, whether or not anything was shed
+        self.last_shed[entity_id] = clock.monotonic()
+        if len(actions) == 0:
+            if entity_id in self.unresolved:
+                return
+            self.unresolved.add(entity_id)
+        else:
+            self.unresolved.discard(entity_id)
+        self.count += 1
+        record = {
+            "time": clock.now().isoformat(timespec="seconds"),
+            "trigger": entity_id,
+            "value": value,
+            "excess": round(excess),
+            "actions": actions,
+            "duration_ms": round(duration * 1000, 1),
+        }
+        self.events.append(record)
+        _LOGGER.warning(f"[overload] {entity_id}={value} => {', '.join(actions) if len(actions) > 0 else 'nothing to shed'}")
+        self.hass.bus.async_fire(f"{CONF_ENTITY_ID}_overload", record)
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "last": self.events[-1] if len(self.events) > 0 else None,
+        }
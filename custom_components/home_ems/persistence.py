@@ -0,0 +1,53 @@
+import logging
+from homeassistant.helpers.storage import Store
+from . import clock
+from .utils import get_entity_id_from_unique_id, get_local_switch
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class StateStore:
+
+    def __init__(self, hass, load_balancer):
+        self.hass = hass
+        self.load_balancer = load_balancer
+        self.store = Store(hass, CONF_STATE_VERSION, f"{DOMAIN}.state")
+        # Last state handed to the store
+        self.last = None
+        self.saves = 0
+        self.restored = None
+
+    async def async_restore(self):
+        # Saved state, with the request switches (not restored by HA) set back
+        data = await self.store.async_load()
+        if data is None:
+            return None
+        age = clock.now().timestamp() - data["saved_at"]
+        if age > CONF_STATE_MAX_AGE:
+            _LOGGER.info(f"[state] saved {age:.0f}s ago, too old => cold start")
+            return None
+        for name, value in data["switches"].items():
+            if get_local_switch(self.hass, name) == value:
+                continue
+            entity_id = get_entity_id_from_unique_id(self.hass, "switch", f"{CONF_ENTITY_ID}_{name}")
+            await self.hass.services.async_call("switch", f"turn_{'on' if value else 'off'}", { "entity_id": entity_id }, blocking=True)
+        _LOGGER.info(f"[state] restoring the state saved {age:.0f}s ago")
+        self.restored = round(age)
+        self.last = { key: value for key, value in data.items() if key != "saved_at" }
+        return data
+
+    def on_change(self):
+        # Called after each run: cheap when nothing changed, writes are
+        # delayed and merged by the store
+        data = self.load_balancer.save_state()
+        if data == self.last:
+            return
+        self.last = data
+        self.saves += 1
+        self.store.async_delay_save(lambda: { **data, "saved_at": clock.now().timestamp() }, CONF_STATE_SAVE_DELAY)
+
+    def stats(self):
+        return {
+            "restored_age": self.restored,
+            "changes": self.saves,
+        }
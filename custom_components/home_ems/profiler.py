@@ -0,0 +1,180 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tracemalloc
+import types
+from . import clock
+from .utils import set_local_switch
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+@types.coroutine
+def profiled(coro, profile):
+    # Drive the coroutine step by step: only its own steps are profiled,
+    # not what the event loop runs while it waits
+    value = None
+    error = None
+    while True:
+        profile.enable()
+        try:
+            if error is not None:
+                awaited = coro.throw(error)
+            else:
+                awaited = coro.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.disable()
+        try:
+            value = yield awaited
+            error = None
+        except BaseException as err:
+            value = None
+            error = err
+
+class Profiler:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.profile = None
+        self.ticks_left = 0
+        self.ticks = 0
+        self.tasks = set()
+        self.started_tracemalloc = False
+        self.before = None
+        # Traceback -> [size, count] allocated by the sampled ticks
+        self.allocations = {}
+        self.finishing = False
+
+    def is_active(self):
+        return self.profile is not None and not self.finishing
+
+    def start(self, ticks=CONF_PROFILING_TICKS):
+        if self.profile is not None:
+            return
+        _LOGGER.warning(f"[profiler] profiling the next {ticks} ticks")
+        self.profile = cProfile.Profile()
+        self.ticks_left = ticks
+        self.ticks = 0
+        self.tasks = set()
+        self.finishing = False
+        self.allocations = {}
+
+    def stop(self):
+        # Switch turned off: write what was captured so far
+        if self.is_active():
+            self.finish()
+
+    def enable(self):
+        if not self.is_active():
+            return False
+        try:
+            self.profile.enable()
+        except ValueError as err:
+            # Another profiler is running (profiler integration...)
+            _LOGGER.error(f"[profiler] cannot profile: {err}")
+            self.abort()
+            return False
+        self.start_tracemalloc()
+        return True
+
+    def disable(self):
+        self.profile.disable()
+        self.stop_tracemalloc()
+        self.ticks += 1
+        self.ticks_left -= 1
+        if self.ticks_left <= 0:
+            self.finish()
+
+    def filters(self):
+        # Other integrations may run meanwhile: only what Home-EMS code allocated
+        return [
+            tracemalloc.Filter(True, os.path.join(os.path.dirname(__file__), "*"), all_frames=True),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+    def start_tracemalloc(self):
+        # Traced during the tick only, not the process in between
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start(CONF_PROFILING_FRAMES)
+            self.before = None
+        else:
+            # Traced by someone else: keep what the tick adds
+            self.before = tracemalloc.take_snapshot().filter_traces(self.filters())
+
+    def stop_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.filters())
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        if self.before is None:
+            stats = [ (stat.traceback, stat.size, stat.count) for stat in snapshot.statistics("lineno") ]
+        else:
+            stats = [ (stat.traceback, stat.size_diff, stat.count_diff) for stat in snapshot.compare_to(self.before, "lineno") ]
+            self.before = None
+        for traceback, size, count in stats:
+            if size > 0:
+                allocation = self.allocations.setdefault(traceback, [0, 0])
+                allocation[0] += size
+                allocation[1] += count
+
+    def wrap(self, coro):
+        # Service calls spawned by the profiled ticks
+        if not self.is_active():
+            return coro
+        async def task():
+            return await profiled(coro, self.profile)
+        return task()
+
+    def track(self, task):
+        if self.is_active():
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def finish(self):
+        self.finishing = True
+        self.hass.async_create_task(self.async_finish())
+
+    async def async_finish(self):
+        # Wait for the service calls of the last ticks
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
+        report = self.report()
+        path = self.hass.config.path(f"{CONF_ENTITY_ID}_profile_{clock.now().strftime('%Y%m%d_%H%M%S')}.txt")
+        await self.hass.async_add_executor_job(self.write, path, report)
+        _LOGGER.warning(f"[profiler] {self.ticks} ticks profiled => {path}")
+        self.abort()
+        set_local_switch(self.hass, "profiling", False)
+
+    def abort(self):
+        self.profile = None
+        self.tasks = set()
+        self.before = None
+        self.allocations = {}
+        self.finishing = False
+        if self.started_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.started_tracemalloc = False
+
+    def report(self):
+        out = io.StringIO()
+        out.write(f"Home-EMS profile of {self.ticks} ticks and their service calls\n\n")
+        out.write("=== Time (cumulative) ===\n")
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(CONF_PROFILING_TOP)
+        out.write("=== Allocations (still allocated at the end of each tick, summed, by line, reached from Home-EMS) ===\n")
+        allocations = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)
+        for traceback, (size, count) in allocations[:CONF_PROFILING_TOP]:
+            out.write(f"{traceback}: size={size / 1024:.1f} KiB, count={count}\n")
+        return out.getvalue()
+
+    def write(self, path, report):
+        with open(path, "w") as file:
+            file.write(report)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.event import async_track_state_change_event
+from .clock import monotonic
+from .utils import config_snapshot, get_state
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+def is_available(state):
+    return state is not None and state.state not in ("unavailable", "unknown")
+
+class Readiness:
+
+    def __init__(self, hass, entry, load_balancer):
+        self.hass = hass
+        self.entry = entry
+        self.load_balancer = load_balancer
+        self.ready = False
+        self.waited = None
+        self.missing = []
+
+    def internal_entities(self):
+        # Switches and select: their state is written once restored
+        ent_reg = er.async_get(self.hass)
+        return [
+            entry.entity_id
+            for entry in er.async_entries_for_config_entry(ent_reg, self.entry.entry_id)
+            if entry.domain in ("switch", "select")
+        ]
+
+    async def async_wait(self, timeout=CONF_READINESS_TIMEOUT):
+        start = monotonic()
+        deadline = start + timeout
+        # External entity ids depend on the Development switch
+        missing = await self.async_wait_for(self.internal_entities(), deadline)
+        if len(missing) == 0:
+            entities = self.load_balancer.get_required_entities(config_snapshot(self.hass))
+            missing = await self.async_wait_for(entities, deadline)
+        self.waited = round(monotonic() - start, 1)
+        self.missing = sorted(missing)
+        self.ready = len(missing) == 0
+        if self.ready:
+            _LOGGER.info(f"[readiness] ready after {self.waited}s")
+        else:
+            _LOGGER.warning(f"[readiness] still missing after {self.waited}s, starting anyway: {', '.join(self.missing)}")
+        return self.ready
+
+    async def async_wait_for(self, entities, deadline):
+        # Returns the entities still unavailable at the deadline
+        missing = { entity_id for entity_id in entities if not is_available(get_state(self.hass, entity_id)) }
+        if len(missing) == 0:
+            return missing
+        _LOGGER.info(f"[readiness] waiting for {', '.join(sorted(missing))}")
+        ready = self.hass.loop.create_future()
+
+        @callback
+        def on_state_change(event):
+            if is_available(event.data.get("new_state")):
+                missing.discard(event.data.get("entity_id"))
+            if len(missing) == 0 and not ready.done():
+                ready.set_result(True)
+
+        unsub = async_track_state_change_event(self.hass, list(missing), on_state_change)
+        try:
+            await asyncio.wait_for(ready, max(deadline - monotonic(), 0))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            unsub()
+        return missing
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "waited": self.waited,
+            "missing": self.missing,
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.event import async_track_state_change_event, async_track_time_interval, async_call_later
+from .clock import monotonic
+from .utils import config_dev, state_store
+from .readiness import Readiness
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class Scheduler:
+    # Owned by the config entry: everything it starts is stopped on unload.
+    # At most one run in flight, requests during a run are merged into one.
+
+    def __init__(self, hass, entry, load_balancer):
+        self.hass = hass
+        self.entry = entry
+        self.load_balancer = load_balancer
+        self.unsubs = []
+        self.debounce_unsub = None
+        self.deadline_unsub = None
+        # Monotonic times the pending timers were set for (drift)
+        self.debounce_target = None
+        self.deadline_target = None
+        self.heartbeat_target = None
+        self.readiness = Readiness(hass, entry, load_balancer)
+        self.lock = asyncio.Lock()
+        self.start_task = None
+        self.task = None
+        self.pending = False
+        self.pending_target = None
+        self.stopped = False
+        self.runs = 0
+        self.coalesced = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = None
+
+    def watched_entities(self):
+        entities = self.load_balancer.get_watched_entities()
+        # Internal config switches and select
+        ent_reg = er.async_get(self.hass)
+        for entry in er.async_entries_for_config_entry(ent_reg, self.entry.entry_id):
+            if entry.domain in ("switch", "select"):
+                entities.append(entry.entity_id)
+        return entities
+
+    def start(self):
+        self.entry.async_on_unload(self.stop)
+        self.start_task = self.entry.async_create_background_task(self.hass, self.async_start(), f"{DOMAIN} scheduler")
+
+    async def async_start(self):
+        # Start as soon as the inputs are there, not on a fixed delay
+        await self.readiness.async_wait()
+        store = state_store(self.hass)
+        restored = await store.async_restore() if store is not None else None
+        self.load_balancer.late_init(restored)
+        if not CONF_SCHEDULER_EVENT_DRIVEN:
+            await self.async_loop()
+            return
+        # Run on input changes and device timers, with a low-rate heartbeat
+        entities = self.watched_entities()
+        _LOGGER.info(f"[scheduler] event driven, watching {len(entities)} entities")
+        self.unsubs.append(async_track_state_change_event(self.hass, entities, self.on_state_change))
+        self.unsubs.append(async_track_time_interval(self.hass, self.on_heartbeat, timedelta(seconds=CONF_SCHEDULER_HEARTBEAT)))
+        self.heartbeat_target = monotonic() + CONF_SCHEDULER_HEARTBEAT
+        self.request_run()
+
+    async def async_loop(self):
+        # Fixed period, aligned on the monotonic clock: a slow run does not
+        # shift the next ticks, the ticks it overlapped are skipped. The
+        # first run is right away
+        period = self.period()
+        target = monotonic()
+        while not self.stopped:
+            await asyncio.sleep(max(target - monotonic(), 0))
+            await self.async_run(target)
+            period = self.period()
+            target += period
+            now = monotonic()
+            if now > target:
+                missed = int((now - target) // period) + 1
+                self.skipped += missed
+                _LOGGER.warning(f"[scheduler] run overran the period of {period}s, skip {missed} tick(s)")
+                target += missed * period
+
+    def period(self):
+        return CONF_SCHEDULER_PERIOD if not config_dev(self.hass) == True else CONF_SCHEDULER_PERIOD_DEV
+
+    @callback
+    def stop(self):
+        self.stopped = True
+        for unsub in self.unsubs:
+            unsub()
+        self.unsubs = []
+        if self.debounce_unsub is not None:
+            self.debounce_unsub()
+            self.debounce_unsub = None
+        if self.deadline_unsub is not None:
+            self.deadline_unsub()
+            self.deadline_unsub = None
+        for task in (self.start_task, self.task):
+            if task is not None:
+                task.cancel()
+        self.start_task = None
+        self.task = None
+
+    #
+    # Triggers
+    #
+
+    @callback
+    def on_state_change(self, event):
+        # Debounce: several inputs usually change together (1min and 5min
+        # power, connector status and offered power...)
+        if self.debounce_unsub is None:
+            self.debounce_target = monotonic() + CONF_SCHEDULER_DEBOUNCE
+            self.debounce_unsub = async_call_later(self.hass, CONF_SCHEDULER_DEBOUNCE, self.on_debounced)
+
+    @callback
+    def on_debounced(self, now):
+        self.debounce_unsub = None
+        self.request_run(self.debounce_target)
+
+    @callback
+    def on_heartbeat(self, now):
+        target = self.heartbeat_target
+        self.heartbeat_target = monotonic() + CONF_SCHEDULER_HEARTBEAT
+        self.request_run(target)
+
+    @callback
+    def on_deadline(self, now):
+        self.deadline_unsub = None
+        self.request_run(self.deadline_target)
+
+    @callback
+    def request_run(self, target=None):
+        if self.stopped:
+            return
+        if self.task is not None:
+            # A run is in flight or queued: one more run after it covers both
+            self.coalesced += 1
+            if not self.pending:
+                self.pending = True
+                self.pending_target = target
+            return
+        self.task = self.entry.async_create_background_task(self.hass, self.async_request(target), f"{DOMAIN} run")
+
+    async def async_request(self, target):
+        try:
+            await self.async_run(target)
+            while self.pending and not self.stopped:
+                self.pending = False
+                await self.async_run(self.pending_target)
+        finally:
+            self.task = None
+        self.schedule_deadline()
+
+    #
+    # Run
+    #
+
+    async def async_run(self, target=None):
+        async with self.lock:
+            start = time.perf_counter()
+            await self.load_balancer.run(self.hass, target)
+            self.last_duration = time.perf_counter() - start
+            self.runs += 1
+            if self.last_duration > CONF_SCHEDULER_OVERRUN:
+                self.overruns += 1
+                _LOGGER.warning(f"[scheduler] run took {self.last_duration:.3f}s (> {CONF_SCHEDULER_OVERRUN}s)")
+
+    def schedule_deadline(self):
+        if self.deadline_unsub is not None:
+            self.deadline_unsub()
+            self.deadline_unsub = None
+        if self.stopped or not CONF_SCHEDULER_EVENT_DRIVEN:
+            return
+        deadline = self.load_balancer.next_deadline()
+        if deadline is None:
+            return
+        delay = max(deadline - monotonic(), 0)
+        self.deadline_target = monotonic() + delay
+        self.deadline_unsub = async_call_later(self.hass, delay, self.on_deadline)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "last_duration_ms": round(self.last_duration * 1000, 2) if self.last_duration is not None else None,
+            "readiness": self.readiness.stats(),
+        }
@@ -1,5 +1,6 @@
 import logging
-from homeassistant.components.sensor import SensorEntity
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.const import EntityCategory
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
 from datetime import timedelta, datetime
@@ -16,12 +17,27 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry, asyn
 
     # Create the sensor entity
     sensor = HomeEMSSensor(hass, config_entry, name, entity_id, load_balancer)
-    async_add_entities([sensor])
+    metrics = hass.data[DOMAIN]["metrics"]
+    async_add_entities([
+        sensor,
+        MetricSensor(entity_id, "Tick duration", "tick_duration", "ms", metrics.tick_duration_ms),
+        MetricSensor(entity_id, "Tick drift", "tick_drift", "ms", metrics.tick_drift_ms),
+        MetricSensor(entity_id, "State reads per tick", "states_get_per_tick", None, lambda: metrics.per_tick(1)),
+        MetricSensor(entity_id, "Registry lookups per tick", "registry_lookups_per_tick", None, lambda: metrics.per_tick(2)),
+        MetricSensor(entity_id, "Service calls per tick", "service_calls_per_tick", None, lambda: metrics.per_tick(3)),
+    ])
 
 
 class HomeEMSSensor(SensorEntity):
     """Representation of a Home EMS Sensor."""
 
+    # Diagnostics change on every update: kept out of the recorder
+    _unrecorded_attributes = frozenset({
+        "entity_cache", "commands", "service_calls", "power", "forecast",
+        "allocator", "ev_profiles", "phases", "freshness", "overload",
+        "trace", "state", "scheduler", "metrics",
+    })
+
     def __init__(self, hass, config_entry, name, entity_id, load_balancer):
         self.hass = hass
         self.config_entry = config_entry
@@ -40,5 +56,45 @@ class HomeEMSSensor(SensorEntity):
         """Return the icon to use in the frontend."""
         return "mdi:transmission-tower"
 
+    @property
+    def extra_state_attributes(self):
+        """Return diagnostic attributes."""
+        aggregator = self.hass.data[DOMAIN]["power_aggregator"]
+        overload_guard = self.hass.data[DOMAIN]["overload_guard"]
+        return {
+            "entity_cache": self.hass.data[DOMAIN]["entity_cache"].stats(),
+            "commands": self.hass.data[DOMAIN]["command_bus"].stats(),
+            "service_calls": self.hass.data[DOMAIN]["command_bus"].executor.stats(),
+            "power": aggregator.stats() if aggregator is not None else None,
+            "forecast": self.load_balancer.forecaster.stats() if self.load_balancer.forecaster is not None else None,
+            "allocator": self.load_balancer.allocator.stats(),
+            "ev_profiles": self.load_balancer.evcharger.profile_stats(),
+            "phases": self.load_balancer.ledger.stats(),
+            "freshness": { "degraded": self.load_balancer.degraded, "stale": self.load_balancer.stale },
+            "overload": overload_guard.stats() if overload_guard is not None else None,
+            "trace": self.load_balancer.trace.stats(),
+            "state": self.hass.data[DOMAIN]["state_store"].stats(),
+            "scheduler": self.hass.data[DOMAIN]["scheduler"].stats() if "scheduler" in self.hass.data[DOMAIN] else None,
+            "metrics": self.hass.data[DOMAIN]["metrics"].stats()
+        }
+
     async def async_update(self):
         """Fetch new state data for the sensor asynchronously."""
+
+
+class MetricSensor(SensorEntity):
+    """Diagnostic sensor: mean over the last ticks of one hot path metric."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_icon = "mdi:speedometer"
+
+    def __init__(self, entity_id, attr_name, key, unit, value):
+        self._attr_name = attr_name
+        self._attr_unique_id = f"{entity_id}_{key}"
+        self._attr_native_unit_of_measurement = unit
+        self.value = value
+
+    @property
+    def native_value(self):
+        return self.value()
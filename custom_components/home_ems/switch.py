@@ -13,6 +13,7 @@ async def async_setup_entry(hass, config_entry, async_add_entities):
         PersistentConfigSwitch(hass, entity_id, name, "LoadBalancer", "loadbalancer", EntityCategory.CONFIG),
         PersistentConfigSwitch(hass, entity_id, name, "Holidays", "holidays", EntityCategory.CONFIG),
         PersistentConfigSwitch(hass, entity_id, name, "Development", "dev", EntityCategory.CONFIG),
+        ProfilingSwitch(hass, entity_id, name, "Profiling", "profiling", EntityCategory.DIAGNOSTIC),
         ConfigSwitch(hass, entity_id, name, "EV Force", "ev_force"),
         ConfigSwitch(hass, entity_id, name, "EV Request", "ev_request"),
         ConfigSwitch(hass, entity_id, name, "EV HC", "ev_hc"),
@@ -60,3 +61,13 @@ class PersistentConfigSwitch(ConfigSwitch, RestoreEntity):
         last_state = await self.async_get_last_state()
         if last_state is not None:
             self._state = last_state.state == 'on'
+
+class ProfilingSwitch(ConfigSwitch):
+    # Profiles the next ticks, turned off once the report is written
+    async def async_turn_on(self, **kwargs):
+        self.hass.data[DOMAIN]["profiler"].start()
+        await super().async_turn_on(**kwargs)
+
+    async def async_turn_off(self, **kwargs):
+        self.hass.data[DOMAIN]["profiler"].stop()
+        await super().async_turn_off(**kwargs)
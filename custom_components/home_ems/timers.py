@@ -0,0 +1,40 @@
+from . import clock
+from .clock import monotonic
+
+class Timers:
+
+    def __init__(self):
+        # name -> monotonic deadline
+        self.deadlines = {}
+
+    def start(self, name, seconds):
+        self.deadlines[name] = monotonic() + seconds
+
+    def cancel(self, name):
+        self.deadlines.pop(name, None)
+
+    def is_started(self, name):
+        return name in self.deadlines
+
+    def is_running(self, name):
+        return name in self.deadlines and monotonic() < self.deadlines[name]
+
+    def expired(self, name):
+        return name in self.deadlines and monotonic() >= self.deadlines[name]
+
+    def next_deadline(self):
+        # Next timer to fire (None if nothing pending)
+        now = monotonic()
+        pending = [ deadline for deadline in self.deadlines.values() if deadline > now ]
+        return min(pending) if len(pending) > 0 else None
+
+    def save(self):
+        # Deadlines in wall clock time: monotonic times do not survive a restart
+        now = monotonic()
+        wall = clock.now().timestamp()
+        return { name: round(wall + deadline - now) for name, deadline in self.deadlines.items() }
+
+    def restore(self, saved):
+        now = monotonic()
+        wall = clock.now().timestamp()
+        self.deadlines = { name: now + deadline - wall for name, deadline in saved.items() }
@@ -0,0 +1,76 @@
+import logging
+import time
+from collections import deque
+from . import clock
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+class DecisionTrace:
+
+    def __init__(self):
+        self.records = deque(maxlen=CONF_TRACE_SIZE)
+        self.listeners = []
+        # Record of the tick in progress
+        self.record = None
+        self.start = 0
+        self.count = 0
+
+    def begin(self, trigger):
+        self.start = time.perf_counter()
+        self.record = {
+            "seq": self.count,
+            "time": clock.now().isoformat(timespec="seconds"),
+            "trigger": trigger,
+            "inputs": {},
+            "actions": [],
+        }
+
+    def inputs(self, **inputs):
+        if self.record is not None:
+            self.record["inputs"].update(inputs)
+
+    def action(self, device, stage, **details):
+        # Device that acted, with what it logged during the tick as reasons
+        if self.record is None:
+            return
+        self.record["actions"].append({
+            "device": device.short_name(),
+            "stage": stage,
+            "reasons": list(device.notes),
+            **details,
+        })
+
+    def notes(self, devices):
+        # Devices that only logged something (detection, failures...)
+        if self.record is None:
+            return
+        acted = { action["device"] for action in self.record["actions"] }
+        for device in devices:
+            if len(device.notes) > 0 and device.short_name() not in acted:
+                self.action(device, "info")
+
+    def end(self, commands):
+        record, self.record = self.record, None
+        if record is None:
+            return
+        record["commands"] = [ repr(command) for command in commands ]
+        record["duration_ms"] = round((time.perf_counter() - self.start) * 1000, 2)
+        self.records.append(record)
+        self.count += 1
+        for listener in list(self.listeners):
+            listener(record)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+        def unsubscribe():
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+        return unsubscribe
+
+    def stats(self):
+        return {
+            "ticks": self.count,
+            "subscribers": len(self.listeners),
+            "last": self.records[-1] if len(self.records) > 0 else None,
+        }
@@ -1,4 +1,5 @@
 import logging
+from dataclasses import dataclass, fields
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers import entity_registry as er
 from .const import *
@@ -9,6 +10,37 @@ _LOGGER = logging.getLogger(__name__)
 def loadbalancer_instance(hass):
     return hass.data[DOMAIN]["load_balancer"]
 
+def command_bus(hass):
+    return hass.data[DOMAIN].get("command_bus")
+
+def power_aggregator(hass):
+    return hass.data[DOMAIN].get("power_aggregator")
+
+def metrics(hass):
+    return hass.data[DOMAIN].get("metrics")
+
+def profiler(hass):
+    return hass.data[DOMAIN].get("profiler")
+
+def state_store(hass):
+    return hass.data[DOMAIN].get("state_store")
+
+def create_task(hass, coro):
+    # Tasks spawned while profiling are profiled too
+    active = profiler(hass)
+    if active is None or not active.is_active():
+        return hass.async_create_task(coro)
+    task = hass.async_create_task(active.wrap(coro))
+    active.track(task)
+    return task
+
+def get_state(hass, entity_id):
+    # State machine reads of the integration, counted per tick
+    counters = metrics(hass)
+    if counters is not None:
+        counters.states_get += 1
+    return hass.states.get(entity_id)
+
 def get_phase(phases):
     if phases & 0x1:
         return 0
@@ -18,28 +50,46 @@ def get_phase(phases):
         return 2
     return 0
 
+def get_phase_list(phases):
+    return [ phase for phase in range(3) if phases & (1 << phase) ]
+
 def get_entity_id_from_unique_id(hass, domain: str, unique_id: str) -> str | None:
+    cache = hass.data[DOMAIN].get("entity_cache")
+    if cache is not None:
+        return cache.get(domain, unique_id)
+    counters = metrics(hass)
+    if counters is not None:
+        counters.registry_lookups += 1
     ent_reg = er.async_get(hass)
     entry = ent_reg.async_get_entity_id(domain, DOMAIN, unique_id)
     return entry
     
 def get_local_switch(hass, name):
     entity_id = get_entity_id_from_unique_id(hass, "switch", f"{CONF_ENTITY_ID}_{name}")
-    value = hass.states.get(entity_id)
+    value = get_state(hass, entity_id)
     if value is not None:
         return value.state == "on"
     return False
 
 def get_local_select(hass, name):
     entity_id = get_entity_id_from_unique_id(hass, "select", f"{CONF_ENTITY_ID}_{name}")
-    value = hass.states.get(entity_id)
+    value = get_state(hass, entity_id)
     if value is not None:
         return value.state
     else:
         return "Unavailable"
 
-def call_async(hass, kind, method, data):
-    hass.async_create_task(
+def call_async(hass, kind, method, data, on_done=None):
+    # on_done(success) is called once the command is applied (or not needed)
+    bus = command_bus(hass)
+    if bus is not None:
+        bus.send(kind, method, data, on_done)
+        return
+    counters = metrics(hass)
+    if counters is not None:
+        counters.service_calls += 1
+    create_task(
+        hass,
         hass.services.async_call(
             kind,
             method,
@@ -123,3 +173,58 @@ def config_water_heater_forced(hass):
 def config_water_heater_set_forced(hass, value):
     set_local_switch(hass, "water_heater_force", value)
 
+#
+# Configuration snapshot: all switches and select read once per tick
+#
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    loadbalancer: bool
+    mode: str
+    dev: bool
+    holidays: bool
+    ev_force: bool
+    ev_request: bool
+    ev_hc: bool
+    ev_tri: bool
+    cro_force: bool
+    cro_request: bool
+    cro_hc: bool
+    pool_force: bool
+    water_heater_force: bool
+    water_heater_boost: bool
+
+    def is_hc_hp(self):
+        return self.mode == "HC/HP"
+
+# Switch of each field of the snapshot (same name), the mode is a select
+CONFIG_SWITCHES = [ field.name for field in fields(ConfigSnapshot) if field.name != "mode" ]
+
+def config_entity_ids(hass):
+    # Resolved again only after the entity cache was invalidated
+    cache = hass.data[DOMAIN].get("entity_cache")
+    key = cache.invalidations if cache is not None else None
+    saved = hass.data[DOMAIN].get("config_entity_ids")
+    if saved is not None and key is not None and saved[0] == key:
+        return saved[1]
+    entity_ids = [ get_entity_id_from_unique_id(hass, "switch", f"{CONF_ENTITY_ID}_{name}") for name in CONFIG_SWITCHES ]
+    entity_ids.append(get_entity_id_from_unique_id(hass, "select", f"{CONF_ENTITY_ID}_mode"))
+    if None not in entity_ids:
+        hass.data[DOMAIN]["config_entity_ids"] = (key, entity_ids)
+    return entity_ids
+
+def config_snapshot(hass):
+    # Rebuilt only when a switch or the select changed: the state machine
+    # replaces the state object on every change
+    entity_ids = config_entity_ids(hass)
+    counters = metrics(hass)
+    if counters is not None:
+        counters.states_get += len(entity_ids)
+    states = [ hass.states.get(entity_id) if entity_id is not None else None for entity_id in entity_ids ]
+    saved = hass.data[DOMAIN].get("config_snapshot")
+    if saved is not None and all(state is previous for state, previous in zip(states, saved[0])):
+        return saved[1]
+    switches = { name: state is not None and state.state == "on" for name, state in zip(CONFIG_SWITCHES, states) }
+    snapshot = ConfigSnapshot(mode=states[-1].state if states[-1] is not None else "Unavailable", **switches)
+    hass.data[DOMAIN]["config_snapshot"] = (states, snapshot)
+    return snapshot
@@ -0,0 +1,28 @@
+import logging
+import voluptuous as vol
+from homeassistant.components import websocket_api
+from homeassistant.core import HomeAssistant, callback
+from .const import *
+
+_LOGGER = logging.getLogger(__name__)
+
+@callback
+def async_register_websocket(hass: HomeAssistant):
+    websocket_api.async_register_command(hass, ws_subscribe_trace)
+
+@websocket_api.websocket_command({ vol.Required("type"): f"{DOMAIN}/trace/subscribe" })
+@callback
+def ws_subscribe_trace(hass, connection, msg):
+    """Send the decision trace kept in memory, then every new tick."""
+    load_balancer = hass.data[DOMAIN]["load_balancer"]
+    if load_balancer is None:
+        connection.send_error(msg["id"], "not_loaded", "Home EMS is not loaded")
+        return
+    trace = load_balancer.trace
+
+    @callback
+    def forward(record):
+        connection.send_message(websocket_api.event_message(msg["id"], record))
+
+    connection.subscriptions[msg["id"]] = trace.subscribe(forward)
+    connection.send_result(msg["id"], list(trace.records))
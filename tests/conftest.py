@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tools"))
+
+from datetime import datetime
+import pytest
+from fake_hass import VirtualClock
+from custom_components.home_ems import clock as home_ems_clock
+
+@pytest.fixture
+def clock():
+    # Virtual time for the timers and windows, the system clock is put back
+    virtual = VirtualClock(datetime(2024, 6, 21, 12, 0))
+    home_ems_clock.set_clock(virtual)
+    yield virtual
+    home_ems_clock.set_clock(home_ems_clock.SystemClock())
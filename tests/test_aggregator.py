@@ -0,0 +1,86 @@
+import math
+from custom_components.home_ems.aggregator import PowerAggregator, Window
+from custom_components.home_ems.const import *
+
+def center(value):
+    # Center of the percentile bucket holding value
+    return (value + CONF_AGGREGATOR_RANGE) // CONF_AGGREGATOR_BUCKET * CONF_AGGREGATOR_BUCKET - CONF_AGGREGATOR_RANGE + CONF_AGGREGATOR_BUCKET / 2
+
+def test_window_stats():
+    window = Window(60, 16)
+    for t, value in enumerate([ 100, -300, 500, 200, 0 ]):
+        window.add(t, value)
+    assert window.mean() == 100
+    assert window.minimum() == -300
+    assert window.maximum() == 500
+    assert window.percentile(50) == center(100)
+    assert window.percentile(0) == center(-300)
+    assert window.percentile(100) == center(500)
+    assert window.span(10) == 10
+
+def test_window_percentiles_match_sorted_samples():
+    window = Window(1000, 1024)
+    values = [ (i * 7919) % 4000 - 2000 for i in range(500) ]
+    for t, value in enumerate(values):
+        window.add(t, value)
+    ranked = sorted(values)
+    for q in (5, 25, 50, 75, 95):
+        assert window.percentile(q) == center(ranked[int(q / 100 * (len(values) - 1))])
+
+def test_window_eviction_by_age():
+    window = Window(60, 16)
+    window.add(0, 1000)
+    window.add(30, 10)
+    window.add(60, 20)
+    # The sample of t=0 is out of the window
+    assert window.count == 2
+    assert window.maximum() == 20
+    assert window.mean() == 15
+    window.expire(200)
+    assert window.count == 0
+    assert window.mean() is None
+    assert window.percentile(50) is None
+
+def test_window_eviction_by_capacity():
+    window = Window(1000, 4)
+    for t, value in enumerate([ -500, 1, 2, 3, 4 ]):
+        window.add(t, value)
+    assert window.count == 4
+    assert window.minimum() == 1
+    assert window.mean() == 2.5
+
+def test_window_clamps_the_histogram():
+    window = Window(60, 16)
+    window.add(0, 10 * CONF_AGGREGATOR_RANGE)
+    window.add(1, -10 * CONF_AGGREGATOR_RANGE)
+    assert window.percentile(100) == center(CONF_AGGREGATOR_RANGE)
+    assert window.percentile(0) == center(-CONF_AGGREGATOR_RANGE)
+    # The extremes are exact
+    assert window.maximum() == 10 * CONF_AGGREGATOR_RANGE
+
+def test_ewma(clock):
+    aggregator = PowerAggregator("sensor.power")
+    aggregator.add(0)
+    assert aggregator.get_ewma() == 0
+    clock.advance(CONF_AGGREGATOR_EWMA_TAU)
+    aggregator.add(1000)
+    assert math.isclose(aggregator.get_ewma(), 1000 * (1 - math.exp(-1)))
+    # A sample right after moves it by almost nothing
+    before = aggregator.get_ewma()
+    clock.advance(0.01)
+    aggregator.add(-5000)
+    assert before - aggregator.get_ewma() < 5
+
+def test_held_samples_and_readiness(clock):
+    aggregator = PowerAggregator("sensor.power")
+    aggregator.add(500)
+    assert not aggregator.is_ready(CONF_AGGREGATOR_FAST_WINDOW)
+    clock.advance(CONF_AGGREGATOR_FAST_WINDOW / 2)
+    # Stable power: the last sample is repeated every CONF_AGGREGATOR_HOLD
+    aggregator.refresh()
+    assert aggregator.windows[CONF_AGGREGATOR_FAST_WINDOW].count == CONF_AGGREGATOR_FAST_WINDOW // 2 // CONF_AGGREGATOR_HOLD + 1
+    assert aggregator.get_ewma() == 500
+    # The sensor stopped reporting: back to the averages
+    clock.advance(CONF_AGGREGATOR_MAX_AGE)
+    aggregator.refresh()
+    assert not aggregator.is_ready(CONF_AGGREGATOR_FAST_WINDOW)
@@ -0,0 +1,94 @@
+from custom_components.home_ems.allocator import Allocator, Demand
+from custom_components.home_ems.const import *
+
+HEADROOM = [ CONF_MAX_CURRENT_PER_PHASE * CONF_PHASE_VOLTAGE ] * 3
+
+class Load:
+
+    def __init__(self, consumed=0, phases=0b001):
+        self.consumed = consumed
+        self.phases = phases
+
+    def get_phases(self):
+        return self.phases
+
+    def get_consumed_power(self):
+        return self.consumed
+
+def cro(current=0, **kwargs):
+    return Demand(Load(current), CONF_CRO_PRIORITY, CONF_CRO_POWER, CONF_CRO_POWER, current=current,
+                  keep_power=CONF_CRO_POWER - CONF_CRO_MIN_DELTA, **kwargs)
+
+def water_heater(current=0):
+    return Demand(Load(current), CONF_WATER_HEATER_PRIORITY, 2000, 2000, current=current)
+
+def ev(current=0, phases=0b001):
+    return Demand(Load(current, phases), CONF_EV_CHARGER_PRIORITY, CONF_EV_CHARGER_MIN_POWER_MONO, CONF_MAX_POWER_PER_PHASE,
+                  current=current, continuous=True)
+
+def test_preemption_by_a_higher_priority():
+    allocator = Allocator()
+    running, waiting = cro(CONF_CRO_POWER), water_heater()
+    allocation = allocator.allocate([ running, waiting ], 2300, 2300, HEADROOM)
+    # Room for one of them: the water heater is worth the two switches
+    assert allocation == { running.device: 0, waiting.device: 2000 }
+    assert allocator.preemptions == 1
+
+def test_no_preemption_for_less_than_the_switch_cost():
+    allocator = Allocator()
+    running, waiting = water_heater(2000), cro()
+    allocation = allocator.allocate([ running, waiting ], 2300, 2300, HEADROOM)
+    assert allocation == { running.device: 2000, waiting.device: 0 }
+    assert allocator.preemptions == 0
+
+def test_running_load_tolerates_a_small_deficit():
+    allocator = Allocator()
+    running = cro(CONF_CRO_POWER)
+    # Down to keep_power: kept running
+    budget = CONF_CRO_POWER - CONF_CRO_MIN_DELTA
+    assert allocator.allocate([ running ], budget, budget, HEADROOM) == { running.device: CONF_CRO_POWER }
+    assert allocator.allocate([ running ], budget - 1, budget - 1, HEADROOM) == { running.device: 0 }
+    # Not running: the same budget does not start it
+    stopped = cro()
+    assert allocator.allocate([ stopped ], budget, budget, HEADROOM) == { stopped.device: 0 }
+
+def test_start_needs_the_forecast_too():
+    allocator = Allocator()
+    stopped = cro()
+    assert allocator.allocate([ stopped ], CONF_CRO_POWER, CONF_CRO_POWER - 1, HEADROOM) == { stopped.device: 0 }
+    assert allocator.allocate([ stopped ], CONF_CRO_POWER, CONF_CRO_POWER, HEADROOM) == { stopped.device: CONF_CRO_POWER }
+
+def test_cannot_start_or_stop():
+    allocator = Allocator()
+    blocked = cro(can_start=False)
+    assert allocator.allocate([ blocked ], 10000, 10000, HEADROOM) == { blocked.device: 0 }
+    kept = cro(CONF_CRO_POWER, can_stop=False)
+    assert allocator.allocate([ kept ], 0, 0, HEADROOM) == { kept.device: CONF_CRO_POWER }
+
+def test_continuous_raise_follows_the_forecast():
+    allocator = Allocator()
+    charging = ev(2000)
+    # Only what the forecast expects to last is given
+    assert allocator.allocate([ charging ], 5000, 3000, HEADROOM) == { charging.device: 3000 }
+    assert allocator.allocate([ charging ], 5000, 8000, HEADROOM) == { charging.device: 5000 }
+    # A drop is not held back by the forecast
+    assert allocator.allocate([ charging ], 1800, 8000, HEADROOM) == { charging.device: 1800 }
+
+def test_continuous_load_capped_by_its_phases():
+    allocator = Allocator()
+    charging = ev(2000, phases=0b111)
+    headroom = [ 3000, 1000, 3000 ]
+    assert allocator.allocate([ charging ], 10000, 10000, headroom) == { charging.device: 3000 }
+    # Not even its min power left on a phase: stopped
+    assert allocator.allocate([ charging ], 10000, 10000, [ 3000, 400, 3000 ]) == { charging.device: 0 }
+
+def test_minimum():
+    allocator = Allocator()
+    charging, running, kept, stopped = ev(4000), cro(CONF_CRO_POWER), cro(CONF_CRO_POWER, can_stop=False), water_heater()
+    allocation = allocator.minimum([ charging, running, kept, stopped ])
+    assert allocation == {
+        charging.device: CONF_EV_CHARGER_MIN_POWER_MONO,
+        running.device: 0,
+        kept.device: CONF_CRO_POWER,
+        stopped.device: 0,
+    }
@@ -0,0 +1,70 @@
+import asyncio
+from fake_hass import FakeHass
+from custom_components.home_ems.command_bus import CommandBus
+from custom_components.home_ems.const import DOMAIN
+
+CRO = "switch.cro"
+
+async def slow_bus():
+    hass = FakeHass()
+    hass.data[DOMAIN] = {}
+    hass.states.set(CRO, "off")
+    release = asyncio.Event()
+
+    async def async_call(domain, service, data, blocking=False):
+        hass.services.calls.append((None, domain, service, data))
+        if service == "turn_on":
+            await release.wait()
+        hass.states.set(data["entity_id"], service[5:])
+
+    hass.services.async_call = async_call
+    return hass, CommandBus(hass), release
+
+def test_turn_off_while_turn_on_pending():
+    async def run():
+        hass, bus, release = await slow_bus()
+        bus.send("switch", "turn_on", { "entity_id": CRO })
+        bus.flush()
+        await asyncio.sleep(0)
+        # The state machine still says "off": not a no-op
+        bus.send("switch", "turn_off", { "entity_id": CRO })
+        assert len(bus.flush()) == 1
+        release.set()
+        await hass.async_block_till_done()
+        return hass, bus
+    hass, bus = asyncio.run(run())
+    assert [ call[2] for call in hass.services.calls ] == [ "turn_on", "turn_off" ]
+    assert hass.states.get(CRO).state == "off"
+    assert bus.stats() == { "issued": 2, "suppressed": 0, "coalesced": 0 }
+
+def test_same_write_in_flight_is_suppressed():
+    async def run():
+        hass, bus, release = await slow_bus()
+        results = []
+        bus.send("switch", "turn_on", { "entity_id": CRO }, results.append)
+        bus.flush()
+        await asyncio.sleep(0)
+        bus.send("switch", "turn_on", { "entity_id": CRO }, results.append)
+        assert bus.flush() == []
+        assert results == []
+        release.set()
+        await hass.async_block_till_done()
+        assert bus.inflight == {}
+        return results, bus
+    results, bus = asyncio.run(run())
+    # Both report the outcome of the call actually sent
+    assert results == [ True, True ]
+    assert bus.stats() == { "issued": 1, "suppressed": 1, "coalesced": 0 }
+
+def test_noop_against_state_once_completed():
+    async def run():
+        hass, bus, release = await slow_bus()
+        release.set()
+        bus.send("switch", "turn_on", { "entity_id": CRO })
+        bus.flush()
+        await hass.async_block_till_done()
+        bus.send("switch", "turn_on", { "entity_id": CRO })
+        assert bus.flush() == []
+        return bus
+    bus = asyncio.run(run())
+    assert bus.stats() == { "issued": 1, "suppressed": 1, "coalesced": 0 }
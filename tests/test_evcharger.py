@@ -0,0 +1,141 @@
+import asyncio
+from fake_hass import FakeHass
+from custom_components.home_ems.const import *
+from custom_components.home_ems.devices.evcharger import CONNECTOR_TRANSITIONS, EVCharger
+from custom_components.home_ems.utils import command_bus, config_snapshot
+
+def with_charger(clock, test):
+    # test(hass, charger) on a fresh Home-EMS, on a running loop
+    async def run():
+        hass = FakeHass(clock)
+        hass.add_local_entities({ "loadbalancer": True })
+        hass.add_home_entities()
+        load_balancer = hass.setup_home_ems()
+        load_balancer.late_init()
+        # Past the interval of the profile sent on startup
+        clock.advance(CONF_EV_CHARGER_PROFILE_INTERVAL)
+        charger = load_balancer.evcharger
+        charger.start_tick(config_snapshot(hass))
+        await test(hass, charger)
+    asyncio.run(run())
+
+def record_actions(charger):
+    actions = []
+    for action in { action for entry in CONNECTOR_TRANSITIONS.values() for action in entry }:
+        setattr(charger, f"enter_{action}", lambda action=action: actions.append(action))
+    return actions
+
+def test_every_transition_action_exists():
+    for entry in CONNECTOR_TRANSITIONS.values():
+        for action in entry:
+            assert callable(getattr(EVCharger, f"enter_{action}", None)), action
+
+def test_transition_table(clock):
+    async def test(hass, charger):
+        charger.connector = None
+        actions = record_actions(charger)
+        for status, expected in [
+            ("Available", [ "unplugged", "cancel_full_timer" ]),
+            # From Available: plugged, the generic entry does not apply
+            ("Preparing", [ "plugged", "auto_request" ]),
+            ("Charging", [ "cancel_full_timer" ]),
+            ("SuspendedEV", [ "full_timer" ]),
+            # Back to Preparing during a session
+            ("Preparing", [ "auto_request", "start_transaction", "cancel_full_timer" ]),
+            ("Faulted", [ "fault_reset", "cancel_full_timer" ]),
+            ("SuspendedEVSE", [ "auto_request", "cancel_full_timer" ]),
+            ("Available", [ "unplugged", "cancel_full_timer" ]),
+            ("SuspendedEVSE", [ "plugged", "auto_request" ]),
+        ]:
+            actions.clear()
+            assert charger.set_connector(status)
+            assert actions == expected, status
+        # Same status: no transition
+        actions.clear()
+        assert not charger.set_connector("SuspendedEVSE")
+        assert actions == []
+    with_charger(clock, test)
+
+def test_plug_requests_and_unplug_clears(clock):
+    async def test(hass, charger):
+        charger.set_connector("Available")
+        charger.set_connector("Preparing")
+        assert charger.requested
+        command_bus(hass).flush()
+        await hass.async_block_till_done()
+        assert hass.states.get(f"switch.{CONF_ENTITY_ID}_ev_request").state == "on"
+        charger.set_connector("Available")
+        assert not charger.requested
+        assert charger.can_auto_request
+    with_charger(clock, test)
+
+def test_full_timer_only_for_an_active_charge(clock):
+    async def test(hass, charger):
+        charger.set_connector("Charging")
+        charger.set_connector("SuspendedEV")
+        assert not charger.timers.is_started("suspend_ev_stop")
+        charger.active = True
+        charger.set_connector("Charging")
+        charger.set_connector("SuspendedEV")
+        assert charger.timers.is_running("suspend_ev_stop")
+        clock.advance(CONF_EV_CHARGER_FULL_DELAY * 60)
+        assert not charger.still_needed()
+        # The car resumed: not full
+        charger.set_connector("Charging")
+        assert not charger.timers.is_started("suspend_ev_stop")
+    with_charger(clock, test)
+
+def test_deferred_raise(clock):
+    async def test(hass, charger):
+        assert charger.update_max_power(3000)
+        # Raise within the profile interval: held back, the profile in force stays
+        assert not charger.update_max_power(4000)
+        assert charger.deferred == 4000
+        assert charger.get_max_power() == 3000
+        assert not charger.update_max_power(4500)
+        assert charger.deferred == 4500
+        # Counted once per deferred raise, not per tick
+        assert charger.profiles["deferred"] == 1
+        sent = charger.profiles["sent"]
+        clock.advance(CONF_EV_CHARGER_PROFILE_INTERVAL)
+        # Deferred raises are sent at the end of the interval
+        assert charger.set_max_power(4500)
+        assert charger.deferred is None
+        assert charger.get_max_power() == 4500
+        assert charger.profiles["sent"] == sent + 1
+    with_charger(clock, test)
+
+def test_drop_sent_right_away(clock):
+    async def test(hass, charger):
+        assert charger.update_max_power(4000)
+        assert not charger.update_max_power(5000)
+        # A drop is never rate limited and replaces the deferred raise
+        assert charger.update_max_power(2000)
+        assert charger.deferred is None
+        assert charger.get_max_power() == 2000
+    with_charger(clock, test)
+
+def test_same_amps_suppressed(clock):
+    async def test(hass, charger):
+        assert charger.update_max_power(4700)
+        sent = charger.profiles["sent"]
+        clock.advance(CONF_EV_CHARGER_PROFILE_INTERVAL)
+        # Same whole amps on the charger side: nothing sent
+        assert charger.limit_amps(4650 * charger.limit_scale()) == charger.limit_amps(4700 * charger.limit_scale())
+        assert not charger.update_max_power(4650)
+        assert charger.profiles["sent"] == sent
+        assert charger.profiles["suppressed"] == 1
+        assert charger.get_max_power() == 4650
+    with_charger(clock, test)
+
+def test_shed_reports_what_the_profile_removes(clock):
+    async def test(hass, charger):
+        charger.active = True
+        assert charger.update_max_power(4700)
+        # Within the same amps: nothing shed
+        assert charger.shed(50) == 0
+        # Whole amps removed, whatever the excess asked
+        shed = charger.shed(1000)
+        assert shed == (charger.limit_amps(4700 * 3) - charger.limit_amps(charger.get_max_power() * 3)) * CONF_PHASE_VOLTAGE
+        assert shed > 0
+    with_charger(clock, test)
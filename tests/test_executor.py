@@ -0,0 +1,30 @@
+import asyncio
+from fake_hass import FakeHass
+from custom_components.home_ems.const import *
+from custom_components.home_ems.executor import ServiceExecutor
+
+def test_hung_target_does_not_block_the_others():
+    async def run():
+        hass = FakeHass()
+        hung = asyncio.Event()
+
+        async def async_call(domain, service, data, blocking=False):
+            if data["entity_id"] == "switch.charger":
+                await hung.wait()
+            hass.states.set(data["entity_id"], service[5:])
+
+        hass.services.async_call = async_call
+        executor = ServiceExecutor(hass)
+        stuck = [ asyncio.ensure_future(executor.async_call("switch", "turn_on", { "entity_id": "switch.charger" }))
+                  for _ in range(CONF_EXECUTOR_MAX_PENDING) ]
+        await asyncio.sleep(0)
+        # Beyond the backlog of the hung target: dropped and counted
+        assert not await executor.async_call("switch", "turn_off", { "entity_id": "switch.charger" })
+        assert executor.rejected == 1
+        # Another switch still gets its slots
+        assert await executor.async_call("switch", "turn_on", { "entity_id": f"switch.{CONF_ENTITY_ID}_ev_tri" })
+        hung.set()
+        assert all(await asyncio.gather(*stuck))
+        return executor
+    executor = asyncio.run(run())
+    assert executor.stats()["pending"] == 0
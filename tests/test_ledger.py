@@ -0,0 +1,70 @@
+from custom_components.home_ems.const import *
+from custom_components.home_ems.ledger import PHASE_LIMIT, PhaseLedger
+
+class Load:
+
+    def __init__(self, phases):
+        self.phases = phases
+
+    def get_phases(self):
+        return self.phases
+
+def test_contributions_split_on_the_phases():
+    ledger = PhaseLedger()
+    single, tri = Load(0b010), Load(0b111)
+    ledger.set(single, 2300)
+    ledger.set(tri, 6900)
+    assert ledger.contributions[single] == [ 0.0, 2300.0, 0.0 ]
+    assert ledger.contributions[tri] == [ 2300.0, 2300.0, 2300.0 ]
+    assert ledger.load(1) == 4600
+    assert ledger.load(1, (tri,)) == 2300
+    # The load moves to another phase: split again
+    single.phases = 0b001
+    ledger.set(single, 2300)
+    assert ledger.contributions[single] == [ 2300.0, 0.0, 0.0 ]
+
+def test_measured_currents_give_the_other_loads():
+    ledger = PhaseLedger()
+    load = Load(0b001)
+    ledger.set(load, 2300)
+    ledger.measure([ 15, 4, 0 ])
+    assert ledger.measured
+    # 15A on phase 1, 10A of them from the managed load
+    assert ledger.others == [ 5 * CONF_PHASE_VOLTAGE, 4 * CONF_PHASE_VOLTAGE, 0.0 ]
+    ledger.measure(None)
+    assert not ledger.measured
+    assert ledger.others == [ 0.0, 0.0, 0.0 ]
+
+def test_headroom_and_limit():
+    ledger = PhaseLedger()
+    single, tri = Load(0b001), Load(0b111)
+    ledger.set(single, 2300)
+    ledger.set(tri, 3450)
+    ledger.measure([ 20, 5, 5 ])
+    # Phase 1: 20A measured, 5A of them from the other loads
+    assert ledger.headroom() == [ PHASE_LIMIT - 20 * CONF_PHASE_VOLTAGE, PHASE_LIMIT - 5 * CONF_PHASE_VOLTAGE, PHASE_LIMIT - 5 * CONF_PHASE_VOLTAGE ]
+    assert ledger.headroom((single, tri)) == [ PHASE_LIMIT - 5 * CONF_PHASE_VOLTAGE, PHASE_LIMIT, PHASE_LIMIT ]
+    # Three phase load: limited by its most loaded phase, own power excluded
+    assert ledger.limit(tri) == (PHASE_LIMIT - 15 * CONF_PHASE_VOLTAGE) * 3
+    assert ledger.limit(single) == PHASE_LIMIT - 10 * CONF_PHASE_VOLTAGE
+    assert ledger.allows(single, PHASE_LIMIT - 10 * CONF_PHASE_VOLTAGE)
+    assert not ledger.allows(single, PHASE_LIMIT)
+
+def test_limit_is_never_negative():
+    ledger = PhaseLedger()
+    load = Load(0b100)
+    ledger.measure([ 0, 0, 2 * CONF_MAX_CURRENT_PER_PHASE ])
+    assert ledger.limit(load) == 0
+
+def test_overloads_counted_on_transitions():
+    ledger = PhaseLedger()
+    over = CONF_MAX_CURRENT_PER_PHASE + 1
+    ledger.measure([ over, 0, 0 ])
+    ledger.measure([ over, over, 0 ])
+    assert ledger.overloads == 2
+    assert ledger.over == { 0, 1 }
+    ledger.measure([ 0, over, 0 ])
+    assert ledger.over == { 1 }
+    ledger.measure([ over, over, 0 ])
+    assert ledger.overloads == 3
+    assert ledger.stats()["overloads"] == 3
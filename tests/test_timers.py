@@ -0,0 +1,48 @@
+from custom_components.home_ems.timers import Timers
+
+def test_expiry(clock):
+    timers = Timers()
+    timers.start("activation", 60)
+    assert timers.is_started("activation")
+    assert timers.is_running("activation")
+    assert not timers.expired("activation")
+    clock.advance(59)
+    assert timers.is_running("activation")
+    clock.advance(1)
+    assert not timers.is_running("activation")
+    assert timers.expired("activation")
+    # Expired timers stay started until cancelled
+    assert timers.is_started("activation")
+    timers.cancel("activation")
+    assert not timers.is_started("activation")
+    assert not timers.expired("activation")
+
+def test_next_deadline(clock):
+    timers = Timers()
+    assert timers.next_deadline() is None
+    timers.start("activation", 300)
+    timers.start("profile", 60)
+    assert timers.next_deadline() == 60
+    clock.advance(60)
+    # Expired: no longer pending
+    assert timers.next_deadline() == 300
+    timers.cancel("activation")
+    assert timers.next_deadline() is None
+
+def test_restart_moves_the_deadline(clock):
+    timers = Timers()
+    timers.start("profile", 60)
+    clock.advance(50)
+    timers.start("profile", 60)
+    clock.advance(50)
+    assert timers.is_running("profile")
+
+def test_save_and_restore(clock):
+    timers = Timers()
+    timers.start("deactivation", 120)
+    saved = timers.save()
+    clock.advance(30)
+    restored = Timers()
+    restored.restore(saved)
+    # Wall clock deadline: the 30s elapsed meanwhile are not given back
+    assert restored.next_deadline() == clock.monotonic() + 90
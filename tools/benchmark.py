@@ -0,0 +1,187 @@
+#
+# Micro benchmarks of the decision loop against a fake hass sized from a few
+# dozen to 100k entities.
+#
+#   python tools/benchmark.py
+#   python tools/benchmark.py --sizes 50,100000 --iterations 2000 --no-cache
+#
+# For each path: median and p95 wall time per call, peak memory allocated
+# during a call, hass.states.get calls and entity registry lookups per call.
+#
+import argparse
+import asyncio
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+
+from fake_hass import FakeHass, VirtualClock
+from custom_components.home_ems import clock
+from custom_components.home_ems.clock import monotonic
+from custom_components.home_ems.const import *
+from custom_components.home_ems.utils import config_snapshot, command_bus
+
+class Bench:
+
+    def __init__(self, size, use_cache):
+        # 3am: HC planning of the water heater is active
+        self.clock = VirtualClock(datetime(2024, 6, 21, 3, 0))
+        clock.set_clock(self.clock)
+        self.hass = FakeHass(self.clock)
+        self.hass.add_filler_entities(size)
+        self.hass.add_local_entities({ "loadbalancer": True, "ev_request": True, "cro_request": True })
+        self.hass.add_home_entities()
+        self.load_balancer = self.hass.setup_home_ems()
+        if not use_cache:
+            del self.hass.data[DOMAIN]["entity_cache"]
+        self.load_balancer.late_init()
+        self.iteration = 0
+
+    def start_tick(self):
+        self.iteration += 1
+        self.config = config_snapshot(self.hass)
+        self.load_balancer.start_tick(self.config)
+
+    def set_switch(self, name, value):
+        self.hass.states.set(f"switch.{CONF_ENTITY_ID}_{name}", "on" if value else "off")
+
+    def power(self):
+        # Alternate between export and import so that decisions change
+        return -3000 if self.iteration % 2 == 0 else 500
+
+    #
+    # Paths
+    #
+
+    def reset_tick(self):
+        lb = self.load_balancer
+        lb.cooldowns.clear()
+        self.set_switch("ev_request", True)
+        self.set_switch("cro_request", True)
+        self.hass.states.set(f"sensor.{CONF_ENHPASE_ID}_power_net_1min", self.power())
+        self.hass.states.set(f"sensor.{CONF_EV_CHARGER_ID}_status_connector", "Charging")
+        self.iteration += 1
+
+    def run_tick(self):
+        self.load_balancer.decide(self.hass)
+        command_bus(self.hass).flush()
+
+    def reset_ev_modulation(self):
+        ev = self.load_balancer.evcharger
+        self.hass.states.set(f"sensor.{CONF_EV_CHARGER_ID}_status_connector", "Charging")
+        self.set_switch("ev_request", True)
+        self.set_switch("cro_request", False)
+        self.start_tick()
+        self.load_balancer.cooldowns.clear()
+        ev.active = True
+        ev.activate_first = False
+        ev.tri_detected = False
+        ev.max_power = 3000
+        ev.timers.cancel("deactivation")
+
+    def run_ev_modulation(self):
+        # Modulation is decided by the surplus allocator
+        self.load_balancer.allocate(self.power(), self.config, monotonic())
+        command_bus(self.hass).flush()
+
+    def reset_cro_solar_start(self):
+        cro = self.load_balancer.cro
+        self.set_switch("cro_request", True)
+        self.start_tick()
+        self.load_balancer.cooldowns.clear()
+        self.load_balancer.evcharger.active = False
+        cro.active = False
+        cro.timers.cancel("activation")
+
+    def run_cro_solar_start(self):
+        self.load_balancer.allocate(-3000, self.config, monotonic())
+        command_bus(self.hass).flush()
+
+    def reset_water_heater_hc(self):
+        water_heater = self.load_balancer.water_heater
+        self.hass.states.set(f"select.{CONF_ENTITY_ID}_mode", "HC/HP")
+        self.hass.states.set(f"sensor.{CONF_LINKY_ID}_ntarf", 1)
+        self.hass.states.set(f"sensor.{CONF_WATER_HEATER_ID}_middle_water_temperature", 45)
+        self.start_tick()
+        water_heater.is_hc_hp = True
+        water_heater.active = True
+        water_heater.suspended = False
+        water_heater.needed_temperature = CONF_WATER_HEATER_MIN_TEMP
+        water_heater.force_pv_hc = False
+
+    def run_water_heater_hc(self):
+        self.load_balancer.water_heater.update(0, self.config)
+        command_bus(self.hass).flush()
+
+PATHS = {
+    "tick": ("reset_tick", "run_tick"),
+    "ev_modulation": ("reset_ev_modulation", "run_ev_modulation"),
+    "cro_solar_start": ("reset_cro_solar_start", "run_cro_solar_start"),
+    "water_heater_hc": ("reset_water_heater_hc", "run_water_heater_hc"),
+}
+
+async def measure(bench, path, iterations):
+    reset = getattr(bench, PATHS[path][0])
+    run = getattr(bench, PATHS[path][1])
+    hass = bench.hass
+    times = []
+    gets = 0
+    lookups = 0
+    for i in range(iterations):
+        reset()
+        gets_before = hass.states.gets
+        lookups_before = hass.registry.lookups
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        gets += hass.states.gets - gets_before
+        lookups += hass.registry.lookups - lookups_before
+        # Service calls complete outside the measured section
+        await hass.async_block_till_done()
+
+    # Allocations: peak traced memory of one call, averaged
+    allocations = []
+    tracemalloc.start()
+    for i in range(min(iterations, 100)):
+        reset()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        run()
+        allocations.append(tracemalloc.get_traced_memory()[1] - current)
+        await hass.async_block_till_done()
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "median_us": statistics.median(times) * 1e6,
+        "p95_us": times[int(len(times) * 0.95)] * 1e6,
+        "alloc_b": statistics.mean(allocations),
+        "states_get": gets / iterations,
+        "registry": lookups / iterations,
+    }
+
+async def benchmark(args):
+    print(f"{'entities':>9} {'path':<16} {'median_us':>10} {'p95_us':>10} {'alloc_B':>9} {'states.get':>11} {'registry':>9}")
+    for size in args.sizes:
+        bench = Bench(size, not args.no_cache)
+        await bench.hass.async_block_till_done()
+        for path in args.paths:
+            result = await measure(bench, path, args.iterations)
+            print(
+                f"{size:>9} {path:<16} {result['median_us']:>10.1f} {result['p95_us']:>10.1f} "
+                f"{result['alloc_b']:>9.0f} {result['states_get']:>11.1f} {result['registry']:>9.1f}"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Home-EMS decision loop")
+    parser.add_argument("--sizes", default="50,1000,10000,100000", help="entity counts of the fake hass")
+    parser.add_argument("--paths", default=",".join(PATHS), help="paths to measure")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--no-cache", action="store_true", help="disable the entity id cache")
+    args = parser.parse_args()
+    args.sizes = [ int(size) for size in args.sizes.split(",") ]
+    args.paths = args.paths.split(",")
+    asyncio.run(benchmark(args))
+
+if __name__ == "__main__":
+    main()
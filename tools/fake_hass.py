@@ -0,0 +1,240 @@
+#
+# Minimal in-memory Home Assistant used by the simulator and the benchmarks:
+# only what Home-EMS uses (state machine, entity registry, service bus and
+# tasks on the running event loop)
+#
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from homeassistant.helpers import entity_registry as er
+from custom_components.home_ems.const import *
+from custom_components.home_ems.load_balancer import LoadBalancer
+from custom_components.home_ems.entity_cache import EntityIdCache
+from custom_components.home_ems.command_bus import CommandBus
+from custom_components.home_ems.aggregator import PowerAggregator
+from custom_components.home_ems.overload import OverloadGuard
+from custom_components.home_ems.metrics import Metrics
+from custom_components.home_ems.profiler import Profiler
+
+LOCAL_SWITCHES = [
+    "loadbalancer", "holidays", "dev", "profiling",
+    "ev_force", "ev_request", "ev_hc", "ev_tri",
+    "cro_force", "cro_request", "cro_hc",
+    "pool_force", "water_heater_force", "water_heater_boost",
+]
+
+class VirtualClock:
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+        # Time only moves with advance()
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance(self, seconds):
+        self.elapsed += seconds
+        self.current = self.start + timedelta(seconds=self.elapsed)
+
+class FakeState:
+
+    def __init__(self, entity_id, state, attributes=None, last_updated=None):
+        self.entity_id = entity_id
+        self.state = state
+        self.attributes = attributes or {}
+        self.last_updated = last_updated
+        self.last_changed = last_updated
+        self.last_reported = last_updated
+
+    def __repr__(self):
+        return f"<state {self.entity_id}={self.state}>"
+
+class FakeEvent:
+
+    def __init__(self, event_type, data):
+        self.event_type = event_type
+        self.data = data
+
+class FakeStates:
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.states = {}
+        self.gets = 0
+        # entity_id -> state change listeners (async_track_state_change_event)
+        self.listeners = {}
+
+    def listen(self, entity_ids, action):
+        for entity_id in entity_ids:
+            self.listeners.setdefault(entity_id, []).append(action)
+
+    def get(self, entity_id):
+        self.gets += 1
+        return self.states.get(entity_id)
+
+    def set(self, entity_id, state, attributes=None):
+        previous = self.states.get(entity_id)
+        if attributes is None and previous is not None:
+            attributes = previous.attributes
+        now = self.clock.now() if self.clock is not None else None
+        if previous is not None and previous.state == str(state) and previous.attributes == (attributes or {}):
+            # Same value: only reported, no state_changed (HA 2024.4+)
+            previous.last_reported = now
+            return
+        self.states[entity_id] = FakeState(entity_id, str(state), attributes, now)
+        for action in self.listeners.get(entity_id, []):
+            action(FakeEvent("state_changed", { "entity_id": entity_id, "old_state": previous, "new_state": self.states[entity_id] }))
+
+class FakeEntityRegistry:
+
+    def __init__(self):
+        self.entities = {}
+        self.lookups = 0
+
+    def register(self, domain, platform, unique_id, entity_id):
+        self.entities[(domain, platform, unique_id)] = entity_id
+
+    def async_get_entity_id(self, domain, platform, unique_id):
+        self.lookups += 1
+        return self.entities.get((domain, platform, unique_id))
+
+class FakeServices:
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.handlers = {}
+        self.calls = []
+
+    def register(self, domain, service, handler):
+        self.handlers[(domain, service)] = handler
+
+    async def async_call(self, domain, service, data, blocking=False):
+        clock = self.hass.clock
+        self.calls.append((clock.now() if clock is not None else None, domain, service, data))
+        handler = self.handlers.get((domain, service))
+        if handler is not None:
+            handler(data)
+        else:
+            self.default_handler(domain, service, data)
+
+    def default_handler(self, domain, service, data):
+        entity_id = data.get("entity_id")
+        if entity_id is None:
+            return
+        if service in ("turn_on", "turn_off"):
+            self.hass.states.set(entity_id, service[5:])
+        elif service == "set_value":
+            self.hass.states.set(entity_id, data["value"])
+        elif service == "set_temperature":
+            state = self.hass.states.get(entity_id)
+            attributes = dict(state.attributes) if state is not None else {}
+            attributes["temperature"] = data["temperature"]
+            self.hass.states.set(entity_id, state.state if state is not None else "on", attributes)
+
+class FakeBus:
+
+    def __init__(self):
+        self.events = []
+
+    def async_listen(self, event_type, listener):
+        return lambda: None
+
+    def async_fire(self, event_type, data=None):
+        self.events.append((event_type, data))
+
+class FakeConfig:
+
+    def __init__(self, config_dir="."):
+        self.config_dir = config_dir
+        self.latitude = 45.0
+        self.longitude = 5.0
+
+    def path(self, *path):
+        return os.path.join(self.config_dir, *path)
+
+class FakeHass:
+
+    def __init__(self, clock=None):
+        self.loop = asyncio.get_running_loop()
+        self.clock = clock
+        self.states = FakeStates(clock)
+        self.services = FakeServices(self)
+        self.bus = FakeBus()
+        self.config = FakeConfig()
+        self.registry = FakeEntityRegistry()
+        self.data = { er.DATA_REGISTRY: self.registry }
+        self.tasks = set()
+
+    def async_create_task(self, coro, *args, **kwargs):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def async_add_executor_job(self, target, *args):
+        return await self.loop.run_in_executor(None, target, *args)
+
+    async def async_block_till_done(self):
+        # Let call_soon callbacks (command bus flush) and created tasks run
+        await asyncio.sleep(0)
+        while len(self.tasks) > 0:
+            await asyncio.gather(*list(self.tasks))
+            await asyncio.sleep(0)
+
+    def setup_home_ems(self):
+        # Same objects as async_setup_entry, without the platforms
+        load_balancer = LoadBalancer(self, None)
+        self.data[DOMAIN] = {
+            "load_balancer"    : load_balancer,
+            "entity_cache"     : EntityIdCache(self),
+            "command_bus"      : CommandBus(self),
+            "metrics"          : Metrics(),
+            "profiler"         : Profiler(self),
+            "power_aggregator" : PowerAggregator(load_balancer.enphase.power_net_id),
+            "overload_guard"   : OverloadGuard(self, load_balancer)
+        }
+        return load_balancer
+
+    def add_local_entities(self, switches=None, mode="Solar"):
+        # Home-EMS switches and select, as created by switch.py/select.py
+        switches = switches or {}
+        for name in LOCAL_SWITCHES:
+            entity_id = f"switch.{CONF_ENTITY_ID}_{name}"
+            self.registry.register("switch", DOMAIN, f"{CONF_ENTITY_ID}_{name}", entity_id)
+            self.states.set(entity_id, "on" if switches.get(name, False) else "off")
+        entity_id = f"select.{CONF_ENTITY_ID}_mode"
+        self.registry.register("select", DOMAIN, f"{CONF_ENTITY_ID}_mode", entity_id)
+        self.states.set(entity_id, mode)
+
+    def add_home_entities(self):
+        # External entities used by the devices, in their idle state
+        self.states.set(f"switch.{CONF_CRO_ID}", "off")
+        self.states.set(f"sensor.{CONF_CRO_ID}_tpl_power", 0)
+        self.states.set(f"switch.{CONF_EV_CHARGER_ID}_charge_control", "off")
+        self.states.set(f"sensor.{CONF_EV_CHARGER_ID}_status_connector", "Available")
+        self.states.set(f"sensor.{CONF_EV_CHARGER_ID}_power_offered", 0)
+        self.states.set(f"sensor.{CONF_EV_CHARGER_ID}_power_active_import", 0)
+        self.states.set(f"switch.{CONF_WATER_HEATER_ID}_pv", "off")
+        self.states.set(f"number.{CONF_WATER_HEATER_ID}_boost_mode_duration", 0)
+        self.states.set(f"water_heater.{CONF_WATER_HEATER_ID}", "eco", { "temperature": CONF_WATER_HEATER_MIN_TEMP })
+        self.states.set(f"sensor.{CONF_WATER_HEATER_ID}_middle_water_temperature", 50)
+        self.states.set(f"sensor.{CONF_ENHPASE_ID}_power_net_1min", 0)
+        self.states.set(f"sensor.{CONF_ENHPASE_ID}_power_net_5min", 0)
+        self.states.set(f"sensor.{CONF_LINKY_ID}_ntarf", 2)
+        self.states.set(f"sensor.{CONF_POOL_ID}_temp_water", 28)
+
+    def add_filler_entities(self, count):
+        # Unrelated entities, to size the state machine and the registry
+        for i in range(count):
+            entity_id = f"sensor.filler_{i}"
+            self.registry.register("sensor", "filler", f"filler_{i}", entity_id)
+            self.states.set(entity_id, i)
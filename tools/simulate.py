@@ -0,0 +1,334 @@
+#
+# Offline simulation of the load balancer on a virtual clock.
+#
+# Replays a recorded time series (Home Assistant history export:
+# entity_id,state,last_changed) or a synthetic day, runs LoadBalancer and all
+# devices against a fake hass and prints every actuation.
+#
+#   python tools/simulate.py                      # synthetic sunny day
+#   python tools/simulate.py history.csv --step 15 --ev-tri
+#
+# The recorded net power is used as the baseline of the house without the
+# controlled loads: the simulated CRO, EV charger and water heater consumption
+# is added on top of it and the 1min/5min averages are computed from the sum.
+#
+import argparse
+import asyncio
+import csv
+import json
+import math
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from fake_hass import FakeHass, VirtualClock
+from custom_components.home_ems import clock
+from custom_components.home_ems.const import *
+
+BASELINE_ENTITY = f"sensor.{CONF_ENHPASE_ID}_power_net_1min"
+CONNECTOR_ENTITY = f"sensor.{CONF_EV_CHARGER_ID}_status_connector"
+WATER_TEMPERATURE_ENTITY = f"sensor.{CONF_WATER_HEATER_ID}_middle_water_temperature"
+
+WATER_HEATER_REAL_POWER = 2450
+EV_CHARGER_MAX_POWER_PER_PHASE = 7360
+EV_CHARGER_MIN_POWER_PER_PHASE = 1380
+
+#
+# Inputs
+#
+
+def parse_time(value):
+    value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+def load_history(path):
+    rows = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            rows.append((parse_time(row["last_changed"]), row["entity_id"], row["state"]))
+    rows.sort()
+    return rows
+
+def synthetic_day(start, seed=1):
+    # Sunny day with a few clouds, EV plugged from 9am to 6pm
+    rnd = random.Random(seed)
+    rows = []
+    cloud = 1.0
+    for minute in range(0, 24 * 60, 1):
+        t = start + timedelta(minutes=minute)
+        hour = minute / 60
+        pv = 0.0
+        if 7 < hour < 20:
+            pv = 6000 * math.sin(math.pi * (hour - 7) / 13)
+        if rnd.random() < 0.05:
+            cloud = rnd.uniform(0.3, 1.0)
+        elif rnd.random() < 0.2:
+            cloud = 1.0
+        load = 400 + rnd.uniform(-50, 50)
+        if 12 <= hour < 12.5 or 19 <= hour < 20:
+            load += 1500
+        rows.append((t, BASELINE_ENTITY, round(load - pv * cloud)))
+        if minute % 60 == 0:
+            rows.append((t, f"sensor.{CONF_LINKY_ID}_ntarf", 1 if hour >= 23 or hour < 7 else 2))
+            rows.append((t, f"sensor.{CONF_POOL_ID}_temp_water", 28))
+            rows.append((t, CONNECTOR_ENTITY, "Preparing" if 9 <= hour < 18 else "Available"))
+    return rows
+
+#
+# House model
+#
+
+class RollingAverage:
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.sum = 0.0
+
+    def add(self, t, value):
+        self.samples.append((t, value))
+        self.sum += value
+        while self.samples[0][0] <= t - self.window:
+            self.sum -= self.samples.popleft()[1]
+
+    def value(self):
+        return self.sum / len(self.samples)
+
+class House:
+
+    def __init__(self, hass, args):
+        self.hass = hass
+        self.ev_tri = args.ev_tri
+        self.three_phase = args.three_phase
+        # Envoy outage: its sensors are not updated between these times
+        self.outage = None
+        if args.envoy_outage is not None:
+            self.outage = [ datetime.strptime(value, "%H:%M").time() for value in args.envoy_outage.split("-") ]
+        self.ev_need = args.ev_need * 1000
+        self.cro_need = args.cro_need * 1000
+        self.water_temperature = args.water_temperature
+        self.replay_water_temperature = False
+        self.plugged = False
+        self.baseline = 0.0
+        self.ev_offered = 0.0
+        # Charge profile periods: (virtual time, limit)
+        self.ev_schedule = []
+        self.average_1min = RollingAverage(60)
+        self.average_5min = RollingAverage(300)
+        self.imported = 0.0
+        self.exported = 0.0
+        self.energy = { "cro": 0.0, "ev": 0.0, "water_heater": 0.0 }
+        # Raw net power samples and overload detection
+        if not args.averages_only:
+            aggregator = hass.data[DOMAIN]["power_aggregator"]
+            hass.states.listen([ aggregator.entity_id ], aggregator.on_state_change)
+        guard = hass.data[DOMAIN]["overload_guard"]
+        hass.states.listen([ guard.power_net_id ] + guard.irms_ids, guard.on_state_change)
+        load_balancer = hass.data[DOMAIN]["load_balancer"]
+        hass.states.listen([ load_balancer.evcharger.status_connector_id ], load_balancer.on_connector_change)
+        hass.services.register("ocpp", "set_charge_rate", self.on_set_charge_rate)
+
+    def on_set_charge_rate(self, data):
+        now = clock.now()
+        periods = data["custom_profile"]["chargingSchedule"]["chargingSchedulePeriod"]
+        self.ev_schedule = [ (now + timedelta(seconds=period["startPeriod"]), period["limit"]) for period in periods ]
+        self.apply_charge_rate(now)
+
+    def apply_charge_rate(self, now):
+        # The charger follows the schedule in whole amps per phase
+        limit = [ limit for start, limit in self.ev_schedule if start <= now ][-1]
+        phases = 3 if self.ev_tri else 1
+        amps = int(limit / (CONF_PHASE_VOLTAGE * 3))
+        offered = min(amps * CONF_PHASE_VOLTAGE * phases, EV_CHARGER_MAX_POWER_PER_PHASE * phases)
+        if offered != self.ev_offered:
+            self.ev_offered = offered
+            self.hass.states.set(f"sensor.{CONF_EV_CHARGER_ID}_power_offered", round(self.ev_offered / 1000, 3))
+
+    def replay(self, entity_id, state):
+        # Recorded inputs of the model, others go to the state machine
+        if entity_id == BASELINE_ENTITY:
+            self.baseline = float(state)
+        elif entity_id == CONNECTOR_ENTITY:
+            self.plugged = state != "Available"
+        else:
+            if entity_id == WATER_TEMPERATURE_ENTITY:
+                self.replay_water_temperature = True
+            self.hass.states.set(entity_id, state)
+
+    def is_on(self, entity_id):
+        state = self.hass.states.get(entity_id)
+        return state is not None and state.state == "on"
+
+    def step(self, now, elapsed, dt):
+        states = self.hass.states
+        hours = dt / 3600
+
+        # CRO: consumes until its need is satisfied
+        cro = CONF_CRO_POWER if self.is_on(f"switch.{CONF_CRO_ID}") and self.cro_need > 0 else 0
+        self.cro_need -= cro * hours
+        states.set(f"sensor.{CONF_CRO_ID}_tpl_power", cro)
+
+        # EV charger
+        if len(self.ev_schedule) > 1:
+            self.apply_charge_rate(now)
+        ev = 0.0
+        if not self.plugged:
+            status = "Available"
+        elif not self.is_on(f"switch.{CONF_EV_CHARGER_ID}_charge_control"):
+            status = "Preparing"
+        elif self.ev_need <= 0:
+            status = "SuspendedEV"
+        elif self.ev_offered < EV_CHARGER_MIN_POWER_PER_PHASE:
+            status = "SuspendedEVSE"
+        else:
+            status = "Charging"
+            ev = self.ev_offered
+        self.ev_need -= ev * hours
+        states.set(CONNECTOR_ENTITY, status)
+        states.set(f"sensor.{CONF_EV_CHARGER_ID}_power_active_import", round(ev / 1000, 3))
+
+        # Water heater: 1deg per 10min when heating, losses and evening usage
+        water_heater = 0.0
+        target = states.get(f"water_heater.{CONF_WATER_HEATER_ID}").attributes.get("temperature", CONF_WATER_HEATER_MIN_TEMP)
+        if self.is_on(f"switch.{CONF_WATER_HEATER_ID}_pv"):
+            target = CONF_WATER_HEATER_MAX_TEMP
+        if not self.replay_water_temperature:
+            if self.water_temperature < target:
+                water_heater = WATER_HEATER_REAL_POWER
+                self.water_temperature += dt / 600
+            self.water_temperature -= 0.3 * hours
+            if 19 <= now.hour < 21:
+                self.water_temperature -= 4 * hours
+            states.set(WATER_TEMPERATURE_ENTITY, round(self.water_temperature, 1))
+
+        # Net power and averages
+        net = self.baseline + cro + ev + water_heater
+        self.average_1min.add(elapsed, net)
+        self.average_5min.add(elapsed, net)
+        if self.outage is None or not self.outage[0] <= now.time() < self.outage[1]:
+            states.set(f"sensor.{CONF_ENHPASE_ID}_power_net", round(net))
+            states.set(f"sensor.{CONF_ENHPASE_ID}_power_net_1min", round(self.average_1min.value()))
+            states.set(f"sensor.{CONF_ENHPASE_ID}_power_net_5min", round(self.average_5min.value()))
+
+        if self.three_phase:
+            # Baseline spread on the 3 phases, EV on phase 1 (mono), CRO and water heater on phase 3
+            phases = [ self.baseline / 3 ] * 3
+            for phase in range(3):
+                if self.ev_tri or phase == 0:
+                    phases[phase] += ev / 3 if self.ev_tri else ev
+            phases[2] += cro + water_heater
+            for phase in range(3):
+                states.set(f"sensor.{CONF_LINKY_ID}_irms{phase + 1}", round(abs(phases[phase]) / CONF_PHASE_VOLTAGE))
+
+        if net > 0:
+            self.imported += net * hours
+        else:
+            self.exported -= net * hours
+        self.energy["cro"] += cro * hours
+        self.energy["ev"] += ev * hours
+        self.energy["water_heater"] += water_heater * hours
+
+#
+# Simulation
+#
+
+def initial_states(hass, args):
+    switches = { "loadbalancer": True, "ev_request": args.ev_request, "cro_request": args.cro_request, "ev_tri": args.ev_tri }
+    hass.add_local_entities(switches, mode=args.mode)
+    hass.add_home_entities()
+
+def format_call(call):
+    t, domain, service, data = call
+    target = data.get("entity_id", "")
+    if domain == "ocpp":
+        periods = data["custom_profile"]["chargingSchedule"]["chargingSchedulePeriod"]
+        value = "/".join(str(period["limit"]) for period in periods)
+    else:
+        value = data.get("value", data.get("temperature", ""))
+    return f"{t:%Y-%m-%d %H:%M:%S} {domain}.{service} {target} {value}".rstrip()
+
+async def simulate(args):
+    if args.history is not None:
+        rows = load_history(args.history)
+        start = rows[0][0]
+        end = rows[-1][0]
+    else:
+        start = datetime.combine(datetime.now().date(), datetime.min.time())
+        end = start + timedelta(days=1)
+        rows = synthetic_day(start, args.seed)
+
+    virtual_clock = VirtualClock(start)
+    clock.set_clock(virtual_clock)
+    hass = FakeHass(virtual_clock)
+    initial_states(hass, args)
+    load_balancer = hass.setup_home_ems()
+    house = House(hass, args)
+    if args.ev_schedule:
+        load_balancer.evcharger.profile_mode = "schedule"
+    if args.trace:
+        # Decision records of the ticks where something happened
+        load_balancer.trace.subscribe(lambda record: print(json.dumps(record)) if len(record["actions"]) > 0 else None)
+
+    load_balancer.late_init()
+    await hass.async_block_till_done()
+    if args.profile > 0:
+        # Same as the profiling switch, report in the current directory
+        hass.data[DOMAIN]["profiler"].start(args.profile)
+
+    wall_start = time.perf_counter()
+    index = 0
+    ticks = 0
+    reported = 0
+    while virtual_clock.now() <= end:
+        now = virtual_clock.now()
+        while index < len(rows) and rows[index][0] <= now:
+            house.replay(rows[index][1], rows[index][2])
+            index += 1
+        house.step(now, virtual_clock.elapsed, args.step)
+        await load_balancer.run(hass)
+        await hass.async_block_till_done()
+        ticks += 1
+        if not args.quiet:
+            for call in hass.services.calls[reported:]:
+                print(format_call(call))
+        reported = len(hass.services.calls)
+        virtual_clock.advance(args.step)
+    wall = time.perf_counter() - wall_start
+
+    print(f"simulated {end - start} in {ticks} ticks, {wall:.3f}s wall time")
+    print(f"actuations: {len(hass.services.calls)} sent, {hass.data[DOMAIN]['command_bus'].stats()}")
+    print(f"overloads: {hass.data[DOMAIN]['overload_guard'].count}")
+    metrics = hass.data[DOMAIN]["metrics"]
+    print(f"ticks: {metrics.tick_duration_ms()}ms, per tick: {metrics.per_tick(1)} states.get {metrics.per_tick(2)} registry {metrics.per_tick(3)} service calls (last {CONF_METRICS_WINDOW})")
+    if args.metrics:
+        print(metrics.exposition(hass.data[DOMAIN]["command_bus"].executor), end="")
+    print(f"grid: imported {house.imported / 1000:.2f}kWh exported {house.exported / 1000:.2f}kWh")
+    print("loads: " + " ".join(f"{name}={energy / 1000:.2f}kWh" for name, energy in house.energy.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Home-EMS load balancing on a virtual clock")
+    parser.add_argument("history", nargs="?", help="history CSV export (entity_id,state,last_changed), synthetic day if omitted")
+    parser.add_argument("--step", type=float, default=CONF_SCHEDULER_PERIOD, help="tick period in seconds")
+    parser.add_argument("--mode", default="Solar", choices=[ "Solar", "HC/HP" ])
+    parser.add_argument("--ev-request", action="store_true", help="EV charge requested at start")
+    parser.add_argument("--ev-tri", action="store_true", help="car charges on 3 phases")
+    parser.add_argument("--ev-schedule", action="store_true", help="multi-period charge profiles from the surplus forecast")
+    parser.add_argument("--ev-need", type=float, default=20, help="energy the car needs (kWh)")
+    parser.add_argument("--cro-request", action="store_true", help="CRO requested at start")
+    parser.add_argument("--cro-need", type=float, default=4, help="energy the CRO needs (kWh)")
+    parser.add_argument("--water-temperature", type=float, default=52, help="initial water temperature")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic day")
+    parser.add_argument("--three-phase", action="store_true", help="publish Linky per phase currents")
+    parser.add_argument("--envoy-outage", metavar="HH:MM-HH:MM", help="Enphase sensors frozen during this time range")
+    parser.add_argument("--averages-only", action="store_true", help="decide on the Enphase 1min/5min averages only")
+    parser.add_argument("--trace", action="store_true", help="print the decision records of the ticks that acted")
+    parser.add_argument("--metrics", action="store_true", help="print the metrics in the Prometheus text format")
+    parser.add_argument("--profile", type=int, default=0, help="profile the first N ticks (cProfile + tracemalloc)")
+    parser.add_argument("--quiet", action="store_true", help="only print the summary")
+    asyncio.run(simulate(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()